@@ -14,6 +14,7 @@ import argparse
 import re
 import urllib2
 import multiprocessing
+import threading
 import tempfile
 
 # NRC pyEnSim. must be installed prior to use.
@@ -24,8 +25,19 @@ import pyEnSim_basics
 import met_process
 import post_process
 import pre_process
+import tempdiff
+import worker_pool
+import snapshot
 
 
+#folders of the model directory that WATFLOOD only reads, their files are hard linked into the run workspaces
+#(see setup_run_workspace); everything else is copied, since a run may write it (ie. level/<date>_ill.pt2)
+WORKSPACE_LINKED_FOLDERS = ["basin", "strfw"]
+
+#executables are started one at a time, so one started from a thread can't inherit the handles another is being
+#started with (see run_executable)
+_popen_lock = threading.Lock()
+
 
 def UpdateConfig(config_file):
     """
@@ -120,8 +132,7 @@ def spin_up(config_file):
       member_repository = os.path.join(os.path.dirname(os.path.dirname(config_file.repository_directory)), member,"Repo")
       input.append([config_file,member_repository,"False"])
       
-    pool = multiprocessing.Pool(processes = len(members) + 1)
-    pool.map(execute_and_plot_spinup,input)
+    worker_pool.get_pool().map(execute_and_plot_spinup,input)
 
 
     
@@ -175,8 +186,7 @@ def hindcast(config_file):
       member_repository = os.path.join(os.path.dirname(os.path.dirname(config_file.repository_directory)), member, "Repo")
       input.append([config_file, member_repository, "False"])
       
-    pool = multiprocessing.Pool(processes = len(members) + 1)
-    pool.map(execute_and_plot_hindcast,input)
+    worker_pool.get_pool().map(execute_and_plot_hindcast,input)
 
     
     
@@ -220,8 +230,7 @@ def forecast(config_file):
       member_repository = os.path.join(os.path.dirname(os.path.dirname(config_file.repository_directory)), member, "Repo")
       input.append([config_file, member_repository, "True"])
       
-    pool = multiprocessing.Pool(processes = len(members) + 1)
-    pool.map(analyze_and_plot_forecast,input)
+    worker_pool.get_pool().map(analyze_and_plot_forecast,input)
     
 
 
@@ -603,7 +612,7 @@ def execute_and_plot_spinup(input):
     Function to execute and plot WATFLOOD spinup; then copy results from the working 'Repo' directory
     to the 'Repo_spinup' directory.
     
-    This is used in conjunction with the multiprocessing.Pool() function, which it requires a single input.
+    This is used in conjunction with the worker_pool.WorkerPool.map() function, which it requires a single input.
     The multiple input requirement is bypassed by joining them in a tuple and parsing them inside the function
     
     Args:
@@ -629,11 +638,8 @@ def execute_and_plot_spinup(input):
   
     #copy results
     print member_directory
-    if os.path.exists(os.path.join(os.path.dirname(member_directory), "Repo_spinup")):
-        shutil.rmtree(os.path.join(os.path.dirname(member_directory), "Repo_spinup"), onerror = onerror)
-    shutil.copytree(os.path.join(os.path.dirname(member_directory), "Repo"),
-                                os.path.join(os.path.dirname(member_directory), "Repo_spinup"),
-                                ignore = shutil.ignore_patterns(config_file.weather_data_directory, config_file.bin_directory))
+    snapshot_results(os.path.dirname(member_directory), "Repo_spinup",
+                     ignore = shutil.ignore_patterns(config_file.weather_data_directory, config_file.bin_directory))
                                 
                                 
                                 
@@ -642,7 +648,7 @@ def execute_and_plot_hindcast(input):
     Function to execute and plot WATFLOOD hindcast; then copy results from the working 'Repo' directory
     to the 'Repo_hindcast' directory.
     
-    This is used in conjunction with the multiprocessing.Pool() function, which it requires a single input.
+    This is used in conjunction with the worker_pool.WorkerPool.map() function, which it requires a single input.
     The multiple input requirement is bypassed by joining them in a tuple and parsing them inside the function
     
     Args:
@@ -668,27 +674,27 @@ def execute_and_plot_hindcast(input):
   
     #copy results
     print member_directory
-    if os.path.exists(os.path.join(os.path.dirname(member_directory), "Repo_hindcast")):
-        shutil.rmtree(os.path.join(os.path.dirname(member_directory), "Repo_hindcast"), onerror = onerror)
-    shutil.copytree(os.path.join(os.path.dirname(member_directory), "Repo"),
-                                os.path.join(os.path.dirname(member_directory), "Repo_hindcast"),
-                                ignore = shutil.ignore_patterns(config_file.weather_data_directory, config_file.bin_directory))
+    snapshot_results(os.path.dirname(member_directory), "Repo_hindcast",
+                     ignore = shutil.ignore_patterns(config_file.weather_data_directory, config_file.bin_directory))
                                 
                                 
                                 
 def execute_and_save_forecast(input):
     """
-    Function to execute WATFLOOD forecast and rename&copy the results to a specified
-    directory (this is usually the forecast directory in the working 'Repo' directory)
+    Function to execute WATFLOOD forecast for one meteorological ensemble member in its own run workspace
+    (see setup_run_workspace) and rename&copy the results to a specified directory (this is usually the
+    forecast directory in the working 'Repo' directory). The workspace is removed afterwards.
     
-    This is used in conjunction with the multiprocessing.Pool() function, which it requires a single input.
-    The multiple input requirement is bypassed by joining them in a tuple and parsing them inside the function
+    This is used in conjunction with the worker_pool.WorkerPool.map() function, which it requires a single input.
+    The multiple input requirement is bypassed by joining them in a tuple and parsing them inside the function.
+    It doesn't change the current directory, so it can run on threads.
     
     Args:
-        input: list of 3 arguments
+        input: list of 4 arguments
             input[0]: config_file - see class ConfigParse
             input[1]: member directory - specifies which hydrogolical member of ensemble is used
             input[2]: RunName - specifies which meteorological ensemble member used
+            input[3]: event directory - directory with the event file(s) of the meteorological ensemble member
             
     Returns:
         NULL
@@ -698,17 +704,61 @@ def execute_and_save_forecast(input):
     config_file = input[0]
     member_directory = input[1]
     RunName = input[2]
+    event_directory = input[3]
     
     #run watflood
-    execute_watflood(config_file,member_directory)
+    workspace = setup_run_workspace(config_file, member_directory, RunName, event_directory)
+    execute_watflood(config_file,workspace)
   
     #save results to common folder
-    shutil.copyfile(os.path.join(member_directory, config_file.model_directory, "results", "spl.csv"),
+    shutil.copyfile(os.path.join(workspace, config_file.model_directory, "results", "spl.csv"),
                     os.path.join(member_directory, config_file.forecast_directory, "spl" + RunName + ".csv"))
                     
-    shutil.copyfile(os.path.join(member_directory, config_file.model_directory, "results", "resin.csv"),
+    shutil.copyfile(os.path.join(workspace, config_file.model_directory, "results", "resin.csv"),
                     os.path.join(member_directory, config_file.forecast_directory, "resin" + RunName + ".csv"))
     
+    shutil.rmtree(workspace, onerror = onerror)
+    
+    
+    
+def setup_run_workspace(config_file, member_directory, RunName, event_directory):
+    """
+    Creates the workspace of a forecast run (one meteorological ensemble member of one hydrological member), so
+    all the runs can execute at the same time without sharing the event files or the results folder.
+    The workspace is a copy of the member's model directory in 'Repo_runs/RunName' next to its 'Repo' directory,
+    without the radcl, tempr, results and event folders. The files of the folders WATFLOOD only reads
+    (WORKSPACE_LINKED_FOLDERS) are hard linked to the model directory, and the rest (resume files, level files,
+    logs) are copied, as a reflink where the file system supports it, because the run may write them
+    (see snapshot.link_tree). The event files are copied from the event directory with the paths of the input
+    files pointing back to the 'mothership' model directory (see CopyModEvent).
+    
+    Args:
+        config_file: see class ConfigParse
+        member_directory: the member's 'Repo' directory
+        RunName: name of the meteorological ensemble member (ie. "01-02")
+        event_directory: directory with the event file(s) of the run
+        
+    Returns:
+        path of the workspace, use it as the member directory of execute_watflood()
+    """
+    
+    workspace = os.path.join(os.path.dirname(member_directory), "Repo_runs", RunName)
+    if os.path.exists(workspace):
+        shutil.rmtree(workspace, onerror = onerror)
+        
+    model_directory = os.path.join(member_directory, config_file.model_directory)
+    workspace_model_directory = os.path.join(workspace, config_file.model_directory)
+    os.makedirs(workspace)
+    linked_folders = [os.path.join(model_directory, folder) + os.sep for folder in WORKSPACE_LINKED_FOLDERS]
+    snapshot.link_tree(model_directory, workspace_model_directory,
+                       read_only = lambda path: any([path.startswith(folder) for folder in linked_folders]),
+                       ignore = shutil.ignore_patterns("radcl", "tempr", "results", "event"))
+    for folder in ["radcl", "tempr", "results", "event"]:
+        os.mkdir(os.path.join(workspace_model_directory, folder))
+        
+    CopyModEvent(event_directory, os.path.join(workspace_model_directory, "event"), mothership_path = config_file.model_directory_path)
+    return workspace
+    
     
     
 def analyze_and_plot_forecast(input):
@@ -717,7 +767,7 @@ def analyze_and_plot_forecast(input):
     then copy results from the working 'Repo' directory to the 'Repo_forecast' directory.
 
     
-    This is used in conjunction with the multiprocessing.Pool() function, which it requires a single input.
+    This is used in conjunction with the worker_pool.WorkerPool.map() function, which it requires a single input.
     The multiple input requirement is bypassed by joining them in a tuple and parsing them inside the function
     
     Args:
@@ -739,12 +789,28 @@ def analyze_and_plot_forecast(input):
   
     #copy results
     print member_directory
-    if os.path.exists(os.path.join(os.path.dirname(member_directory), "Repo_forecast")):
-        shutil.rmtree(os.path.join(os.path.dirname(member_directory), "Repo_forecast"), onerror=onerror)
-    shutil.copytree(os.path.join(os.path.dirname(member_directory), "Repo"),
-                                os.path.join(os.path.dirname(member_directory), "Repo_forecast"),
-                                ignore = shutil.ignore_patterns("wxData", "bin"))
+    snapshot_results(os.path.dirname(member_directory), "Repo_forecast",
+                     ignore = shutil.ignore_patterns("wxData", "bin"))
                                 
+    
+    
+def snapshot_results(member_path, snapshot_name, ignore = None):
+    """
+    Replaces a snapshot of the member's working 'Repo' directory (ie. 'Repo_hindcast') with a new one.
+    Only the files that changed since the previous snapshot are copied, see snapshot module.
+    
+    Args:
+        member_path: directory of the hydrological ensemble member (the parent of its 'Repo' directory)
+        snapshot_name: 'Repo_spinup', 'Repo_hindcast' or 'Repo_forecast'
+        ignore: see snapshot.take_snapshot()
+        
+    Returns:
+        NULL - but replaces the snapshot directory
+    """
+    
+    counts = snapshot.take_snapshot(os.path.join(member_path, "Repo"), os.path.join(member_path, snapshot_name), ignore = ignore)
+    print (snapshot_name + ": " + str(counts["copied"]) + " files copied (" + str(counts["copied_bytes"] / (1024 * 1024)) + " MB), " +
+           str(counts["linked"]) + " unchanged files linked")
 
   
 def onerror(func, path, exc_info):
@@ -769,7 +835,7 @@ def onerror(func, path, exc_info):
         
         
         
-def CopyModEvent(mothership_dir, member_dir, keywords = "NA"):
+def CopyModEvent(mothership_dir, member_dir, keywords = "NA", mothership_path = False):
     """
     Function specifically for hydrological ensemble modelling. Copies event files to different 
     member directory and changes paths of specified files back to the 'mothership' directory.
@@ -777,13 +843,16 @@ def CopyModEvent(mothership_dir, member_dir, keywords = "NA"):
     Args: mothership_dir: 'event' directory of mothership
           member_dir: 'event' directory of member
           keywords: flags found in event file that need changing
+          mothership_path: either False, or the model directory the paths are changed to. Defaults to the
+                           parent of mothership_dir
           
     Returns:
         NULL
     """
     
     #get path and names of event files
-    mothership_path = os.path.dirname(mothership_dir)
+    if mothership_path is False:
+        mothership_path = os.path.dirname(mothership_dir)
     mothership_files = os.listdir(mothership_dir)
     
     #copy event files from mothership to member, keep log
@@ -999,7 +1068,9 @@ def generate_run_event_files_forecast(config_file, members):
     (ie. there are multiple met ensemble files but only a single temperature file) in the tempr directory, 
     the last working temperature files are used.
     
-    If multiple hydrological ensembles are being used, these are executed in parallel.
+    Every met forecast of every hydrological ensemble member (including the mothership) is run in its own
+    workspace (see setup_run_workspace), and all of these runs are executed in parallel on the framework's
+    thread pool (see worker_pool module).
     
     Args:
         config_file: see class ConfigParse
@@ -1020,22 +1091,33 @@ def generate_run_event_files_forecast(config_file, members):
     #Use the met files as the 'master copy', get the simulation # from each filename
     RunNumber = [re.findall(r'met_(\d+)-(\d+).+', s) for s in met_list]
     
+    #the mothership and member 'Repo' directories, their run workspaces are created in 'Repo_runs' next to them
+    member_directories = [config_file.repository_directory]
+    for member in members:
+        member_directories.append(os.path.join(os.path.dirname(os.path.dirname(config_file.repository_directory)), member, "Repo"))
+    runs_directory = os.path.join(os.path.dirname(config_file.repository_directory), "Repo_runs")
+    for member_directory in member_directories:
+        if os.path.exists(os.path.join(os.path.dirname(member_directory), "Repo_runs")):
+            shutil.rmtree(os.path.join(os.path.dirname(member_directory), "Repo_runs"), onerror = onerror)
+    
     #for each simulation in the 'master'
+    input = []
     for i,Run in enumerate(RunNumber):
       #Parse simulation Run number
       RunName = Run[0][0] + '-' + Run[0][1]
-      print "Running Scenario: " + RunName
 
       #assign the temperature file name, if it doesn't exist, use the most recent working temperature file
       try:
         tem_list[i]
       except IndexError:
-        print "using default temp file \n"
+        print "using default temp file for Scenario: " + RunName
       else:
         new_temperature_file = tem_list[i]
         new_tempdiff_file = dif_list[i]
         
-      #generate the event file, changing the met and tem references accordingly
+      #generate the event file of this scenario, changing the met and tem references accordingly
+      event_directory = os.path.join(runs_directory, "event", RunName)
+      os.makedirs(event_directory)
       pre_process.EventGenerator(config_file, 
                          start_date = config_file.forecast_date, 
                          first_event = True, 
@@ -1044,22 +1126,23 @@ def generate_run_event_files_forecast(config_file, members):
                                   [":tbcflg", "n"],
                                   [":griddedrainfile","radcl\\" + met_list[i]],
                                   [":griddedtemperaturefile","tempr\\" + new_temperature_file],
-                                  [":griddeddailydifference","tempr\\" + new_tempdiff_file]])
-    
-      #copy to other members
-      for i in members:
-        copy_memberevents(config_file,i)
-
-      #execute parallel program to loop through each met forecast and run watflood
-      #set input for Mothership and inputs, this can be done in a loop because it is fast
-      input = [[config_file,config_file.repository_directory,RunName]] #MotherShip input
-      for j,member in enumerate(members): #member input
-          member_repository = os.path.join(os.path.dirname(os.path.dirname(config_file.repository_directory)), member,"Repo")
-          input.append([config_file,member_repository,RunName])
-          
-      #execute and save each member in parallel
-      pool = multiprocessing.Pool(processes = len(members) + 1)
-      pool.map(execute_and_save_forecast,input)
+                                  [":griddeddailydifference","tempr\\" + new_tempdiff_file]],
+                         event_directory = event_directory)
+    
+      #every member runs every scenario
+      for member_directory in member_directories:
+          input.append([config_file,member_directory,RunName,event_directory])
+
+    #execute and save every scenario of every member in parallel, each run is a WATFLOOD subprocess so
+    #threads are enough to drive them
+    pool = worker_pool.get_thread_pool()
+    print "Running " + str(len(input)) + " WATFLOOD simulations with " + str(min(pool.processes, len(input))) + " threads"
+    pool.map(execute_and_save_forecast, input)
+    print pool.stats()
+        
+    for member_directory in member_directories:
+        if os.path.exists(os.path.join(os.path.dirname(member_directory), "Repo_runs")):
+            shutil.rmtree(os.path.join(os.path.dirname(member_directory), "Repo_runs"), onerror = onerror)
         
         
 
@@ -1186,11 +1269,8 @@ def calculate_distributed_data(config_file, snow, moist):
     """
     print "Calculating Distributed Data"
     
-    # initial directory
-    initial_directory = os.getcwd()
-    
-    # change directory to root of model directory
-    os.chdir(os.path.join(config_file.repository_directory, config_file.model_directory_path))
+    # executables are run from the root of model directory
+    model_directory = os.path.join(config_file.repository_directory, config_file.model_directory_path)
     
     # run distribution executables
     # ragmet
@@ -1199,31 +1279,28 @@ def calculate_distributed_data(config_file, snow, moist):
         cmd = [os.path.join(config_file.repository_directory,
                             config_file.bin_directory,
                             config_file.data_distribution_precipitation)]    
-        subprocess.call(cmd,shell=True)
+        run_executable(cmd, model_directory, executable_timeout(config_file), stop_on_error(config_file))
         
     # tmp exe
     if config_file.use_GEMTemps != "True":
       cmd = [os.path.join(config_file.repository_directory,
                           config_file.bin_directory,
                           config_file.data_distribution_temperature)]   
-      subprocess.call(cmd,shell=True)
+      run_executable(cmd, model_directory, executable_timeout(config_file), stop_on_error(config_file))
 	
     # snow exe
     if snow == True:
       cmd = [os.path.join(config_file.repository_directory,
                           config_file.bin_directory,
                           config_file.data_distribution_snow)]   
-      subprocess.call(cmd,shell=True)
+      run_executable(cmd, model_directory, executable_timeout(config_file), stop_on_error(config_file))
 	
     # moist exe
     if moist == True:
       cmd = [os.path.join(config_file.repository_directory,
                           config_file.bin_directory,
                           config_file.data_distribution_moist)]   
-      subprocess.call(cmd,shell=True)
-    
-    # reset directory to initial
-    os.chdir(initial_directory)
+      run_executable(cmd, model_directory, executable_timeout(config_file), stop_on_error(config_file))
          
          
             
@@ -1231,7 +1308,7 @@ def update_model_folders(config_file):
     """
     Move met and tem files from the temporary wxData folder to the radcl and tempr directories within the WATFLOOD folder structure
     After the files have been moved, generate *_diff.r2c (required for modified Hargreaves evaporation (:flgevp2 = 4 in par file) 
-    files from the *_tem.r2c files using a custom Rscript.
+    files from the *_tem.r2c files (see tempdiff module), unless they were written during the forecast conversion.
     
     Args:
         config_file: see class ConfigParse
@@ -1254,19 +1331,18 @@ def update_model_folders(config_file):
     current_file = os.listdir(forecast_tem_directory)[0]
     copytree(forecast_tem_directory,os.path.join(config_file.repository_directory,config_file.model_directory_path,"tempr"))
     
-    #create YYYYMMDD_dif.r2c file from temperature file
-    print "Calculating YYYYMMDD_dif.r2c file \n"
-    cmd = [config_file.rscript_path, os.path.join(config_file.repository_directory, config_file.scripts_directory, config_file.r_script_tempdiff),
-                                    os.path.join(config_file.repository_directory, config_file.scripts_directory),
-                                    os.path.join(config_file.repository_directory,config_file.model_directory_path,"tempr")]
-
-    subprocess.call(cmd,shell=True)
+    #create YYYYMMDD_dif.r2c file from temperature file, unless they were written with the temperature files
+    #(they are then copied with them)
+    if config_file.convert_forecast_dif != "True":
+        print "Calculating YYYYMMDD_dif.r2c file \n"
+        tempdiff.update_directory(os.path.join(config_file.repository_directory,config_file.model_directory_path,"tempr"))
 
     
 
 def execute_watflood(config_file, hydensemble_directory):
     """
-    Execute watflood model, current directory must be model directory.
+    Execute watflood model from the model directory (see run_executable). The current directory isn't changed,
+    so several runs can be executed at the same time from threads.
     
     Args:
         config_file: see class ConfigParse
@@ -1276,11 +1352,99 @@ def execute_watflood(config_file, hydensemble_directory):
         NULL - but executes WATFLOOD
     """
 
-    # must change to root of model directory
-    os.chdir(os.path.join(hydensemble_directory, config_file.model_directory))  
-    
+    # must run from root of model directory
     cmd = [os.path.join(config_file.repository_directory,config_file.bin_directory,config_file.watflood_executable)]
-    subprocess.call(cmd,shell=True)
+    run_executable(cmd, os.path.join(hydensemble_directory, config_file.model_directory), executable_timeout(config_file),
+                   stop_on_error(config_file))
+    
+    
+    
+def executable_timeout(config_file):
+    """
+    Returns the time limit of the executables in seconds (see 'executable_timeout' in class ConfigParse), or None
+    """
+    
+    if config_file.executable_timeout == "False":
+        return None
+    return float(config_file.executable_timeout) * 60
+    
+    
+    
+def stop_on_error(config_file):
+    """
+    Returns whether an executable that exits with an error code stops the framework (see 'stop_on_executable_error'
+    in class ConfigParse)
+    """
+    
+    return config_file.stop_on_executable_error == "True"
+    
+    
+    
+def _disinherit(file_object):
+    """
+    stops a file from being inherited by the executables. On windows, subprocess starts an executable whose output
+    is redirected with every inheritable handle, so the runs started from other threads would hold the file open
+    (and their workspaces couldn't be removed)
+    """
+    
+    if os.name != "nt":
+        return
+    import ctypes
+    import msvcrt
+    HANDLE_FLAG_INHERIT = 1
+    ctypes.windll.kernel32.SetHandleInformation(msvcrt.get_osfhandle(file_object.fileno()), HANDLE_FLAG_INHERIT, 0)
+    
+    
+    
+def run_executable(cmd, working_directory, timeout = None, check = False):
+    """
+    Runs an executable from a working directory, without changing the current directory and without a shell.
+    Its output (stdout and stderr) is written to '<executable name>.log' in the working directory.
+    
+    Args:
+        cmd: list of the executable path and its arguments
+        working_directory: directory the executable is run from (ie. the model directory)
+        timeout: either None, or the number of seconds after which the executable is stopped
+        check: raise a RuntimeError if the executable exits with an error code, otherwise the error is only printed
+               (the framework used to ignore it)
+        
+    Returns:
+        NULL - but raises a RuntimeError if the executable times out, or exits with an error code and check is True
+    """
+    
+    log_path = os.path.join(working_directory, os.path.splitext(os.path.basename(cmd[0]))[0] + ".log")
+    log_file = open(log_path, "w")
+    try:
+        _disinherit(log_file)
+        with _popen_lock:
+            process = subprocess.Popen(cmd, cwd = working_directory, stdout = log_file, stderr = subprocess.STDOUT,
+                                       close_fds = os.name != "nt")
+        
+        #stop the executable if it runs too long
+        timed_out = threading.Event()
+        def stop():
+            timed_out.set()
+            process.kill()
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, stop)
+            timer.daemon = True
+            timer.start()
+        try:
+            returncode = process.wait()
+        finally:
+            if timer is not None:
+                timer.cancel()
+    finally:
+        log_file.close()
+        
+    if timed_out.is_set():
+        raise RuntimeError(cmd[0] + " was stopped after " + str(timeout) + " seconds in " + working_directory + ", see " + log_path)
+    if returncode != 0:
+        message = cmd[0] + " exited with code " + str(returncode) + " in " + working_directory + ", see " + log_path
+        if check:
+            raise RuntimeError(message + ":\n" + open(log_path).read()[-2000:])
+        print "WARNING: " + message
 
     
     
@@ -1447,6 +1611,10 @@ class ConfigParse:
         self.data_distribution_moist = parameter_settings["data_distribution_moist"]
         self.data_state_variable_streamflow = parameter_settings["data_state_variable_streamflow"]
         self.watflood_executable = parameter_settings["watflood_executable"]
+        # optional. minutes an executable (WATFLOOD, ragmet, tmp, ...) can run before it is stopped, "False" for no limit
+        self.executable_timeout = parameter_settings.get("executable_timeout", "False")
+        # optional. "True" to stop the framework when an executable exits with an error code, by default it is only reported
+        self.stop_on_executable_error = parameter_settings.get("stop_on_executable_error", "False")
 
         # location of r scripts
         self.r_script_directory = os.path.join(self.repository_directory,"scripts")
@@ -1497,6 +1665,22 @@ class ConfigParse:
         # start hout for data pull. either 00 or 12. default is 00.
         self.forecast_start_hour = parameter_settings["forecast_start_hour"] 
 
+        # optional. directory for the cached grib to r2c regridding weights, "False" lets pyEnSim do the interpolation
+        self.regrid_cache_directory = parameter_settings.get("regrid_cache_directory", "False")
+
+        # optional. "True" converts the forecast grib files while they are being downloaded
+        self.stream_forecast_conversion = parameter_settings.get("stream_forecast_conversion", "False")
+
+        # optional. directory where converted forecast frames are cached so reruns don't convert them again, "False" turns the cache off
+        self.conversion_cache_directory = parameter_settings.get("conversion_cache_directory", "False")
+        # optional. size limit of the conversion cache in MB, and number of days an unused frame is kept
+        self.conversion_cache_size = parameter_settings.get("conversion_cache_size", "2048")
+        self.conversion_cache_days = parameter_settings.get("conversion_cache_days", "30")
+
+        # optional. "True" writes the forecast *_dif.r2c files while the temperature grib files are converted, instead of
+        # reading the *_tem.r2c files again when they are copied to the model folder
+        self.convert_forecast_dif = parameter_settings.get("convert_forecast_dif", "False")
+
         
         
 
@@ -9,7 +9,7 @@ the script.
 -m 'Type of model run: UpdateConfig,Spinup,DefaultHindcast,Forecast,AcceptAndCopy'
 
 Functions are defined in the custom modules located in same folder (FrameworkLibrary.py,
-met_process.py, post_process.py, pre_process.py, pyEnSim_basics.py)
+met_process.py, post_process.py, pre_process.py, pyEnSim_basics.py, worker_pool.py)
 
 """
 
@@ -32,6 +32,7 @@ import pyEnSim.pyEnSim as pyEnSim
 #import custom modules
 import FrameworkLibrary
 import post_process
+import worker_pool
 
 
 def Run_Framework():
@@ -53,7 +54,16 @@ def Run_Framework():
     os.chdir(config_file.repository_directory)
 
     ## ===== run operational framework
+    #the worker processes are started once and shared by all the stages, they are stopped when the run is done
+    try:
+        Run_Stage(config_file, model_run)
+    except:
+        worker_pool.shutdown(terminate = True)
+        raise
+    worker_pool.shutdown()
 
+
+def Run_Stage(config_file, model_run):
     # if Update Configuration File (specifically the hindcast and forecast dates)
     if model_run == "UpdateConfig":
         print "\n===============Updating Configuration File with Today's dates===================\n"
@@ -0,0 +1,260 @@
+"""
+Cache of converted forecast frames, so a forecast date that is converted again (reruns, tests, retries) is read
+back from disk instead of being decoded, de-accumulated and interpolated again.
+
+Each frame is keyed by the contents of what it is made from: the grib message of the member, the grib message of
+the previous timestep it is de-accumulated with, the r2c template, the unit conversion and the interpolation method.
+The converted grid is stored as float32 in a file named after the key ('<key>.npy'), so a frame converted before is
+found again by any run, whatever the grib and r2c files are called. Entries are removed once they are older than
+a number of days, and the oldest used are removed first to keep the cache under a size limit (see evict()).
+"""
+
+#import standard modules
+import os
+import time
+import hashlib
+import tempfile
+import threading
+import numpy
+
+#import custom modules
+import grib_index
+import download_manager
+
+
+#bump this if the way frames are converted changes, so nothing converted before is used
+CACHE_VERSION = 2
+
+#suffix of each cached frame
+ENTRY_SUFFIX = ".npy"
+
+#default limits of the cache, see evict()
+MAX_BYTES = 2048 * 1024 * 1024
+MAX_AGE_DAYS = 30
+
+#checksums of the grib and template files, by (path, size, modification time), see file_hashes()
+_hashes = {}
+_hashes_lock = threading.Lock()
+MAX_HASHES = 1000
+
+#one cache object per directory per process, see get_cache()
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+
+def file_hashes(path, messages = True):
+    """
+    gets the sha1 checksum of each message of a grib file, or of the whole file if its messages can't be
+    matched to the children pyEnSim loads (see grib_index.one_field_per_message()). The checksums are kept
+    for the rest of the process, until the file changes.
+
+    Args:
+        path: path of a grib or template file
+        messages: whether to look for grib messages, False for a template file
+    Returns:
+        (list of the sha1 hex string of each message, None), or (None, sha1 hex string of the whole file)
+    """
+
+    file_stat = os.stat(path)
+    key = (os.path.abspath(path), file_stat.st_size, file_stat.st_mtime)
+    with _hashes_lock:
+        if key in _hashes:
+            return _hashes[key]
+
+    if messages and grib_index.one_field_per_message(path):
+        hashes = ([], None)
+        grib_file = open(path, "rb")
+        try:
+            for offset, length, fields in grib_index.read_index(path):
+                grib_file.seek(offset)
+                hashes[0].append(hashlib.sha1(grib_file.read(length)).hexdigest())
+        finally:
+            grib_file.close()
+    else:
+        hashes = (None, download_manager.file_checksum(path))
+
+    with _hashes_lock:
+        if len(_hashes) >= MAX_HASHES:
+            _hashes.clear()
+        _hashes[key] = hashes
+    return hashes
+
+
+
+def message_hash(grib_path, child):
+    """
+    sha1 checksum of the grib message that holds a child of a grib file
+    """
+
+    message_hashes, file_hash = file_hashes(grib_path)
+    if message_hashes is not None and child < len(message_hashes):
+        return message_hashes[child]
+    if file_hash is None:
+        file_hash = hashlib.sha1(",".join(message_hashes)).hexdigest()
+    return file_hash + ":" + str(child)
+
+
+
+class ConversionCache(object):
+    """
+    Converted frames cached in a directory, see the module description.
+
+    Args:
+        directory: directory where the frames are stored, it is created if it doesn't exist
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.hits = 0
+        self.misses = 0
+
+
+    def key(self, grib_path, child, template_path, convert_add = False, convert_mult = False, grib_previous = False, method = "pyEnSim"):
+        """
+        gets the key of a converted frame
+
+        Args:
+            grib_path: path of the grib file
+            child: child of the grib file (ensemble member)
+            template_path: path of the r2c template the frame is converted onto
+            convert_add: see pyEnSim_basics.grib_fastappend_r2c()
+            convert_mult: see pyEnSim_basics.grib_fastappend_r2c()
+            grib_previous: path of the grib file the frame is de-accumulated with, or False
+            method: how the frame is put on the template grid; "pyEnSim" or "weights" (see grib_regrid)
+        Returns:
+            sha1 hex string
+        """
+
+        parts = [str(CACHE_VERSION), message_hash(grib_path, child), file_hashes(template_path, messages = False)[1],
+                 repr(convert_add), repr(convert_mult), method]
+        if grib_previous is not False:
+            parts.append(message_hash(grib_previous, child))
+        return hashlib.sha1(",".join(parts)).hexdigest()
+
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[0:2], key + ENTRY_SUFFIX)
+
+
+    def get(self, key):
+        """
+        gets a cached frame, and marks it as used so it is evicted last
+
+        Args:
+            key: see key()
+        Returns:
+            numpy float32 array of the values on the template grid in node order, or None if it isn't cached
+        """
+
+        path = self._path(key)
+        try:
+            values = numpy.load(path)
+            os.utime(path, None)
+        except (IOError, OSError, ValueError): #missing, or removed by another process while reading it
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return values
+
+
+    def put(self, key, values):
+        """
+        adds a converted frame to the cache. Errors writing the frame (ie. a full disk) are ignored,
+        the frame just isn't cached
+
+        Args:
+            key: see key()
+            values: numpy array of the values on the template grid in node order
+        """
+
+        path = self._path(key)
+        try:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+
+            #write to a temporary file first so another process never reads a half written frame
+            fh, tmp_path = tempfile.mkstemp(suffix = ENTRY_SUFFIX, dir = os.path.dirname(path))
+            entry_file = os.fdopen(fh, "wb")
+            try:
+                numpy.save(entry_file, numpy.asarray(values, dtype = numpy.float32))
+            finally:
+                entry_file.close()
+            try:
+                os.rename(tmp_path, path)
+            except OSError: #windows won't rename over an existing file, the frame is already cached
+                os.remove(tmp_path)
+        except (IOError, OSError):
+            pass
+
+
+    def evict(self, max_bytes = MAX_BYTES, max_age_days = MAX_AGE_DAYS):
+        """
+        removes the frames that haven't been used for max_age_days, then the least recently used frames
+        until the cache is no bigger than max_bytes
+
+        Args:
+            max_bytes: size limit of the cache
+            max_age_days: age limit of the frames, in days since they were last used
+        Returns:
+            number of frames removed
+        """
+
+        if not os.path.isdir(self.directory):
+            return 0
+
+        entries = []
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(ENTRY_SUFFIX):
+                    path = os.path.join(root, name)
+                    try:
+                        file_stat = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((file_stat.st_mtime, file_stat.st_size, path))
+
+        #oldest used first
+        entries.sort()
+        oldest = time.time() - max_age_days * 86400.0
+        total = sum([size for mtime, size, path in entries])
+        removed = 0
+        for mtime, size, path in entries:
+            if mtime >= oldest and total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+
+        return removed
+
+
+    def stats(self):
+        """
+        Returns:
+            string with the number of frames read from the cache and converted, in this process
+        """
+
+        return "Conversion cache: %d frames reused, %d converted" % (self.hits, self.misses)
+
+
+
+def get_cache(directory):
+    """
+    gets the conversion cache of a directory. The cache object is shared by every conversion in the process.
+
+    Args:
+        directory: cache directory (ie. config_file.conversion_cache_directory)
+    Returns:
+        ConversionCache
+    """
+
+    key = os.path.normcase(os.path.abspath(directory))
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = ConversionCache(directory)
+        return _caches[key]
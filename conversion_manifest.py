@@ -0,0 +1,186 @@
+"""
+Record of the forecast r2c files that have been converted from grib, so a rerun only converts what is missing or has changed.
+
+For every r2c file in wxData the manifest keeps the frames that have been written to it (frame index and time)
+together with a signature of where each frame came from: the checksums of the grib file, of the previous grib
+file it was de-accumulated with, and of the template, plus the unit conversion and the interpolation method
+(pyEnSim or the regrid weights). When the conversion is run again the frames at the start of each file that are
+still on disk and have the same signature are kept, the file is cut back to the last of them and only the frames
+after it are converted.
+
+The checksums of the grib files are kept in the manifest as well, by path, size and modification time, so
+unchanged files aren't read again to work them out.
+"""
+
+#import standard modules
+import os
+import json
+import hashlib
+import tempfile
+
+#import custom modules
+import r2c_io
+import download_manager
+
+
+#name of the manifest file kept in the wxData folder
+MANIFEST_NAME = "conversion_manifest.json"
+
+#bump this if the way frames are converted changes, so everything is converted again
+MANIFEST_VERSION = 2
+
+
+
+class ConversionManifest(object):
+    """
+    Conversion manifest of a wxData folder, see the module description.
+
+    Args:
+        directory: wxData folder; r2c files are recorded by their path relative to it
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.path = os.path.join(self.directory, MANIFEST_NAME)
+        self.files = {}
+        self.sources = {}
+
+        if os.path.exists(self.path):
+            manifest_file = open(self.path, "r")
+            try:
+                manifest = json.load(manifest_file)
+                if manifest.get("version") == MANIFEST_VERSION:
+                    self.files = manifest.get("files", {})
+                    self.sources = manifest.get("sources", {})
+            except (ValueError, AttributeError): #a corrupt manifest only means everything is converted again
+                pass
+            finally:
+                manifest_file.close()
+
+
+    def _key(self, path):
+        return os.path.relpath(os.path.abspath(path), self.directory).replace("\\", "/")
+
+
+    def checksum(self, path):
+        """
+        gets the checksum of a source file, only reading the file if it has changed since the last time
+
+        Args:
+            path: path of a grib or template file
+        Returns:
+            sha1 checksum, or None if the file doesn't exist
+        """
+
+        if not os.path.isfile(path):
+            return None
+
+        key = os.path.abspath(path)
+        file_stat = os.stat(path)
+        cached = self.sources.get(key)
+        if cached is not None and cached[0] == file_stat.st_size and cached[1] == file_stat.st_mtime:
+            return cached[2]
+
+        checksum = download_manager.file_checksum(path)
+        self.sources[key] = [file_stat.st_size, file_stat.st_mtime, checksum]
+        return checksum
+
+
+    def signature(self, source):
+        """
+        signature of where a frame comes from
+
+        Args:
+            source: (grib path, previous grib path or False, convert_add, convert_mult, template path, method), method
+                    being how the frame is put on the template grid, "pyEnSim" or "weights" (see grib_regrid)
+        Returns:
+            sha1 hex string, or None if one of the files is missing (the frame can't be checked)
+        """
+
+        grib_path, grib_previous, convert_add, convert_mult, template, method = source
+        checksums = [self.checksum(grib_path), self.checksum(template)]
+        if grib_previous is not False:
+            checksums.append(self.checksum(grib_previous))
+        if None in checksums:
+            return None
+
+        signature = hashlib.sha1(str(MANIFEST_VERSION))
+        signature.update(",".join(checksums + [repr(grib_previous is not False), repr(convert_add), repr(convert_mult), method]))
+        return signature.hexdigest()
+
+
+    def valid_frames(self, r2c_path, expected):
+        """
+        counts how many of the expected frames at the start of an r2c file are already in it, from the same source
+
+        Args:
+            r2c_path: path of the r2c file
+            expected: list of (frame index, frame time, source) of the frames the file should have, in order.
+                      source is described in signature()
+        Returns:
+            number of frames at the start of the file that can be kept
+        """
+
+        recorded = self.files.get(self._key(r2c_path), [])
+        if len(recorded) == 0 or not os.path.isfile(r2c_path):
+            return 0
+
+        #the frames have to be in the file too, ie. not lost when a run was stopped before its frames were written out
+        r2c = r2c_io.R2CFile(r2c_path)
+        try:
+            on_disk = [(frame[0], frame[2]) for frame in r2c.frames]
+        finally:
+            r2c.close()
+
+        valid = 0
+        for n, (frame_index, frame_time, source) in enumerate(expected):
+            if n >= len(recorded) or n >= len(on_disk):
+                break
+            recorded_index, recorded_time, recorded_signature = recorded[n]
+            time_string = frame_time.strftime(r2c_io.FRAME_TIME_FORMAT)
+            if recorded_index != frame_index or recorded_time != time_string or on_disk[n] != (frame_index, r2c_io.parse_frame_time(time_string)):
+                break
+            if recorded_signature is None or recorded_signature != self.signature(source):
+                break
+            valid = valid + 1
+
+        return valid
+
+
+    def record(self, r2c_path, frames):
+        """
+        sets the frames that are in an r2c file
+
+        Args:
+            r2c_path: path of the r2c file
+            frames: list of (frame index, frame time, source), see valid_frames()
+        """
+
+        self.files[self._key(r2c_path)] = [[frame_index, frame_time.strftime(r2c_io.FRAME_TIME_FORMAT), self.signature(source)]
+                                           for frame_index, frame_time, source in frames]
+
+
+    def save(self):
+        """
+        writes the manifest to disk (through a temporary file, so a crash never leaves half a manifest)
+        """
+
+        #forget the checksums of grib files that have since been deleted
+        for key in list(self.sources):
+            if not os.path.isfile(key):
+                del self.sources[key]
+
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        fh, tmp_path = tempfile.mkstemp(suffix = ".json", dir = self.directory)
+        manifest_file = os.fdopen(fh, "w")
+        try:
+            json.dump({"version": MANIFEST_VERSION, "files": self.files, "sources": self.sources}, manifest_file, indent = 1, sort_keys = True)
+        finally:
+            manifest_file.close()
+
+        try:
+            os.rename(tmp_path, self.path)
+        except OSError: #windows won't rename over an existing file
+            os.remove(self.path)
+            os.rename(tmp_path, self.path)
@@ -0,0 +1,950 @@
+"""
+In-process http downloader for the grib repositories (EC datamart and NOMADS).
+
+The framework used to download by shelling out to wget, one process per file, after first opening
+each url with urllib2 just to see if it exists; every file cost two requests and two new connections.
+Here a bounded pool of threads downloads the files, each thread keeps one persistent (keep-alive)
+connection per host, and each file is a single GET. A missing remote file is simply a 404.
+
+Files are written to a temporary file next to the target and renamed into place once the whole body
+has been received, so a file that exists in the repository is always complete. With a manifest
+(see DownloadManifest) an interrupted download is resumed rather than started again, and grib files
+that are cut short are rejected before they get to the conversion.
+
+Urls can point at any http(s) host, so the downloads can be tested against a local http server
+standing in for dd.weather.gc.ca or nomads.ncep.noaa.gov.
+"""
+
+#import standard modules
+import os
+import re
+import json
+import time
+import random
+import socket
+import hashlib
+import httplib
+import urlparse
+import tempfile
+import threading
+import collections
+import multiprocessing.pool
+
+#import custom modules
+import grib_index
+
+
+#result of a single download; status is the final http status, or None if the request failed
+#before a response was received (error then holds the reason)
+DownloadResult = collections.namedtuple("DownloadResult", ["url", "path", "status", "error"])
+
+#http status codes that are followed to a new location
+REDIRECT_STATUS = (301, 302, 303, 307, 308)
+
+#http status codes that mean the server is busy or failed, these requests are retried
+RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+
+#http status codes that mean the server wants fewer requests, see ConcurrencyController
+THROTTLE_STATUS = (429, 503)
+
+USER_AGENT = "Ensemble-Framework-Downloader"
+
+#name of the manifest file kept in each repository directory, see DownloadManifest
+MANIFEST_NAME = "download_manifest.json"
+
+#manifests that have been loaded in this process, keyed by directory (see get_manifest)
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+#name of the file kept in a repository directory with what is known of each server directory listing, see ListingCache
+LISTING_NAME = "listing_cache.json"
+
+
+
+def _replace(source, destination):
+    """
+    renames source to destination, replacing destination if it exists (os.rename won't on windows)
+    """
+
+    try:
+        os.rename(source, destination)
+    except OSError:
+        if not os.path.exists(destination):
+            raise
+        os.remove(destination)
+        os.rename(source, destination)
+
+
+
+def _validator(entry):
+    """
+    gets the value used to check that the server's copy of a file hasn't changed (ETag, or Last-Modified)
+    """
+
+    if entry is None:
+        return None
+    return entry.get("etag") or entry.get("last_modified") or None
+
+
+
+def _content_range_start(response):
+    """
+    gets the first byte of a partial (206) response, from its Content-Range header
+    """
+
+    match = re.match(r"bytes\s+(\d+)-", response.getheader("content-range") or "")
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+
+def _response_size(response, offset):
+    """
+    gets the full size of the file being downloaded, or None if the server doesn't say
+    """
+
+    match = re.match(r"bytes\s+\d+-\d+/(\d+)", response.getheader("content-range") or "")
+    if match is not None:
+        return int(match.group(1))
+
+    length = response.getheader("content-length")
+    if length is None:
+        return None
+    return offset + int(length)
+
+
+
+def is_grib_path(path):
+    """
+    whether a local file name is a grib file
+    """
+
+    return os.path.splitext(path)[1].lower() in (".grib", ".grib2", ".grb", ".grb2")
+
+
+
+def grib_length(path):
+    """
+    adds up the lengths of the whole grib messages at the start of a file, using the total length in
+    section 0 of each message (and checking each message ends with '7777'). For a complete grib file
+    this is the file size; a truncated file, or an error page saved as a grib file, comes up short.
+
+    Args:
+        path: local file path
+    Returns:
+        number of bytes of the file that are complete grib messages (0 if it doesn't start with one)
+    """
+
+    return sum([length for offset, length, fields in grib_index.scan_messages(path)])
+
+
+
+class DownloadManifest(object):
+    """
+    Record of the files downloaded into a repository directory, saved as a json file in the directory.
+    For each file it keeps the url, size, ETag and Last-Modified headers, sha1 checksum, the length of its
+    whole grib messages and whether the download finished. This lets a download be resumed or checked
+    against the server, and lets truncated files be told apart from complete ones.
+
+    Use get_manifest() rather than making one of these directly, so all the downloads into a directory
+    share the same manifest.
+
+    Args:
+        directory: repository directory; files are recorded by their path relative to it
+        save_every: number of changes between saves, the manifest is also saved by save()
+    """
+
+    def __init__(self, directory, save_every = 20):
+        self.directory = os.path.abspath(directory)
+        self.path = os.path.join(self.directory, MANIFEST_NAME)
+        self.save_every = save_every
+        self._lock = threading.RLock()
+        self._changes = 0
+        self.entries = {}
+
+        if os.path.exists(self.path):
+            manifest_file = open(self.path, "r")
+            try:
+                self.entries = json.load(manifest_file)
+            except ValueError: #a corrupt manifest only means the files are checked from scratch
+                self.entries = {}
+            finally:
+                manifest_file.close()
+
+        #forget files that have since been deleted
+        for key in list(self.entries):
+            local_path = os.path.join(self.directory, key)
+            if not os.path.exists(local_path) and not os.path.exists(local_path + ".part"):
+                del self.entries[key]
+
+
+    def _key(self, path):
+        return os.path.relpath(os.path.abspath(path), self.directory).replace("\\", "/")
+
+
+    def get(self, path):
+        """
+        gets a copy of the manifest entry of a local file, or None if it isn't in the manifest
+        """
+
+        with self._lock:
+            entry = self.entries.get(self._key(path))
+            return dict(entry) if entry is not None else None
+
+
+    def set(self, path, entry):
+        """
+        sets the manifest entry of a local file
+        """
+
+        with self._lock:
+            self.entries[self._key(path)] = dict(entry)
+            self._changed()
+
+
+    def remove(self, path):
+        """
+        removes a local file from the manifest
+        """
+
+        with self._lock:
+            if self.entries.pop(self._key(path), None) is not None:
+                self._changed()
+
+
+    def _changed(self):
+        self._changes += 1
+        if self._changes >= self.save_every:
+            self.save()
+
+
+    def is_complete(self, path, verify_checksum = False):
+        """
+        checks that a local file has been completely downloaded. A file that isn't in the manifest (ie. downloaded
+        before the manifest existed) is accepted if it exists and, for grib files, ends with a whole message.
+
+        Args:
+            path: local file path
+            verify_checksum: also check the file's sha1 against the manifest, this reads the whole file
+        Returns:
+            True if the file is complete
+        """
+
+        if not os.path.isfile(path):
+            return False
+
+        size = os.path.getsize(path)
+        entry = self.get(path)
+        if entry is not None:
+            if not entry.get("complete") or entry.get("size") != size:
+                return False
+            if is_grib_path(path) and entry.get("grib_length") != size:
+                return False
+            if verify_checksum and entry.get("sha1") is not None:
+                return entry["sha1"] == file_checksum(path)
+            return True
+
+        return not is_grib_path(path) or grib_length(path) == size
+
+
+    def save(self):
+        """
+        writes the manifest to disk (through a temporary file, so a crash never leaves half a manifest)
+        """
+
+        with self._lock:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            fh, tmp_path = tempfile.mkstemp(suffix = ".json", dir = self.directory)
+            manifest_file = os.fdopen(fh, "w")
+            try:
+                json.dump(self.entries, manifest_file, indent = 1, sort_keys = True)
+            finally:
+                manifest_file.close()
+            _replace(tmp_path, self.path)
+            self._changes = 0
+
+
+
+def get_manifest(directory):
+    """
+    gets the download manifest of a repository directory, see DownloadManifest. The manifest is
+    loaded the first time and shared by every download into the directory after that.
+
+    Args:
+        directory: repository directory (ie. config_file.grib_forecast_repo)
+    Returns:
+        DownloadManifest
+    """
+
+    key = os.path.normcase(os.path.abspath(directory))
+    with _manifests_lock:
+        if key not in _manifests:
+            _manifests[key] = DownloadManifest(directory)
+        return _manifests[key]
+
+
+
+class ListingCache(object):
+    """
+    What is known of the server directory listings a repository is downloaded from, saved as a json file in the
+    repository directory. For each listing url it keeps a high-water mark, the last file name (in name order) that
+    is held locally along with every file before it, and the ETag/Last-Modified of the listing. A listing that hasn't
+    changed since the mark was set isn't downloaded again, and otherwise only the part of the listing after the mark
+    is parsed, so each update scales with the number of new files rather than with the server's whole history.
+
+    This relies on the file names sorting in time order, as the datamart's time stamped names do.
+
+    Args:
+        directory: repository directory
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.path = os.path.join(self.directory, LISTING_NAME)
+        self.listings = {}
+
+        if os.path.exists(self.path):
+            listing_file = open(self.path, "r")
+            try:
+                self.listings = json.load(listing_file)
+            except ValueError: #a corrupt cache only means the listings are parsed from scratch
+                self.listings = {}
+            finally:
+                listing_file.close()
+
+
+    def mark(self, url):
+        """
+        gets the high-water mark of a listing, or None if nothing is held locally yet
+        """
+
+        return self.listings.get(url, {}).get("mark")
+
+
+    def new_files(self, manager, url, pattern):
+        """
+        lists the files in a server directory that come after the high-water mark
+
+        Args:
+            manager: DownloadManager used to read the listing
+            url: url of the directory listing
+            pattern: compiled regular expression whose first group is a file name in the listing
+        Returns:
+            sorted list of the file names after the mark
+        """
+
+        entry = self.listings.setdefault(url, {})
+        mark = entry.get("mark")
+
+        #the listing can only be skipped if everything in it up to the last file was held last time
+        headers = {}
+        if mark is not None and mark == entry.get("last"):
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        response = manager.request(url, headers)
+        body = response.read()
+        if response.status == 304:
+            return []
+        if response.status != 200:
+            raise httplib.HTTPException("HTTP " + str(response.status) + " " + str(response.reason) + ": " + url)
+
+        #only parse the listing from the mark on; if the mark is no longer on the server, parse all of it
+        start = 0
+        if mark is not None:
+            start = max(body.find(mark), 0)
+        names = sorted(set([name for name in pattern.findall(body, start) if mark is None or name > mark]))
+
+        entry["etag"] = response.getheader("etag")
+        entry["last_modified"] = response.getheader("last-modified")
+        if len(names) > 0:
+            entry["last"] = names[-1]
+        return names
+
+
+    def set_mark(self, url, name):
+        """
+        moves the high-water mark of a listing forward to name, once name and every file before it are held locally
+        """
+
+        entry = self.listings.setdefault(url, {})
+        if entry.get("mark") is None or name > entry["mark"]:
+            entry["mark"] = name
+
+
+    def advance_mark(self, url, names, failed):
+        """
+        moves the high-water mark of a listing forward through the files downloaded from it, stopping before the
+        first one that failed (so it is listed again next time)
+
+        Args:
+            url: url of the directory listing
+            names: sorted list of the file names that were downloaded, see new_files()
+            failed: set of the urls of the downloads that failed
+        """
+
+        for name in names:
+            if url + name in failed:
+                break
+            self.set_mark(url, name)
+
+
+    def save(self):
+        """
+        writes the listing cache to disk (through a temporary file, so a crash never leaves half a file)
+        """
+
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        fh, tmp_path = tempfile.mkstemp(suffix = ".json", dir = self.directory)
+        listing_file = os.fdopen(fh, "w")
+        try:
+            json.dump(self.listings, listing_file, indent = 1, sort_keys = True)
+        finally:
+            listing_file.close()
+        _replace(tmp_path, self.path)
+
+
+
+def file_checksum(path, chunk_size = 65536):
+    """
+    sha1 checksum of a local file, as stored in the manifest
+    """
+
+    checksum = hashlib.sha1()
+    local_file = open(path, "rb")
+    try:
+        for chunk in iter(lambda: local_file.read(chunk_size), ""):
+            checksum.update(chunk)
+    finally:
+        local_file.close()
+
+    return checksum.hexdigest()
+
+
+
+class ConcurrencyController(object):
+    """
+    Limits the number of simultaneous downloads from one host, and adjusts the limit from how the server
+    responds. After every 'window' downloads the limit is:
+        - halved if any request was throttled (429/503) or more than error_threshold of them failed
+        - increased by one if the time for the server to respond is still close to the best seen, ie. the
+          extra requests aren't queueing up on the server
+        - otherwise left as it is
+    This finds the highest rate the server will sustain without tripping its rate limits.
+
+    Args:
+        initial: number of simultaneous downloads to start with
+        minimum: lowest the limit can go
+        maximum: highest the limit can go (the number of download threads)
+        window: number of downloads between adjustments
+        error_threshold: fraction of failed requests in a window that halves the limit
+        latency_tolerance: the limit is only increased while the average response time in a window is
+            less than latency_tolerance times the best window so far
+    """
+
+    def __init__(self, initial = 4, minimum = 1, maximum = 20, window = 10, error_threshold = 0.1, latency_tolerance = 1.5):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = min(max(initial, self.minimum), self.maximum)
+        self.window = window
+        self.error_threshold = error_threshold
+        self.latency_tolerance = latency_tolerance
+
+        self.active = 0
+        self.best_latency = None
+        self._condition = threading.Condition()
+        self._latencies = []
+        self._errors = 0
+        self._throttled = False
+
+
+    def acquire(self):
+        """
+        waits until another download is allowed to start
+        """
+
+        with self._condition:
+            while self.active >= self.limit:
+                self._condition.wait()
+            self.active += 1
+
+
+    def release(self, latency, failed = False, throttled = False):
+        """
+        records a finished download and adjusts the limit at the end of each window
+
+        Args:
+            latency: seconds until the server responded
+            failed: whether the request failed (no response, or a busy/error status)
+            throttled: whether the server asked for fewer requests (429/503)
+        """
+
+        with self._condition:
+            self.active -= 1
+            self._latencies.append(latency)
+            self._errors += int(failed)
+            self._throttled = self._throttled or throttled
+
+            if len(self._latencies) >= self.window:
+                mean_latency = sum(self._latencies) / len(self._latencies)
+                if self._throttled or self._errors > self.error_threshold * len(self._latencies):
+                    self.limit = max(self.minimum, self.limit // 2)
+                elif self.best_latency is None or mean_latency <= self.latency_tolerance * self.best_latency:
+                    self.limit = min(self.maximum, self.limit + 1)
+
+                if self._errors == 0 and (self.best_latency is None or mean_latency < self.best_latency):
+                    self.best_latency = mean_latency
+                self._latencies = []
+                self._errors = 0
+                self._throttled = False
+
+            self._condition.notify_all()
+
+
+
+class HostStats(object):
+    """
+    Running totals of the downloads from one host, used for the throughput report (see DownloadManager.report())
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.requests = 0
+        self.retries = 0
+        self.errors = 0
+        self.bytes = 0
+        self.first_start = None
+        self.last_end = None
+        self._lock = threading.Lock()
+
+
+    def record(self, start, elapsed, received, failed, retry):
+        with self._lock:
+            self.requests += 1
+            self.retries += int(retry)
+            self.errors += int(failed)
+            self.bytes += received
+            if self.first_start is None or start < self.first_start:
+                self.first_start = start
+            if self.last_end is None or start + elapsed > self.last_end:
+                self.last_end = start + elapsed
+
+
+    def throughput(self):
+        """
+        average download rate in bytes per second, over the time this host was being downloaded from
+        """
+
+        if self.first_start is None or self.last_end <= self.first_start:
+            return 0.0
+        return self.bytes / (self.last_end - self.first_start)
+
+
+
+class DownloadManager(object):
+    """
+    Downloads files over http(s) from a pool of threads, reusing one connection per host per thread.
+
+    Args:
+        threads: maximum number of simultaneous downloads (from each host)
+        initial_threads: number of simultaneous downloads from each host to start with, this is adjusted
+            between 1 and threads as the downloads go (see ConcurrencyController)
+        retries: number of times a failed request is tried again
+        backoff: seconds to wait before the first retry, this doubles with each retry (with random jitter)
+        max_backoff: longest wait between retries, in seconds
+        timeout: socket timeout in seconds for each connection
+        chunk_size: number of bytes read from the response at a time
+        max_redirects: number of redirects followed before giving up on a url
+        manifest: optional DownloadManifest of the directory the files are saved in, which makes the
+            downloads resumable (see download())
+
+    Example:
+        manager = DownloadManager(threads = 20)
+        for result in manager.download_all([(url, path), ...]):
+            if result.status != 200:
+                print result.url, result.status, result.error
+        manager.close()
+    """
+
+    def __init__(self, threads = 20, initial_threads = 4, retries = 4, backoff = 2.0, max_backoff = 60.0,
+                 timeout = 60, chunk_size = 65536, max_redirects = 5, manifest = None):
+        self.threads = threads
+        self.initial_threads = initial_threads
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.max_redirects = max_redirects
+        self.manifest = manifest
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._controllers = {}
+        self._stats = {}
+
+
+    def _controller(self, host):
+        """
+        gets the concurrency controller of a host
+        """
+
+        with self._lock:
+            if host not in self._controllers:
+                self._controllers[host] = ConcurrencyController(initial = self.initial_threads, maximum = self.threads)
+            return self._controllers[host]
+
+
+    def _host_stats(self, host):
+        """
+        gets the download totals of a host
+        """
+
+        with self._lock:
+            if host not in self._stats:
+                self._stats[host] = HostStats(host)
+            return self._stats[host]
+
+
+    def report(self):
+        """
+        summary of the downloads from each host: files, data, throughput, retries, errors and
+        the number of simultaneous downloads the host settled on
+
+        Returns:
+            list of strings, one per host
+        """
+
+        lines = []
+        for host in sorted(self._stats):
+            stats = self._stats[host]
+            lines.append(host + ": " + str(stats.requests - stats.retries) + " files, " +
+                         "%.1f MB at %.2f MB/s, " % (stats.bytes / 1e6, stats.throughput() / 1e6) +
+                         str(stats.retries) + " retries, " + str(stats.errors) + " failed requests, " +
+                         str(self._controllers[host].limit) + " simultaneous downloads")
+        return lines
+
+
+    def _connection(self, scheme, netloc):
+        """
+        gets this thread's connection to a host, making a new one if there isn't one. Also returns
+        whether the connection has been used before.
+        """
+
+        connections = getattr(self._local, "connections", None)
+        if connections is None:
+            connections = self._local.connections = {}
+
+        key = (scheme, netloc)
+        reused = key in connections
+        if not reused:
+            if scheme == "https":
+                connection = httplib.HTTPSConnection(netloc, timeout = self.timeout)
+            elif scheme == "http":
+                connection = httplib.HTTPConnection(netloc, timeout = self.timeout)
+            else:
+                raise ValueError("Only http and https urls can be downloaded: " + scheme + "://" + netloc)
+            connections[key] = connection
+            with self._lock:
+                self._connections.append(connection)
+
+        return connections[key], reused
+
+
+    def _drop_connection(self, scheme, netloc):
+        """
+        closes and forgets this thread's connection to a host (ie. after the server closed it)
+        """
+
+        connection = getattr(self._local, "connections", {}).pop((scheme, netloc), None)
+        if connection is not None:
+            connection.close()
+            with self._lock:
+                if connection in self._connections:
+                    self._connections.remove(connection)
+
+
+    def request(self, url, headers = None):
+        """
+        sends a GET request and returns the response, following redirects. The body must be read
+        (or the response closed) before the next request is made from the same thread.
+
+        Args:
+            url: url to request
+            headers: optional dictionary of extra request headers
+        Returns:
+            httplib.HTTPResponse
+        """
+
+        for redirect in range(self.max_redirects + 1):
+            parts = urlparse.urlsplit(url)
+            path = urlparse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+            request_headers = {"User-Agent": USER_AGENT}
+            request_headers.update(headers or {})
+
+            #a kept-alive connection may have been closed by the server since it was last used,
+            #in which case the request is sent once more on a new connection
+            for attempt in range(2):
+                connection, reused = self._connection(parts.scheme, parts.netloc)
+                try:
+                    connection.request("GET", path, headers = request_headers)
+                    response = connection.getresponse()
+                    break
+                except (httplib.HTTPException, socket.error):
+                    self._drop_connection(parts.scheme, parts.netloc)
+                    if not reused or attempt == 1:
+                        raise
+
+            if response.status not in REDIRECT_STATUS:
+                return response
+
+            location = response.getheader("location")
+            response.read()
+            if location is None:
+                return response
+            url = urlparse.urljoin(url, location)
+
+        raise httplib.HTTPException("Too many redirects: " + url)
+
+
+    def read(self, url):
+        """
+        downloads a url into memory (ie. a directory listing)
+
+        Args:
+            url: url to read
+        Returns:
+            the body of the response as a string
+        Raises:
+            httplib.HTTPException if the server doesn't return the page
+        """
+
+        response = self.request(url)
+        body = response.read()
+        if response.status != 200:
+            raise httplib.HTTPException("HTTP " + str(response.status) + " " + str(response.reason) + ": " + url)
+        return body
+
+
+    def download(self, url, path):
+        """
+        downloads a single url to a local file. Nothing is written to path unless the whole file is received.
+
+        If the manager has a manifest (see DownloadManifest) the download is resumable: the data is written to
+        path + ".part", and if that is interrupted the next download of the same url asks the server only for
+        the missing bytes (an http Range request, with If-Range so a changed file is downloaded from the start).
+        Files that are already complete (see DownloadManifest.is_complete()) are skipped by the callers rather
+        than downloaded again. Grib files that don't end with a complete message are rejected.
+
+        Args:
+            url: url to download
+            path: local file path to save to; the directory must exist
+        Failed requests (no response, or a busy/overloaded server) are retried after a randomised, exponentially
+        increasing delay, and each host's number of simultaneous downloads is adjusted as the downloads go (see
+        ConcurrencyController).
+
+        Returns:
+            DownloadResult
+        """
+
+        host = urlparse.urlsplit(url).netloc
+        controller = self._controller(host)
+        stats = self._host_stats(host)
+
+        for attempt in range(self.retries + 1):
+            measure = {"latency": None, "bytes": 0, "retry_after": None}
+            result = None
+            controller.acquire()
+            start = time.time()
+            try:
+                result = self._download_once(url, path, measure)
+            finally:
+                elapsed = time.time() - start
+                failed = result is None or result.status is None or result.status in RETRY_STATUS
+                controller.release(measure["latency"] or elapsed, failed, result is not None and result.status in THROTTLE_STATUS)
+
+            stats.record(start, elapsed, measure["bytes"], failed, attempt > 0)
+            if not failed or attempt == self.retries:
+                return result
+
+            time.sleep(self._backoff(attempt, measure["retry_after"]))
+
+        return result
+
+
+    def _backoff(self, attempt, retry_after = None):
+        """
+        time to wait before retrying: a random time up to backoff * 2^attempt ("full jitter", so the threads
+        that failed together don't all retry together), or the server's Retry-After if that is longer
+        """
+
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        if retry_after is not None and retry_after.strip().isdigit():
+            delay = max(delay, min(self.max_backoff, int(retry_after)))
+        return delay
+
+
+    def _download_once(self, url, path, measure):
+        """
+        a single attempt at download(), without retries. The time until the response arrived, the bytes received
+        and any Retry-After header are put in the measure dictionary.
+        """
+
+
+        manifest = self.manifest
+        entry = None
+        headers = {}
+        offset = 0
+
+        if manifest is None:
+            directory, filename = os.path.split(os.path.abspath(path))
+            fh, part_path = tempfile.mkstemp(prefix = filename + ".", suffix = ".part", dir = directory)
+            os.close(fh)
+        else:
+            part_path = path + ".part"
+            entry = manifest.get(path)
+            if entry is not None and entry.get("url") == url and _validator(entry) is not None:
+                if not entry.get("complete") and os.path.exists(part_path):
+                    offset = os.path.getsize(part_path)
+                    headers["Range"] = "bytes=" + str(offset) + "-"
+                    headers["If-Range"] = _validator(entry)
+
+        start = time.time()
+        try:
+            response = self.request(url, headers)
+            measure["latency"] = time.time() - start
+        except (httplib.HTTPException, socket.error) as e:
+            self._discard_part(part_path, manifest is None)
+            return DownloadResult(url, path, None, str(e))
+
+        if offset > 0 and (response.status == 416 or (response.status == 206 and _content_range_start(response) != offset)):
+            #the partial file is no use to the server, start again from the beginning
+            response.read()
+            self._discard_part(part_path, True)
+            manifest.remove(path)
+            return self._download_once(url, path, measure)
+
+        if response.status not in (200, 206) or (response.status == 206 and _content_range_start(response) != offset):
+            measure["retry_after"] = response.getheader("retry-after")
+            response.read()
+            self._discard_part(part_path, manifest is None)
+            return DownloadResult(url, path, response.status, response.reason)
+
+        if response.status == 200:
+            offset = 0
+        size = _response_size(response, offset)
+        checksum = hashlib.sha1()
+
+        if manifest is not None:
+            #record where the partial file came from, so it can be resumed if the download is interrupted
+            entry = {"url": url, "etag": response.getheader("etag"), "last_modified": response.getheader("last-modified"),
+                     "size": size, "complete": False}
+            manifest.set(path, entry)
+
+        try:
+            if offset > 0:
+                part_file = open(part_path, "rb")
+                try:
+                    for chunk in iter(lambda: part_file.read(self.chunk_size), ""):
+                        checksum.update(chunk)
+                finally:
+                    part_file.close()
+
+            part_file = open(part_path, "ab" if offset > 0 else "wb")
+            try:
+                while True:
+                    chunk = response.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    checksum.update(chunk)
+                    part_file.write(chunk)
+                    measure["bytes"] += len(chunk)
+            finally:
+                part_file.close()
+
+            #the server closed the connection before sending everything it said it would
+            if size is not None and os.path.getsize(part_path) != size:
+                raise httplib.IncompleteRead("", size - os.path.getsize(part_path))
+        except (httplib.HTTPException, socket.error, IOError, OSError) as e:
+            parts = urlparse.urlsplit(url)
+            self._drop_connection(parts.scheme, parts.netloc)
+            self._discard_part(part_path, manifest is None or _validator(entry) is None)
+            if manifest is not None:
+                manifest.save()
+            return DownloadResult(url, path, None, str(e) or e.__class__.__name__)
+
+        #a grib file that doesn't end with a whole message was cut short by the server
+        complete_length = grib_length(part_path)
+        part_size = os.path.getsize(part_path)
+        if is_grib_path(path) and complete_length != part_size:
+            self._discard_part(part_path, True)
+            if manifest is not None:
+                manifest.remove(path)
+            return DownloadResult(url, path, None, "Incomplete grib file, only " + str(complete_length) + " of " + str(part_size) + " bytes are whole messages")
+
+        _replace(part_path, path)
+        if manifest is not None:
+            entry.update({"size": part_size, "sha1": checksum.hexdigest(), "grib_length": complete_length, "complete": True})
+            manifest.set(path, entry)
+
+        return DownloadResult(url, path, response.status, None)
+
+
+    def _discard_part(self, part_path, remove):
+        """
+        removes a partial download, unless it is being kept to be resumed
+        """
+
+        if remove and os.path.exists(part_path):
+            os.remove(part_path)
+
+
+    def download_all(self, download_list):
+        """
+        downloads a list of files on the thread pool. Results are yielded as each download finishes,
+        which is not necessarily the order of download_list.
+
+        Args:
+            download_list: list of (url, local file path)
+        Returns:
+            generator of DownloadResult, one per download
+        """
+
+        if len(download_list) == 0:
+            return
+
+        pool = multiprocessing.pool.ThreadPool(processes = max(1, min(self.threads, len(download_list))))
+        try:
+            for result in pool.imap_unordered(self._download_pair, download_list):
+                yield result
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+
+    def _download_pair(self, download):
+        return self.download(download[0], download[1])
+
+
+    def close(self):
+        """
+        closes all the open connections, and saves the manifest
+        """
+
+        if self.manifest is not None:
+            self.manifest.save()
+
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+        self._local = threading.local()
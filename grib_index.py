@@ -0,0 +1,206 @@
+"""
+Index of the messages in a grib file, for reading single ensemble members without loading the whole file.
+
+The EC datamart ensemble files hold every member as a separate grib2 message (each message is one
+'child' once pyEnSim has loaded the file). pyEnSim can only load a whole file, so to convert fewer members
+than the file holds, the messages of the requested members are copied into a small grib file and that
+is loaded instead. The byte offset and length of every message come from a scan of the section headers,
+which only reads a few bytes per section; the result is saved next to the grib file (<grib file>.idx) so
+each file is only scanned once.
+"""
+
+#import standard modules
+import os
+import json
+import struct
+import tempfile
+
+
+#bump this if the index format changes, so old index files are scanned again
+INDEX_VERSION = 1
+
+#suffix of the index file saved next to each grib file
+INDEX_SUFFIX = ".idx"
+
+
+
+def scan_messages(grib_path):
+    """
+    scans the whole grib messages at the start of a file, using the total length in section 0 of each
+    message (and checking each message ends with '7777'). The scan stops at the first message that
+    isn't complete, so for a truncated file the messages cover less than the file size.
+
+    Args:
+        grib_path: path of a grib file (edition 1 or 2)
+    Returns:
+        list of (offset, length, fields) for each message; fields is the number of data fields (section 7s)
+        in a grib2 message, or 1 for grib1
+    """
+
+    size = os.path.getsize(grib_path)
+    messages = []
+    offset = 0
+    grib_file = open(grib_path, "rb")
+    try:
+        while offset < size:
+            grib_file.seek(offset)
+            section0 = grib_file.read(16)
+            if len(section0) < 8 or section0[0:4] != "GRIB":
+                break
+
+            edition = ord(section0[7])
+            if edition == 2 and len(section0) == 16:
+                length = struct.unpack(">Q", section0[8:16])[0]
+            elif edition == 1:
+                length = struct.unpack(">I", "\x00" + section0[4:7])[0]
+            else:
+                break
+
+            if length < 16 or offset + length > size:
+                break
+            grib_file.seek(offset + length - 4)
+            if grib_file.read(4) != "7777":
+                break
+
+            fields = 1
+            if edition == 2:
+                fields = _count_fields(grib_file, offset, length)
+                if fields is None:
+                    break
+
+            messages.append((offset, length, fields))
+            offset += length
+    finally:
+        grib_file.close()
+
+    return messages
+
+
+
+def _count_fields(grib_file, offset, length):
+    """
+    counts the data sections (section 7) of a grib2 message by walking its section headers.
+    Returns None if the sections don't add up to the message length
+    """
+
+    position = offset + 16
+    end = offset + length - 4
+    fields = 0
+    while position < end:
+        grib_file.seek(position)
+        header = grib_file.read(5)
+        if len(header) < 5:
+            return None
+        section_length, number = struct.unpack(">IB", header)
+        if section_length < 5:
+            return None
+        if number == 7:
+            fields += 1
+        position += section_length
+
+    if position != end:
+        return None
+    return fields
+
+
+
+def index_path(grib_path):
+    """
+    path of the index file of a grib file
+    """
+
+    return grib_path + INDEX_SUFFIX
+
+
+
+def read_index(grib_path):
+    """
+    gets the message index of a grib file, from the index file next to it if that is up to date,
+    otherwise the file is scanned and the index file is (re)written. If the index file can't be
+    written (ie. a read only repository) the scan is still returned.
+
+    Args:
+        grib_path: path of a grib file
+    Returns:
+        list of (offset, length, fields), see scan_messages()
+    """
+
+    file_stat = os.stat(grib_path)
+    path = index_path(grib_path)
+
+    if os.path.exists(path):
+        try:
+            index_file = open(path, "r")
+            try:
+                index = json.load(index_file)
+            finally:
+                index_file.close()
+            if index.get("version") == INDEX_VERSION and index.get("size") == file_stat.st_size and index.get("mtime") == file_stat.st_mtime:
+                return [tuple(message) for message in index["messages"]]
+        except (IOError, ValueError, AttributeError):
+            pass
+
+    messages = scan_messages(grib_path)
+
+    #write to a temporary file first so another process never reads a half written index
+    try:
+        fh, tmp_path = tempfile.mkstemp(suffix = INDEX_SUFFIX, dir = os.path.dirname(os.path.abspath(grib_path)))
+        index_file = os.fdopen(fh, "w")
+        try:
+            json.dump({"version": INDEX_VERSION, "size": file_stat.st_size, "mtime": file_stat.st_mtime, "messages": messages}, index_file)
+        finally:
+            index_file.close()
+        try:
+            os.rename(tmp_path, path)
+        except OSError: #windows won't rename over an existing file
+            os.remove(path)
+            os.rename(tmp_path, path)
+    except (IOError, OSError):
+        pass
+
+    return messages
+
+
+
+def one_field_per_message(grib_path):
+    """
+    whether every message of a grib file holds a single field, in which case message n is pyEnSim's child n
+    and single children can be read on their own
+    """
+
+    messages = read_index(grib_path)
+    return len(messages) > 0 and all([fields == 1 for offset, length, fields in messages])
+
+
+
+def extract_messages(grib_path, message_numbers, target_path = None):
+    """
+    copies some of the messages of a grib file into a new grib file
+
+    Args:
+        grib_path: path of a grib file
+        message_numbers: list of the messages to copy (0 based), in the order they are written
+        target_path: file to write, or None for a new temporary file (the caller must delete it)
+    Returns:
+        path of the new grib file
+    """
+
+    messages = read_index(grib_path)
+
+    if target_path is None:
+        fh, target_path = tempfile.mkstemp(suffix = os.path.splitext(grib_path)[1] or ".grib2")
+        target_file = os.fdopen(fh, "wb")
+    else:
+        target_file = open(target_path, "wb")
+
+    grib_file = open(grib_path, "rb")
+    try:
+        for n in message_numbers:
+            offset, length, fields = messages[n]
+            grib_file.seek(offset)
+            target_file.write(grib_file.read(length))
+    finally:
+        grib_file.close()
+        target_file.close()
+
+    return target_path
@@ -0,0 +1,473 @@
+"""
+Module to regrid grib2 fields onto the r2c template grid with a cached sparse weight matrix.
+
+pyEnSim works out the projection and interpolation from scratch every time a grib raster is
+converted (ConvertToCoordinateSystem + MapObjectDispatch), even though each source (datamart
+regional/global, NOMADS, CaPA, GEMTemps) always uses the same grid. This module builds the
+bilinear interpolation from the grib grid to the template grid once, stores it on disk as a
+sparse matrix, and every frame after that is a single sparse matrix-vector product.
+
+Only the grib2 grid definition (section 3) and the r2c header are read here, the data values
+still come from pyEnSim (see pyEnSim_basics.raster_to_array).
+
+The grid definition is also used to crop the continental fields to the points around the template
+(see get_crop()), so only those points are decoded and converted, whichever way the interpolation is done.
+"""
+
+#import standard modules
+import os
+import struct
+import hashlib
+import math
+import tempfile
+
+#import scientific modules
+import numpy
+import scipy.sparse
+
+#import custom modules
+import r2c_io
+
+
+#bump this if the way the weights are calculated changes, so old cache files are not reused
+WEIGHTS_VERSION = "1"
+
+#weights that have already been loaded/built in this process, keyed by the cache file name
+_weights_cache = {}
+
+#number of grib points kept around the template extent when cropping, so the interpolation near the
+#edges of the template still has all the points it uses
+CROP_HALO = 2
+
+#crops that have already been worked out in this process, see get_crop()
+_crops = {}
+_cropped_weights = {}
+
+
+
+def _signed(value, bits):
+    """
+    grib2 stores signed integers as sign and magnitude (the first bit is the sign)
+
+    Args:
+        value: unsigned integer read from the file
+        bits: number of bits in the value
+    Returns:
+        signed integer
+    """
+
+    if value & (1 << (bits - 1)):
+        return -(value & ((1 << (bits - 1)) - 1))
+    return value
+
+
+
+def read_grid_section(grib_path):
+    """
+    reads the raw grid definition section (section 3) of the first message in a grib2 file
+
+    Args:
+        grib_path: path of a grib2 file
+    Returns:
+        string of bytes containing the whole of section 3
+    """
+
+    grib_file = open(grib_path, 'rb')
+    try:
+        section0 = grib_file.read(16)
+        if len(section0) < 16 or section0[0:4] != 'GRIB' or ord(section0[7]) != 2:
+            raise ValueError(grib_path + " is not a grib2 file")
+
+        #walk through the sections until the grid definition is found
+        while True:
+            header = grib_file.read(5)
+            if len(header) < 5 or header[0:4] == '7777':
+                raise ValueError("No grid definition section found in " + grib_path)
+
+            length, number = struct.unpack('>IB', header)
+            if number == 3:
+                return header + grib_file.read(length - 5)
+            grib_file.seek(length - 5, 1)
+    finally:
+        grib_file.close()
+
+
+
+def parse_grid_section(section):
+    """
+    parses a grib2 grid definition section. Only regular lat/lon (template 3.0) and
+    polar stereographic (template 3.20) grids are supported, which covers the datamart,
+    NOMADS, CaPA and GEMTemps grids.
+
+    Args:
+        section: raw section 3 bytes, see read_grid_section()
+    Returns:
+        dictionary describing the grid (template, ni, nj, scanning_mode, earth_radius and projection parameters)
+    """
+
+    def u1(octet):
+        return ord(section[octet - 1])
+
+    def u4(octet):
+        return struct.unpack('>I', section[octet - 1:octet + 3])[0]
+
+    def s4(octet):
+        return _signed(u4(octet), 32)
+
+    template = struct.unpack('>H', section[12:14])[0]
+
+    #shape of the earth, only the spherical definitions are used by the grids we download
+    shape = u1(15)
+    if shape == 0:
+        earth_radius = 6367470.0
+    elif shape == 1:
+        earth_radius = u4(17) / float(10 ** u1(16))
+    elif shape == 6:
+        earth_radius = 6371229.0
+    else:
+        raise ValueError("Unsupported grib2 shape of the earth: " + str(shape))
+
+    grid = {"template": template, "earth_radius": earth_radius}
+
+    if template == 0:
+        #regular lat/lon, angles are in micro-degrees unless a basic angle is given
+        basic_angle = u4(39)
+        subdivisions = u4(43)
+        if basic_angle in (0, 0xFFFFFFFF):
+            unit = 1e-6
+        else:
+            unit = basic_angle / float(subdivisions)
+
+        grid["ni"] = u4(31)
+        grid["nj"] = u4(35)
+        grid["la1"] = s4(47) * unit
+        grid["lo1"] = s4(51) * unit
+        grid["di"] = u4(64) * unit
+        grid["dj"] = u4(68) * unit
+        grid["scanning_mode"] = u1(72)
+
+    elif template == 20:
+        #polar stereographic, distances are in millimetres
+        grid["ni"] = u4(31)
+        grid["nj"] = u4(35)
+        grid["la1"] = s4(39) * 1e-6
+        grid["lo1"] = s4(43) * 1e-6
+        grid["lad"] = s4(48) * 1e-6
+        grid["lov"] = s4(52) * 1e-6
+        grid["di"] = u4(56) * 1e-3
+        grid["dj"] = u4(60) * 1e-3
+        grid["south_pole"] = bool(u1(64) & 0x80)
+        grid["scanning_mode"] = u1(65)
+
+    else:
+        raise ValueError("Unsupported grib2 grid definition template: 3." + str(template))
+
+    if grid["scanning_mode"] & 0x10:
+        raise ValueError("Boustrophedonic grib2 grids are not supported")
+
+    return grid
+
+
+
+def read_r2c_grid(r2c_path):
+    """
+    reads the grid attributes from the header of an ascii r2c file
+
+    Args:
+        r2c_path: path to an r2c file, typically the template (ie. EmptyGridLL.r2c)
+    Returns:
+        dictionary with projection, xorigin, yorigin, xcount, ycount, xdelta, ydelta
+    """
+
+    attributes = r2c_io.read_header(r2c_path)[1]
+    grid = dict([(key, attributes.get(key, "")) for key in ["projection", "xorigin", "yorigin", "xcount", "ycount", "xdelta", "ydelta"]])
+
+    if grid.get("projection", "").upper() != "LATLONG":
+        raise ValueError("Only LATLONG r2c templates can be regridded to: " + r2c_path)
+
+    for key in ["xorigin", "yorigin", "xdelta", "ydelta"]:
+        grid[key] = float(grid[key])
+    for key in ["xcount", "ycount"]:
+        grid[key] = int(grid[key])
+
+    return grid
+
+
+
+def _stereographic_xy(lat, lon, grid):
+    """
+    projects latitudes and longitudes (degrees) onto the polar stereographic plane of a grib grid
+    """
+
+    sign = -1.0 if grid["south_pole"] else 1.0
+    lat = numpy.radians(lat) * sign
+    dlon = numpy.radians(lon - grid["lov"])
+    lad = math.radians(grid["lad"]) * sign
+
+    rho = grid["earth_radius"] * (1.0 + math.sin(lad)) * numpy.cos(lat) / (1.0 + numpy.sin(lat))
+
+    return rho * numpy.sin(dlon), -sign * rho * numpy.cos(dlon)
+
+
+
+def grid_indices(grid, lat, lon):
+    """
+    finds the (fractional) position of each lat/lon point on a grib grid
+
+    Args:
+        grid: grib grid dictionary, see parse_grid_section()
+        lat: numpy array of latitudes (degrees)
+        lon: numpy array of longitudes (degrees)
+    Returns:
+        fi, fj: numpy arrays with the fractional i (along a row) and j (along a column) index of each point
+    """
+
+    scanning_mode = grid["scanning_mode"]
+    i_sign = -1.0 if scanning_mode & 0x80 else 1.0
+    j_sign = 1.0 if scanning_mode & 0x40 else -1.0
+
+    if grid["template"] == 0:
+        fi = numpy.mod(i_sign * (lon - grid["lo1"]), 360.0) / grid["di"]
+        fj = j_sign * (lat - grid["la1"]) / grid["dj"]
+    else:
+        x1, y1 = _stereographic_xy(numpy.array([grid["la1"]]), numpy.array([grid["lo1"]]), grid)
+        x, y = _stereographic_xy(lat, lon, grid)
+        fi = i_sign * (x - x1[0]) / grid["di"]
+        fj = j_sign * (y - y1[0]) / grid["dj"]
+
+    return fi, fj
+
+
+
+def r2c_cell_centres(r2c_grid):
+    """
+    gets the lat/lon of every cell centre of an r2c grid, in node order (rows from yOrigin upwards,
+    west to east along each row, which is the order the frames are written in the r2c file)
+
+    Args:
+        r2c_grid: dictionary, see read_r2c_grid()
+    Returns:
+        lat, lon: flat numpy arrays of length xcount*ycount
+    """
+
+    x = r2c_grid["xorigin"] + (numpy.arange(r2c_grid["xcount"]) + 0.5) * r2c_grid["xdelta"]
+    y = r2c_grid["yorigin"] + (numpy.arange(r2c_grid["ycount"]) + 0.5) * r2c_grid["ydelta"]
+    lon, lat = numpy.meshgrid(x, y)
+
+    return lat.ravel(), lon.ravel()
+
+
+
+def build_weights(grid, r2c_grid):
+    """
+    builds the bilinear interpolation weights from a grib grid to an r2c grid. Points outside
+    the grib grid take the value of the nearest edge.
+
+    Args:
+        grid: grib grid dictionary, see parse_grid_section()
+        r2c_grid: r2c grid dictionary, see read_r2c_grid()
+    Returns:
+        scipy.sparse.csr_matrix of shape (number of r2c cells, number of grib points)
+    """
+
+    ni = grid["ni"]
+    nj = grid["nj"]
+
+    lat, lon = r2c_cell_centres(r2c_grid)
+    fi, fj = grid_indices(grid, lat, lon)
+
+    fi = numpy.clip(fi, 0, ni - 1)
+    fj = numpy.clip(fj, 0, nj - 1)
+    i0 = numpy.minimum(numpy.floor(fi).astype(numpy.int64), max(ni - 2, 0))
+    j0 = numpy.minimum(numpy.floor(fj).astype(numpy.int64), max(nj - 2, 0))
+    di = fi - i0
+    dj = fj - j0
+    i1 = numpy.minimum(i0 + 1, ni - 1)
+    j1 = numpy.minimum(j0 + 1, nj - 1)
+
+    #grib points are stored row by row, unless adjacent points in j are consecutive
+    if grid["scanning_mode"] & 0x20:
+        index = lambda i, j: i * nj + j
+    else:
+        index = lambda i, j: j * ni + i
+
+    rows = numpy.tile(numpy.arange(len(lat)), 4)
+    cols = numpy.concatenate([index(i0, j0), index(i1, j0), index(i0, j1), index(i1, j1)])
+    weights = numpy.concatenate([(1 - di) * (1 - dj), di * (1 - dj), (1 - di) * dj, di * dj])
+
+    #duplicate entries (ie. on the last row/column) are summed by the conversion to csr
+    return scipy.sparse.coo_matrix((weights, (rows, cols)), shape = (len(lat), ni * nj)).tocsr()
+
+
+
+def weights_key(grid_section, r2c_grid):
+    """
+    unique key for a grib grid definition and r2c template pair, used for the cache file name
+    """
+
+    template_description = ",".join([str(r2c_grid[k]) for k in sorted(r2c_grid)])
+    key = hashlib.sha1(WEIGHTS_VERSION)
+    key.update(grid_section)
+    key.update(template_description)
+
+    return key.hexdigest()[0:20]
+
+
+
+def get_weights(grib_path, r2c_template_path, cache_directory):
+    """
+    gets the regridding weights from the grid of a grib file to an r2c template. The weights are
+    built the first time a (grib grid, template) pair is seen and saved in cache_directory; after that
+    they are loaded from disk, and kept in memory for the rest of the process.
+
+    Args:
+        grib_path: path to any grib2 file on the source grid
+        r2c_template_path: path to the r2c template (ie. EmptyGridLL.r2c, TEMPLATE_met.r2c)
+        cache_directory: directory where the weights are stored, it is created if it doesn't exist
+    Returns:
+        scipy.sparse.csr_matrix; target = weights.dot(grib values)
+    """
+
+    grid_section = read_grid_section(grib_path)
+    r2c_grid = read_r2c_grid(r2c_template_path)
+    cache_name = "regrid_" + weights_key(grid_section, r2c_grid) + ".npz"
+
+    if cache_name in _weights_cache:
+        return _weights_cache[cache_name]
+
+    cache_path = os.path.join(cache_directory, cache_name)
+    if os.path.exists(cache_path):
+        weights = scipy.sparse.load_npz(cache_path)
+    else:
+        weights = build_weights(parse_grid_section(grid_section), r2c_grid)
+
+        #write to a temporary file first so another process never reads a half written file
+        if not os.path.exists(cache_directory):
+            os.makedirs(cache_directory)
+        fh, tmp_path = tempfile.mkstemp(suffix = ".npz", dir = cache_directory)
+        os.close(fh)
+        scipy.sparse.save_npz(tmp_path, weights)
+        try:
+            os.rename(tmp_path, cache_path)
+        except OSError: #another process got there first (windows won't rename over an existing file)
+            os.remove(tmp_path)
+
+    _weights_cache[cache_name] = weights
+    return weights
+
+
+
+def crop_window(grid, r2c_grid, halo = CROP_HALO):
+    """
+    works out the window of a grib grid that covers an r2c grid, with a halo of extra points on each side
+
+    Args:
+        grid: grib grid dictionary, see parse_grid_section()
+        r2c_grid: r2c grid dictionary, see read_r2c_grid()
+        halo: number of grib points added on each side of the window
+    Returns:
+        (i0, i1, j0, j1); the window is i0 <= i < i1 and j0 <= j < j1
+    """
+
+    #the corners of every cell, so the whole template extent is covered
+    x = r2c_grid["xorigin"] + numpy.arange(r2c_grid["xcount"] + 1) * r2c_grid["xdelta"]
+    y = r2c_grid["yorigin"] + numpy.arange(r2c_grid["ycount"] + 1) * r2c_grid["ydelta"]
+    lon, lat = numpy.meshgrid(x, y)
+    fi, fj = grid_indices(grid, lat.ravel(), lon.ravel())
+
+    i0 = min(max(int(math.floor(fi.min())) - halo, 0), grid["ni"])
+    i1 = max(min(int(math.ceil(fi.max())) + halo + 1, grid["ni"]), i0)
+    j0 = min(max(int(math.floor(fj.min())) - halo, 0), grid["nj"])
+    j1 = max(min(int(math.ceil(fj.max())) + halo + 1, grid["nj"]), j0)
+
+    return i0, i1, j0, j1
+
+
+
+def window_nodes(grid, window):
+    """
+    gets the grib points of a window in node order (the order of pyEnSim_basics.raster_to_array())
+
+    Args:
+        grid: grib grid dictionary, see parse_grid_section()
+        window: (i0, i1, j0, j1), see crop_window()
+    Returns:
+        sorted numpy array of node indices
+    """
+
+    i0, i1, j0, j1 = window
+    i, j = numpy.meshgrid(numpy.arange(i0, i1), numpy.arange(j0, j1))
+
+    #same node order as build_weights()
+    if grid["scanning_mode"] & 0x20:
+        nodes = i * grid["nj"] + j
+    else:
+        nodes = j * grid["ni"] + i
+
+    return numpy.sort(nodes.ravel())
+
+
+
+def get_crop(grib_path, r2c_template_path):
+    """
+    gets the grib points that are needed to convert a grib file onto an r2c template (see crop_window()).
+    The crop is worked out once per (grib grid, template) pair and kept in memory for the rest of the process.
+
+    Args:
+        grib_path: path to any grib2 file on the source grid
+        r2c_template_path: path to the r2c template (ie. EmptyGridLL.r2c, TEMPLATE_met.r2c)
+    Returns:
+        (key, nodes); key is a string identifying the crop and nodes a sorted numpy array of node indices.
+        (None, None) if the whole field is needed (the template covers most of the grid, or the grid or
+        template can't be read here)
+    """
+
+    try:
+        grid_section = read_grid_section(grib_path)
+        r2c_grid = read_r2c_grid(r2c_template_path)
+    except (IOError, ValueError, KeyError):
+        return None, None
+
+    key = weights_key(grid_section, r2c_grid)
+    if key not in _crops:
+        try:
+            grid = parse_grid_section(grid_section)
+        except ValueError:
+            grid = None
+
+        nodes = None
+        if grid is not None:
+            nodes = window_nodes(grid, crop_window(grid, r2c_grid))
+            if len(nodes) >= grid["ni"] * grid["nj"]: #nothing to crop
+                nodes = None
+        _crops[key] = nodes
+
+    if _crops[key] is None:
+        return None, None
+    return key, _crops[key]
+
+
+
+def crop_weights(weights, key, nodes):
+    """
+    gets the columns of a regridding weight matrix for the nodes of a crop, so it can be applied to
+    cropped values. The cropped matrix is kept in memory for the rest of the process.
+
+    Args:
+        weights: scipy.sparse.csr_matrix, see get_weights()
+        key: crop key, see get_crop()
+        nodes: node indices of the crop, see get_crop()
+    Returns:
+        scipy.sparse.csr_matrix of shape (number of r2c cells, len(nodes)), or None if the weights use
+        points outside the crop (the whole field is then needed)
+    """
+
+    cache_key = (id(weights), key)
+    if cache_key not in _cropped_weights:
+        used = numpy.unique(weights.indices)
+        if numpy.all(numpy.in1d(used, nodes)):
+            _cropped_weights[cache_key] = (weights, weights[:, nodes].tocsr())
+        else:
+            _cropped_weights[cache_key] = (weights, None)
+
+    return _cropped_weights[cache_key][1]
@@ -12,21 +12,35 @@ import datetime
 import sys
 import multiprocessing
 import subprocess
-import urllib2
 import re
 import shutil
+import collections
+import time
 
 
 
 #import custom modules
 import FrameworkLibrary 
 import pyEnSim_basics
+import grib_regrid
+import r2c_io
+import download_manager
+import conversion_manifest
+import conversion_cache
+import tempdiff
+import worker_pool
 import pyEnSim.pyEnSim as pyEnSim
 
+
+#consecutive conversion tasks (timesteps of the same grib files) sent to a worker process at once, so a grib file
+#decoded as one timestep is still in that worker's raster cache when it is the previous timestep of the next one
+#(see pyEnSim_basics.RasterCache)
+CONVERSION_CHUNK_SIZE = 8
+
  
 def repo_pull_nomads(repos, filePath, timestamp, repo_path):
     """
-    Downloads forecast data from NOMADS repository using wget
+    Downloads forecast data from NOMADS repository, see download_manager.DownloadManager
     
         Args:
         repos: the source data in a single source from the config file, see below for example
@@ -58,6 +72,25 @@ def repo_pull_nomads(repos, filePath, timestamp, repo_path):
         NULL - downloads grib files from online repository
     """
     
+    #download on a pool of threads, this speeds up download time considerably. The number of simultaneous
+    #requests to the filter cgi adapts to how fast the server responds, and throttled requests are retried
+    print '\nDownloading Files... \n'
+    download_files(nomads_download_list(repos, timestamp, repo_path), threads = 20, manifest = download_manager.get_manifest(repo_path))
+
+            
+            
+def nomads_download_list(repos, timestamp, repo_path):
+    """
+    Builds the list of NOMADS files to download for a single source, see repo_pull_nomads()
+    
+    Args:
+        repos: the source data in a single source from the config file, see repo_pull_nomads()
+        timestamp: datestamp + start hour
+        repo_path: path to store all the repo data; currently 'config_file.grib_forecast_repo'
+    Returns:
+        list of (url, local file path) for the files that don't exist locally, or are incomplete (see download_manager.DownloadManifest)
+    """
+    
     #build repository directory to store the date's files
     today_repo_path = repo_path + "/" + timestamp + "/"
     FrameworkLibrary.build_dir(today_repo_path)
@@ -71,7 +104,8 @@ def repo_pull_nomads(repos, filePath, timestamp, repo_path):
     Source =  repos[8][0]
     Grouping = repos[7][0]
     num_ensembles = int(repos[10][0])
-    wget_list = []
+    manifest = download_manager.get_manifest(repo_path)
+    download_list = []
 
     print 'building list of files for download'
     for k in range(1,num_ensembles + 1): #for each ensemble member
@@ -111,19 +145,15 @@ def repo_pull_nomads(repos, filePath, timestamp, repo_path):
                 name = name.replace('%S2', 'cmc_')
                 name = name.replace('%S3', 'cmce')
                 
-            #concatenate and create wget command
+            #concatenate the url and local file name
             downloadname = url + name
             filename = Source + '_' + Grouping + '_' + ensemble + '_' +  str(DeltaTime).zfill(3) + '_' + timestamp + '.grib2'
-            cmd = "wget -q -O " + today_repo_path + filename + " " + '"' + downloadname + '"' + " 2> NUL"
             
-            #append to wget download list if file doesn't exist locally
-            if not os.path.isfile(today_repo_path + filename): #if file does not exist locally
-                  wget_list.append(cmd)
+            #append to download list if file doesn't exist locally, or is incomplete
+            if not manifest.is_complete(today_repo_path + filename):
+                  download_list.append((downloadname, today_repo_path + filename))
                   
-    #now run wget with multiple threads, this speeds up download time considerably
-    print '\nDownloading Files... \n'
-    pool = multiprocessing.Pool(processes = 20)
-    pool.map(os.system,wget_list)
+    return download_list
 
             
 
@@ -131,7 +161,7 @@ def repo_pull_nomads(repos, filePath, timestamp, repo_path):
     
 def repo_pull_datamart(repos,filePath,timestamp,repo_path):
     """
-    Downloads forecast data from EC datamart repository using wget
+    Downloads forecast data from EC datamart repository, see download_manager.DownloadManager
     http://dd.weather.gc.ca/
     
     Args:
@@ -155,10 +185,29 @@ def repo_pull_datamart(repos,filePath,timestamp,repo_path):
         NULL - downloads grib files from online repository
     """
 
+    download_files(datamart_download_list(repos, timestamp, repo_path), threads = 20, manifest = download_manager.get_manifest(repo_path))
+    print "\n"
+          
+          
+          
+def datamart_download_list(repos, timestamp, repo_path):
+    """
+    Builds the list of EC datamart files to download for a single source, see repo_pull_datamart()
+    
+    Args:
+        repos: the source data in a single source from the config file, see repo_pull_datamart()
+        timestamp: datestamp + start hour
+        repo_path: path to store all the repo data; currently 'config_file.grib_forecast_repo'
+    Returns:
+        list of (url, local file path) for the files that don't exist locally, or are incomplete (see download_manager.DownloadManifest)
+    """
+
     #build repository directory to store the date's files
     today_repo_path = repo_path + "/" + timestamp + "/"
     FrameworkLibrary.build_dir(today_repo_path)
 
+    manifest = download_manager.get_manifest(repo_path)
+    download_list = []
     #for each of the 'series' that are being stitched together (typically 1 or 2)
     for i, url in enumerate(repos[0]): 
       DeltaTimeStart = int(repos[2][i])
@@ -167,240 +216,94 @@ def repo_pull_datamart(repos,filePath,timestamp,repo_path):
       
       #loop through the time series
       for j in range(DeltaTimeStart/DeltaTimeStep,DeltaTimeEnd/DeltaTimeStep + 1):
-        #set progress bar
-        pbar = (j+1-DeltaTimeStart/DeltaTimeStep)/float((DeltaTimeEnd/DeltaTimeStep + 1)-DeltaTimeStart/DeltaTimeStep) * 40
-        sys.stdout.write('\r')
-        # the exact output you're looking for:
-        sys.stdout.write("[%-40s] %d%%" % ('='*int(pbar), pbar/40*100))
-        sys.stdout.flush()
-      
         DeltaTime = j * DeltaTimeStep
         #replace %T with the deltaT
         url = repos[0][i].replace('%T', str(DeltaTime).zfill(3))
         name = repos[1][i].replace('%T', str(DeltaTime).zfill(3))
         
-        filename = url + name
-        
-        #run wget
-        if not os.path.isfile(today_repo_path + name): #if file does not exist locally
-          try: #download if remote file exists
-              urllib2.urlopen(filename) #command to see if remote file can be opened
-              os.system("wget -q -O " + today_repo_path + name + " " + filename + " 2> NUL") #use wget to actually download the file
-          except urllib2.URLError as e: #do nothing if remote file doesn't exist
-              print " Error: File does not exist locally or remotely"
-        
-
-      print "\n"
-          
+        if not manifest.is_complete(today_repo_path + name): #if file does not exist locally, or is incomplete
+          download_list.append((url + name, today_repo_path + name))
           
+    return download_list
 
 
 
-def grib2r2c_datamart(repos, wx_repo, r2c_template, datestamp_object, grib_repo, silent = False):
+def get_regrid_cache(config_file):
     """
-    Function to process the EC datamart grib files (both deterministic and ensemble)
+    Gets the directory where the cached regridding weights are stored (see grib_regrid module)
     
     Args:
-        repos: 
-            #Example repos from config file, note substitution parameters (%X) in :FileName
-            :SourceData  
-            0:URL                http://nomads.ncep.noaa.gov/cgi-bin/              
-            1:FileName           filter_%S1.pl?file=%S2gep%E.t%Hz.pgrb2af%T&%query&subregion=&leftlon=-98&rightlon=-88&toplat=54&bottomlat=46&dir=%2F%S3.%Y%m%d%2F00%2Fpgrb2a
-            2:DeltaTimeStart     6                                                                          
-            3:DeltaTimeEnd       240                                                                         
-            4:DeltaTimeStep      6                                                                          
-            5:StitchTimeStart    6                                                                          
-            6:StitchTimeEnd      240                                                                         
-            7:Grouping           tem                                                                        
-            8:Type               NOMAD_GFS                                                                        
-            9:Forecast           3
-            10:num_ensembles     20   
-        
-        wx_repo: wxdata folder path
-        r2c_template: path to r2c template
-        datestamp_object: forecast date in the datetime class
-        grib_repo: repository where grib data is downloaded and stored
-        
+        config_file: see class ConfigParse()
     Returns:
-        NULL - but creates r2c files from grib files
+        path of the cache directory, or False if 'regrid_cache_directory' isn't set, in which
+        case pyEnSim does the interpolation
     """
-
-    #get initial info from repos
-    Stitches = len(repos[0])
-    Grouping = repos[7][0]
-    Type = repos[8][0]
-    num_ensembles = int(repos[10][0])
     
-    DeltaTimeStart = int(repos[2][0])
-    DeltaTimeEnd = int(repos[3][0])
-    Forecast = int(repos[9][0])
+    if config_file.regrid_cache_directory == "False":
+        return False
+    return config_file.regrid_cache_directory
     
-    #set folder paths
-    today_grib_repo = os.path.join(grib_repo,datestamp_object.strftime("%Y%m%d%H"))
-    r2c_dest_folder = os.path.join(wx_repo, Grouping)
     
-    #Set the number of r2c files to produce based on user defined 'num_ensembles' arg from repos
-    #note that EC datamart structure has the ensembles embedded as multiple 'children' in each grib file
-    #the processing of these 'children' is done within the pyEnSim_basics.grib_save_r2c and 
-    #pyEnSim_basics.grib_fastappend_r2c functions
-    frame_index = 0
-    if num_ensembles > 1:
-        ensemble = num_ensembles
-    else:
-        ensemble = False
-        
-    #for each of the 'series' that are being stitched together (typically 1 or 2)
-    for i in range(0,Stitches):
-
     
-        StitchTimeStart = int(repos[5][i])
-        StitchTimeEnd = int(repos[6][i])
-        DeltaTimeStep = int(repos[4][i])
-        
-        print "Converting Hours: " + str(StitchTimeStart) + " to " + str(StitchTimeEnd)
-        #loop through each timestep
-        for j in range(StitchTimeStart/DeltaTimeStep,StitchTimeEnd/DeltaTimeStep+1):
-            
-            if silent is False:
-                pbar = j/float(StitchTimeEnd/DeltaTimeStep) * 40
-                sys.stdout.write('\r')
-                # the exact output you're looking for:
-                sys.stdout.write("[%-40s] %d%%" % ('='*int(pbar), pbar/40*100))
-                sys.stdout.flush() 
-        
-            frame_index = frame_index + 1
-            
-            #set deltatime so that frame timestamp can be properly labelled
-            if j == 1:
-                DeltaTime = StitchTimeStart
-            else:
-                DeltaTime = DeltaTime + DeltaTimeStep
-
-            #end loop if we've reached the end
-            if DeltaTime > StitchTimeEnd:
-                break
-
-            #get first file and convert to r2c
-            name = repos[1][i].replace('%T', str(DeltaTime).zfill(3)) #%Y%m%d%H have already been replaced in query_meteorological_forecast()
-            grib_filepath = os.path.join(today_grib_repo,name)
-
-            oldname = repos[1][i].replace('%T', str(DeltaTime-DeltaTimeStep).zfill(3)) #%Y%m%d%H have already been replaced in query_meteorological_forecast()
-            oldgrib_filepath = os.path.join(today_grib_repo,oldname)
-
-            
-            #get r2c destination filename
-            r2c_dest_filename = datestamp_object.strftime("%Y%m%d") + '_' + Grouping + '_' + "%02d" % Forecast + '-01.r2c'
-            r2c_dest_filepath = os.path.join(r2c_dest_folder,r2c_dest_filename)
-            
-            r2c_template_object = pyEnSim_basics.load_r2c_template(r2c_template)
-            frame_time = datestamp_object + datetime.timedelta(hours=int(DeltaTime))
-            
-            
-            if Grouping == "tem":
-                if j == 1:
-                    #if this is the first pass, create the r2c file(s)
-                    pyEnSim_basics.grib_save_r2c(grib_filepath, r2c_template, r2c_dest_filepath, timestamp = datestamp_object, convert_add = -273.15, ensemble = ensemble)
-                else:
-                    #append grib data to existing r2c file(s) on all other passes
-                    pyEnSim_basics.grib_fastappend_r2c(grib_filepath, r2c_template_object, r2c_dest_filepath, frame_index, frame_time, convert_add = -273.15, ensemble = ensemble)
-                    
-
-            if Grouping == "met":
-                if j == 1:
-                    pyEnSim_basics.grib_save_r2c(grib_filepath, r2c_template, r2c_dest_filepath, timestamp = datestamp_object, ensemble = ensemble)
-                else:
-                    pyEnSim_basics.grib_fastappend_r2c(grib_filepath, r2c_template_object, r2c_dest_filepath, frame_index, frame_time, grib_previous = oldgrib_filepath, ensemble = ensemble)
-
-        print "\n"
-          
-
-
-def grib_to_r2c_nomads(repos, r2c_repo, r2c_template, datestamp_object, grib_repo, silent = False):
+def get_regrid_weights(grib_path, r2c_template, regrid_cache):
+    """
+    Returns the regridding weights for a grib file, or None if regrid_cache is False
     """
-    Function to convert the files that have been downloaded via the repo_pull_nomads function
-    Note that the ensemble files are handled differently than the EC datamart ensemble files.
-    NOMADS stores 1 single ensemble in 1 single grib file. There are no 'children' as in the datamart.
+    
+    if regrid_cache is False:
+        return None
+    return grib_regrid.get_weights(grib_path, r2c_template, regrid_cache)
+    
+    
+    
+def get_frame_cache(config_file):
+    """
+    Gets the directory where the converted forecast frames are cached (see conversion_cache module)
     
     Args:
-        repos:
-           #Example repos from config file, note substitution parameters (%X) in :FileName
-           :SourceData  
-           0:URL                http://nomads.ncep.noaa.gov/cgi-bin/              
-           1:FileName           filter_%S1.pl?file=%S2gep%E.t%Hz.pgrb2af%T&%query&subregion=&leftlon=-98&rightlon=-88&toplat=54&bottomlat=46&dir=%2F%S3.%Y%m%d%2F00%2Fpgrb2a
-           2:DeltaTimeStart     6                                                                          
-           3:DeltaTimeEnd       240                                                                         
-           4:DeltaTimeStep      6                                                                          
-           5:StitchTimeStart    6                                                                          
-           6:StitchTimeEnd      240                                                                         
-           7:Grouping           tem                                                                        
-           8:Type               NOMAD_GFS                                                                        
-           9:Forecast           3
-           10:num_ensembles     20   
-       
-        wx_repo: wxdata folder path
-        r2c_template: path to r2c template
-        datestamp_object: forecast date in the datetime class
-        grib_repo: repository where grib data is downloaded and stored
-        
+        config_file: see class ConfigParse()
     Returns:
-        NULL - but converts grib files to r2c
+        path of the cache directory, or False if 'conversion_cache_directory' isn't set, in which
+        case every frame is converted
     """
-
-    #get information for source file
-    Grouping = repos[7][0]
-    Type = repos[8][0]
-    num_ensembles = int(repos[10][0])
     
-    DeltaTimeStart = int(repos[2][0])
-    DeltaTimeEnd = int(repos[3][0])
-    DeltaTimeStep = int(repos[4][0])
-    Forecast = int(repos[9][0])
+    if config_file.conversion_cache_directory == "False":
+        return False
+    return config_file.conversion_cache_directory
+    
+    
+    
+def open_frame_cache(frame_cache):
+    """
+    Returns the conversion_cache.ConversionCache of a cache directory, or None if frame_cache is False
+    """
+    
+    if frame_cache is False:
+        return None
+    return conversion_cache.get_cache(frame_cache)
+    
+    
+    
+def evict_frame_cache(config_file):
+    """
+    Removes the oldest converted frames from the cache, to keep it within the age and size limits in the configuration file
+    
+    Args:
+        config_file: see class ConfigParse()
+    Returns:
+        NULL
+    """
+    
+    converted_frames = open_frame_cache(get_frame_cache(config_file))
+    if converted_frames is None:
+        return
+    removed = converted_frames.evict(max_bytes = float(config_file.conversion_cache_size) * 1024 * 1024,
+                                     max_age_days = float(config_file.conversion_cache_days))
+    if removed > 0:
+        print "Removed " + str(removed) + " old frames from the conversion cache"
     
-    today_grib_repo = grib_repo + "/" + datestamp_object.strftime("%Y%m%d%H") + "/"
-    r2c_dest_folder = os.path.join(r2c_repo, Grouping)
     
-    r2c_template_object = pyEnSim_basics.load_r2c_template(r2c_template)
     
-
-    print "Converting Hours: " + str(DeltaTimeStart) + " to " + str(DeltaTimeEnd)
-    #for each ensemble member (1-20)
-    for i in range(1,num_ensembles+1):
-        if silent is False:
-            pbar = i/float(num_ensembles) * 40
-            sys.stdout.write('\r')
-            # the exact output you're looking for:
-            sys.stdout.write("[%-40s] %d%%" % ('='*int(pbar), pbar/40*100))
-            sys.stdout.flush()
-
-        #for each timestep
-        for j in range(DeltaTimeStart/DeltaTimeStep,DeltaTimeEnd/DeltaTimeStep + 1):
-      
-            #get file to convert
-            DeltaTime = j * DeltaTimeStep
-            TimeStamp = datestamp_object + datetime.timedelta(hours = (DeltaTime-DeltaTimeStep))
-            grib_filepath = today_grib_repo + Type + '_' + Grouping + '_' + "%02d" % i + '_' + "%03d" % DeltaTime + '_' + datestamp_object.strftime("%Y%m%d%H") + '.grib2'
-
-            #get r2c destination filename
-            r2c_dest_filename = datestamp_object.strftime("%Y%m%d") + '_' + Grouping + '_' + "%02d" % Forecast + '-' + "%02d" % i + '.r2c'
-            r2c_dest_filepath = os.path.join(r2c_dest_folder,r2c_dest_filename)
-
-
-            #get first file and convert to r2c
-            if j == 1:
-                if Grouping == 'tem':
-                    pyEnSim_basics.grib_save_r2c(grib_filepath, r2c_template, r2c_dest_filepath, timestamp = datestamp_object, convert_add = -273.15)
-                if Grouping == 'met':
-                    pyEnSim_basics.grib_save_r2c(grib_filepath, r2c_template, r2c_dest_filepath, timestamp = datestamp_object, convert_mult = False)
-                    
-            else: #for all grib files after the first file, append to existing r2c file
-                if Grouping == 'tem':
-                    pyEnSim_basics.grib_fastappend_r2c(grib_filepath, r2c_template_object, r2c_dest_filepath, frameindex = j, frametime = TimeStamp, convert_add = -273.15)
-                if Grouping == 'met':
-                    pyEnSim_basics.grib_fastappend_r2c(grib_filepath, r2c_template_object, r2c_dest_filepath, frameindex = j, frametime = TimeStamp, convert_mult = False)
-    print '\n'
-
-
-        
 def query_meteorological_forecast(config_file):
     """
     Query EC datamart and/or NOMADS to download and convert data. 
@@ -460,17 +363,10 @@ def query_meteorological_forecast(config_file):
           
     
     #Download the forecast data to directory specified in the config file
-    print "Downloading Data.... \n"
-    for k in range(len(repos_parent)):
-    
-      Type = repos_parent[k][8][0]
-      Grouping = repos_parent[k][7][0]
-      print Type + " - " + Grouping
-      
-      if "NOMAD" in Type: #if NOMADS
-        repo_pull_nomads(repos_parent[k], wx_path, timestamp, config_file.grib_forecast_repo)
-      else: #else assume EC datamart
-        repo_pull_datamart(repos_parent[k], wx_path, timestamp, config_file.grib_forecast_repo)
+    #in streaming mode the downloads are done together with the conversion further down
+    streaming = config_file.stream_forecast_conversion == "True"
+    if not streaming:
+      download_forecast(repos_parent, wx_path, timestamp, config_file.grib_forecast_repo)
       
 
     # Now process the downloaded files into WATFLOOD format************************
@@ -483,80 +379,677 @@ def query_meteorological_forecast(config_file):
         os.mkdir(os.path.join(wx_path,"tem"))
         
         
-    #check if r2c files exist in the working directory, only convert from grib2 to r2c if the 
-    #r2c files don't already exist
-    existing_metfiles = os.listdir(os.path.join(wx_path,"met"))
-    existing_temfiles = os.listdir(os.path.join(wx_path,"tem"))
-    pattern = str(datestamp + ".*r2c")
-    
-    #check if files exist in folders and proceed accordingly
-    need_to_convert_met = "True"
-    for file in existing_metfiles:
-        if re.search(pattern, file):
-          need_to_convert_met = "False"
-          break
+    #convert to watflood r2c, the conversion manifest keeps track of the frames that are already converted
+    #so only the missing frames, or the ones whose grib files have changed, are converted again
+    r2c_template = os.path.join(repo_path,config_file.lib_directory,"EmptyGridLL.r2c")
+    
+    print "Converting Data.... \n"
+    input = []
+    for k in range(len(repos_parent)): #for each 'source section'
+    
+      Type = repos_parent[k][8][0]
+      Grouping = repos_parent[k][7][0]
+      print Type + " - " + Grouping
+      
+      tmp_tuple = [Type, repos_parent[k],wx_path, r2c_template, datestamp_object, config_file.grib_forecast_repo, get_regrid_cache(config_file),
+                 get_frame_cache(config_file)]
+      input.append(tmp_tuple)
           
-    need_to_convert_tem = "True"
-    for file in existing_temfiles:
-        if re.search(pattern, file):
-          need_to_convert_tem = "False"
-          break
-    
-    if need_to_convert_met == "False" and need_to_convert_tem == "False":
-        print "Converted Files already exist in wxData/met & tem directories,"
-        print "using those files, please delete if you wish to redo grib conversion"
+    #convert every grib file as a separate task, rather than one source per process
+    #the dif files are written from the temperature frames as they are converted, if requested
+    manifest = conversion_manifest.ConversionManifest(wx_path)
+    dif_files = None
+    if config_file.convert_forecast_dif == "True":
+      dif_files = tempdiff.DifFiles()
+    if streaming:
+      convert_streaming(input, forecast_download_list(repos_parent, timestamp, config_file.grib_forecast_repo),
+                        manifest = download_manager.get_manifest(config_file.grib_forecast_repo), conversion_manifest = manifest,
+                        dif_files = dif_files)
     else:
-      # convert to watflood r2c
-      r2c_template = os.path.join(repo_path,config_file.lib_directory,"EmptyGridLL.r2c")
-           
-      print "Converting Data.... \n"
-      input = []
-      for k in range(len(repos_parent)): #for each 'source section'
-      
-        Type = repos_parent[k][8][0]
-        Grouping = repos_parent[k][7][0]
-        print Type + " - " + Grouping
-        
-        tmp_tuple = [Type, repos_parent[k],wx_path, r2c_template, datestamp_object, config_file.grib_forecast_repo]
-        input.append(tmp_tuple)
-
-        #Use this piece of code if doing serial computing*************
-        # if "NOMAD" in Type: #if in NOMADS format
-            # grib_to_r2c_nomads(repos_parent[k], wx_path, r2c_template, datestamp_object, config_file.grib_forecast_repo)
-        # else: #else assume in EC datamart format
-            # grib2r2c_datamart(repos_parent[k], wx_path, r2c_template, datestamp_object, config_file.grib_forecast_repo)
-        #*************************************************************
-            
-      print "Processing in Parallel, the status will not print correctly\n"
-      p = multiprocessing.Pool(processes = min(multiprocessing.cpu_count(),len(repos_parent) + 1))
-      p.map(convert_parallel,input)
+      convert_scheduled(input, manifest = manifest, dif_files = dif_files)
+    evict_frame_cache(config_file)
       
 
        
+def download_forecast(repos_parent, wx_path, timestamp, repo_path):
+    """
+    Downloads the forecast grib files of every ':SourceData' section
+    
+    Args:
+        repos_parent: list of all the ':SourceData' sections of the config file
+        wx_path: wxData folder path
+        timestamp: datestamp + start hour
+        repo_path: path to store all the repo data; currently 'config_file.grib_forecast_repo'
+    Returns:
+        NULL - downloads grib files from online repositories
+    """
+    
+    print "Downloading Data.... \n"
+    for k in range(len(repos_parent)):
+    
+      Type = repos_parent[k][8][0]
+      Grouping = repos_parent[k][7][0]
+      print Type + " - " + Grouping
+      
+      if "NOMAD" in Type: #if NOMADS
+        repo_pull_nomads(repos_parent[k], wx_path, timestamp, repo_path)
+      else: #else assume EC datamart
+        repo_pull_datamart(repos_parent[k], wx_path, timestamp, repo_path)
+        
+        
     
-def convert_parallel(input):
+def datamart_conversion_tasks(repos, wx_repo, r2c_template, datestamp_object, grib_repo, regrid_cache = False, frame_cache = False):
     """
-    Executes the conversion functions (grib2r2c_datamart and grib2r2c_nomads) in parallel
-    This is for the sole purpose of speeding up the computation time
+    Lists every frame of an EC datamart source (both deterministic and ensemble) as independent conversion tasks
+    (one per timestep, each task converts all the ensemble children of its grib file)
     
     Args:
-        input: composed of multiple tuples containing arguments for conversion functions, see 
-        last part of met_process.query_meteorological_forecast()
+        repos: 
+            #Example repos from config file, note substitution parameters (%X) in :FileName
+            :SourceData  
+            0:URL                http://nomads.ncep.noaa.gov/cgi-bin/              
+            1:FileName           filter_%S1.pl?file=%S2gep%E.t%Hz.pgrb2af%T&%query&subregion=&leftlon=-98&rightlon=-88&toplat=54&bottomlat=46&dir=%2F%S3.%Y%m%d%2F00%2Fpgrb2a
+            2:DeltaTimeStart     6                                                                          
+            3:DeltaTimeEnd       240                                                                         
+            4:DeltaTimeStep      6                                                                          
+            5:StitchTimeStart    6                                                                          
+            6:StitchTimeEnd      240                                                                         
+            7:Grouping           tem                                                                        
+            8:Type               NOMAD_GFS                                                                        
+            9:Forecast           3
+            10:num_ensembles     20   
+        
+        wx_repo: wxdata folder path
+        r2c_template: path to r2c template
+        datestamp_object: forecast date in the datetime class
+        grib_repo: repository where grib data is downloaded and stored
+        regrid_cache: either False, or the directory of the cached regridding weights (see get_regrid_cache())
+        frame_cache: either False, or the directory of the cached converted frames (see get_frame_cache())
+        
+    Returns:
+        list of conversion tasks, see convert_frame_task()
+    """
+    
+    Stitches = len(repos[0])
+    Grouping = repos[7][0]
+    num_ensembles = int(repos[10][0])
+    Forecast = int(repos[9][0])
+    
+    today_grib_repo = os.path.join(grib_repo,datestamp_object.strftime("%Y%m%d%H"))
+    r2c_dest_filename = datestamp_object.strftime("%Y%m%d") + '_' + Grouping + '_' + "%02d" % Forecast + '-01.r2c'
+    r2c_dest_filepath = os.path.join(wx_repo, Grouping, r2c_dest_filename)
+    
+    if Grouping == "tem":
+        convert_add = -273.15
+    else:
+        convert_add = False
+    
+    tasks = []
+    frame_index = 0
+    for i in range(0,Stitches):
+        StitchTimeStart = int(repos[5][i])
+        StitchTimeEnd = int(repos[6][i])
+        DeltaTimeStep = int(repos[4][i])
+        
+        for j in range(StitchTimeStart/DeltaTimeStep,StitchTimeEnd/DeltaTimeStep+1):
+            frame_index = frame_index + 1
+            
+            if j == 1:
+                DeltaTime = StitchTimeStart
+            else:
+                DeltaTime = DeltaTime + DeltaTimeStep
+            if DeltaTime > StitchTimeEnd:
+                break
+                
+            grib_filepath = os.path.join(today_grib_repo, repos[1][i].replace('%T', str(DeltaTime).zfill(3)))
+            oldgrib_filepath = os.path.join(today_grib_repo, repos[1][i].replace('%T', str(DeltaTime-DeltaTimeStep).zfill(3)))
+            
+            #the first frame is labelled with the forecast date and isn't de-accumulated, as in pyEnSim_basics.grib_save_r2c
+            if j == 1:
+                frame_time = datestamp_object
+                grib_previous = False
+            else:
+                frame_time = datestamp_object + datetime.timedelta(hours=int(DeltaTime))
+                grib_previous = oldgrib_filepath if Grouping == "met" else False
+                
+            tasks.append([grib_filepath, grib_previous, None, None, frame_index, frame_time, convert_add, False, r2c_template, regrid_cache, frame_cache])
+            
+    #the ensemble members are the children of the grib files, skip the 1st child as in pyEnSim_basics.grib_save_r2c.
+    #if the grib files have fewer children than requested, the extra r2c files are never created
+    if num_ensembles > 1:
+        children = range(1,num_ensembles+1)
+        r2c_dest_base = re.split("\d\d.r2c",r2c_dest_filepath)[0]
+        r2c_paths = [r2c_dest_base + "%02d" % (c) + ".r2c" for c in children]
+    else:
+        children = [0]
+        r2c_paths = [r2c_dest_filepath]
+        
+    for task in tasks:
+        task[2] = children
+        task[3] = r2c_paths
+        
+    return tasks
+    
+    
+    
+def nomads_conversion_tasks(repos, r2c_repo, r2c_template, datestamp_object, grib_repo, regrid_cache = False, frame_cache = False):
+    """
+    Lists every frame of a NOMADS source as independent conversion tasks (one per member and timestep).
+    Note that the ensemble files are handled differently than the EC datamart ensemble files.
+    NOMADS stores 1 single ensemble in 1 single grib file. There are no 'children' as in the datamart.
+    
+    Args:
+        see datamart_conversion_tasks()
+    Returns:
+        list of conversion tasks, see convert_frame_task()
+    """
+    
+    Grouping = repos[7][0]
+    Type = repos[8][0]
+    num_ensembles = int(repos[10][0])
+    DeltaTimeStart = int(repos[2][0])
+    DeltaTimeEnd = int(repos[3][0])
+    DeltaTimeStep = int(repos[4][0])
+    Forecast = int(repos[9][0])
+    
+    today_grib_repo = grib_repo + "/" + datestamp_object.strftime("%Y%m%d%H") + "/"
+    
+    if Grouping == "tem":
+        convert_add = -273.15
+    else:
+        convert_add = False
+    
+    tasks = []
+    for i in range(1,num_ensembles+1):
+        r2c_dest_filename = datestamp_object.strftime("%Y%m%d") + '_' + Grouping + '_' + "%02d" % Forecast + '-' + "%02d" % i + '.r2c'
+        r2c_dest_filepath = os.path.join(r2c_repo, Grouping, r2c_dest_filename)
+        
+        for j in range(DeltaTimeStart/DeltaTimeStep,DeltaTimeEnd/DeltaTimeStep + 1):
+            DeltaTime = j * DeltaTimeStep
+            grib_filepath = today_grib_repo + Type + '_' + Grouping + '_' + "%02d" % i + '_' + "%03d" % DeltaTime + '_' + datestamp_object.strftime("%Y%m%d%H") + '.grib2'
+            
+            #the first frame is labelled with the forecast date, as in pyEnSim_basics.grib_save_r2c
+            if j == 1:
+                frame_time = datestamp_object
+            else:
+                frame_time = datestamp_object + datetime.timedelta(hours = (DeltaTime-DeltaTimeStep))
+                
+            tasks.append([grib_filepath, False, [0], [r2c_dest_filepath], j, frame_time, convert_add, False, r2c_template, regrid_cache, frame_cache])
+            
+    return tasks
+    
+    
+    
+def convert_frame_task(task):
+    """
+    Converts a single grib file (all the requested children) onto the r2c template grid.
+    This is the unit of work of convert_scheduled() and runs in a worker process.
+    
+    Args:
+        task: list of
+            task[0]: grib file path
+            task[1]: previous grib file path to de-accumulate with, or False
+            task[2]: list of children of the grib file to convert, children the file doesn't have are skipped
+            task[3]: list of r2c paths the children are written to (same length as task[2])
+            task[4]: frame index
+            task[5]: frame time (datetime)
+            task[6]: convert_add, see pyEnSim_basics.grib_fastappend_r2c()
+            task[7]: convert_mult, see pyEnSim_basics.grib_fastappend_r2c()
+            task[8]: r2c template path
+            task[9]: regrid cache directory or False
+            task[10]: converted frame cache directory or False, see get_frame_cache()
+    Returns:
+        frames: list of (r2c path, frame index, frame time, numpy array of values) tuples, one per child converted
+        cache_stats: (process id, pyEnSim_basics.raster_cache_stats()) of the worker, see raster_cache_report()
+    """
+    
+    grib_path, grib_previous, children, r2c_paths, frame_index, frame_time, convert_add, convert_mult, r2c_template, regrid_cache, frame_cache = task
+    
+    template_r2c_object = pyEnSim_basics.get_template(r2c_template)
+    arrays = pyEnSim_basics.grib_to_arrays(grib_path, template_r2c_object, children,
+                                           convert_mult = convert_mult, convert_add = convert_add, grib_previous = grib_previous,
+                                           regrid_weights = get_regrid_weights(grib_path, r2c_template, regrid_cache),
+                                           conversion_cache = open_frame_cache(frame_cache))
+                                           
+    r2c_paths = dict(zip(children, r2c_paths))
+    frames = [(r2c_paths[child], frame_index, frame_time, values) for child, values in arrays]
+    return frames, (os.getpid(), pyEnSim_basics.raster_cache_stats())
+    
+    
+    
+def raster_cache_report(cache_stats):
+    """
+    adds up the raster cache counters of the conversion workers, to see whether the decoded grib files are reused
+    and whether the cache is big enough (see pyEnSim_basics.set_raster_cache_size())
+    
+    Args:
+        cache_stats: dictionary of worker process id -> latest pyEnSim_basics.raster_cache_stats() of that worker
+    Returns:
+        string with the hits, misses and evictions of all the workers
+    """
+    
+    totals = dict([(name, sum([stats[name] for stats in cache_stats.values()])) for name in ["hits", "misses", "evictions"]])
+    largest = max([stats["nbytes"] for stats in cache_stats.values()] + [0])
+    limit = max([stats["max_bytes"] for stats in cache_stats.values()] + [0])
+    return ("Raster cache: %d hits, %d misses, %d evictions in %d worker processes (at most %.0f of %.0f MB used)"
+            % (totals["hits"], totals["misses"], totals["evictions"], len(cache_stats), largest / 1048576.0, limit / 1048576.0))
+    
+    
+    
+def conversion_plan(input, manifest = None, dif_files = None):
+    """
+    Builds the conversion tasks of every forecast source and the frame assembler that writes their results.
+    With a conversion manifest, the frames at the start of each r2c file that were already converted from the same
+    grib files are kept (the file is cut back to the last of them) and only the frames after them are planned.
+    
+    Args:
+        input: list of conversion inputs, one per ':SourceData' section of the configuration file (see the end of
+               query_meteorological_forecast()): Type, repos, wx_path, r2c_template, datestamp_object, grib_forecast_repo,
+               regrid_cache and frame_cache, see datamart_conversion_tasks()
+        manifest: either None, or the conversion_manifest.ConversionManifest of the wxData folder
+        dif_files: either None, or a tempdiff.DifFiles. The dif file of each temperature file is then written
+                   from the temperature frames as they are converted (see tempdiff.DifFiles)
+    Returns:
+        tasks: list of conversion tasks, see convert_frame_task()
+        assembler: r2c_io.FrameAssembler for all the r2c files the tasks write to
+        progress: dictionary of (expected frames, number of frames kept) for each r2c file, see record_conversion()
+    """
+    
+    tasks = []
+    tem_paths = set()
+    for Type, repos, wx_path, r2c_template, datestamp_object, grib_forecast_repo, regrid_cache, frame_cache in input:
+        if "NOMAD" in Type:
+            source_tasks = nomads_conversion_tasks(repos, wx_path, r2c_template, datestamp_object, grib_forecast_repo, regrid_cache, frame_cache)
+        else:
+            source_tasks = datamart_conversion_tasks(repos, wx_path, r2c_template, datestamp_object, grib_forecast_repo, regrid_cache, frame_cache)
+        if repos[7][0] == "tem":
+            for task in source_tasks:
+                tem_paths.update(task[3])
+        tasks.extend(source_tasks)
+            
+    #expected frames of each r2c file in the order they are written, with the source of each frame
+    expected = {}
+    templates = {}
+    for task in tasks:
+        method = "pyEnSim" if task[9] is False else "weights"
+        source = (task[0], task[1], task[6], task[7], task[8], method)
+        for r2c_path in task[3]:
+            if r2c_path not in expected:
+                expected[r2c_path] = []
+                templates[r2c_path] = task[8]
+            expected[r2c_path].append((task[4], task[5], source))
+            
+    #keep the frames that are already converted
+    progress = {}
+    skip = set()
+    for r2c_path in expected:
+        kept = 0
+        if manifest is not None:
+            kept = manifest.valid_frames(r2c_path, expected[r2c_path])
+            if kept > 0:
+                r2c_io.truncate_frames(r2c_path, kept)
+        progress[r2c_path] = (expected[r2c_path], kept)
+        skip.update([(r2c_path, frame[0]) for frame in expected[r2c_path][0:kept]])
+        
+    #only convert the children whose frames aren't kept
+    planned = []
+    for task in tasks:
+        children = [(child, r2c_path) for child, r2c_path in zip(task[2], task[3]) if (r2c_path, task[4]) not in skip]
+        if len(children) > 0:
+            planned.append(task[0:2] + [[child for child, r2c_path in children], [r2c_path for child, r2c_path in children]] + task[4:])
+            
+    #each new file is created by pyEnSim with its first frame (header included), as grib_save_r2c did,
+    #the frames after it (or after the kept ones) are appended
+    frame_order = {}
+    headers = {}
+    template_headers = {}
+    for r2c_path in expected:
+        template = templates[r2c_path]
+        if template not in template_headers:
+            template_headers[template] = r2c_io.read_header(template)[0]
+        kept = progress[r2c_path][1]
+        frame_order[r2c_path] = [frame[0] for frame in expected[r2c_path][kept:]]
+        headers[r2c_path] = template_headers[template] if kept == 0 else None
+        
+    def create(r2c_path, frame_index, frame_time, values):
+        pyEnSim_basics.save_r2c_frame(values, templates[r2c_path], r2c_path, frame_index, frame_time)
+        
+    #temperature files converted from the start get their dif file from the frames as they are written,
+    #the ones that are only partly converted are updated from the file afterwards
+    on_write = None
+    if dif_files is not None:
+        for r2c_path in tem_paths:
+            if progress[r2c_path][1] == 0:
+                dif_files.add_file(r2c_path)
+            else:
+                dif_files.update_file(r2c_path)
+        on_write = dif_files.add_frame
+            
+    return planned, r2c_io.FrameAssembler(frame_order, headers, on_write, create), progress
+    
+    
+    
+def record_conversion(manifest, progress, assembler):
+    """
+    records the frames that have been written to each r2c file in the conversion manifest, and saves it.
+    Frames that were converted but not yet written out (ie. the conversion was stopped) aren't recorded
+    
+    Args:
+        manifest: either None, or the conversion_manifest.ConversionManifest of the wxData folder
+        progress: see conversion_plan()
+        assembler: the r2c_io.FrameAssembler that wrote the frames
+    Returns:
+        NULL - but saves the manifest
+    """
+    
+    if manifest is None:
+        return
+        
+    for r2c_path, (expected, kept) in progress.items():
+        manifest.record(r2c_path, expected[0:kept + assembler.frames_written(r2c_path)])
+    manifest.save()
+    
+    
+    
+def convert_scheduled(input, processes = False, manifest = None, dif_files = None):
+    """
+    Converts all the forecast sources at once, with every grib file (NOMADS member and timestep, or datamart
+    timestep) as a separate task on a bounded pool of worker processes. The frames come back in any order and are
+    written to each r2c file in frame order as soon as all the frames before them have arrived.
+    
+    Args:
+        input: list of conversion inputs, see conversion_plan()
+        processes: number of worker processes, defaults to the number of cpus
+        manifest: either None, or the conversion_manifest.ConversionManifest of the wxData folder. Only the frames
+                  that are missing or whose grib files have changed are converted, see conversion_plan()
+        dif_files: either None, or a tempdiff.DifFiles that writes the dif files during the conversion, see conversion_plan()
     Returns:
         NULL - converts meteorological forecast files
     """
-    #parse input, the multithreading function requires only one input
-    Type = input[0]
-    repos = input[1]
-    wx_path = input[2]
-    r2c_template = input[3]
-    datestamp_object = input[4]
-    grib_forecast_repo = input[5]
     
-    if "NOMAD" in Type: #if in NOMADS format
-        grib_to_r2c_nomads(repos, wx_path, r2c_template, datestamp_object, grib_forecast_repo, silent = False)
-    else: #else assume in EC datamart format
-        grib2r2c_datamart(repos, wx_path, r2c_template, datestamp_object, grib_forecast_repo, silent = False)
+    tasks, assembler, progress = conversion_plan(input, manifest, dif_files)
+    if len(tasks) == 0:
+        print "Converted files are up to date in the wxData/met & tem directories"
+        record_conversion(manifest, progress, assembler)
+        if dif_files is not None:
+            dif_files.close()
+        return
+    
+    try:
+        run_conversion_tasks(tasks, assembler.add_frame, processes)
+        assembler.close()
+        if dif_files is not None:
+            dif_files.close()
+    finally:
+        record_conversion(manifest, progress, assembler)
+        
+    print "\n"
+    
+    
+    
+def run_conversion_tasks(tasks, add_frame, processes = False):
+    """
+    Runs conversion tasks on a bounded pool of worker processes, showing a progress bar
+    
+    Args:
+        tasks: list of conversion tasks, see convert_frame_task()
+        add_frame: function called with (r2c path, frame index, frame time, values) for every frame converted.
+                   The frames come back in any order
+        processes: number of worker processes, defaults to the framework's worker pool (see worker_pool module)
+    Returns:
+        NULL
+    """
+    
+    pool = get_worker_pool(processes)
+    print "Converting " + str(len(tasks)) + " grib files with " + str(min(pool.processes, len(tasks))) + " processes"
+    
+    #consecutive timesteps go to the same worker, unless that leaves workers without tasks
+    chunksize = max(1, min(CONVERSION_CHUNK_SIZE, len(tasks) // (4 * pool.processes)))
+    cache_stats = {}
+    try:
+        for k, (results, worker_stats) in enumerate(pool.imap_unordered(convert_frame_task, tasks, chunksize)):
+            cache_stats[worker_stats[0]] = worker_stats[1]
+            pbar = (k+1)/float(len(tasks)) * 40
+            sys.stdout.write('\r')
+            sys.stdout.write("[%-40s] %d%%" % ('='*int(pbar), pbar/40*100))
+            sys.stdout.flush()
+            
+            for r2c_path, frame_index, frame_time, values in results:
+                add_frame(r2c_path, frame_index, frame_time, values)
+    except:
+        release_worker_pool(pool, processes, terminate = True)
+        raise
+    release_worker_pool(pool, processes)
+    print ""
+    print pool.stats()
+    print raster_cache_report(cache_stats)
+    
+    
+    
+def get_worker_pool(processes = False):
+    """
+    gets the pool the conversion tasks run on
+
+    Args:
+        processes: either False for the framework's worker pool (see worker_pool.get_pool()), or a number of
+                   worker processes to start a pool of its own
+    Returns:
+        worker_pool.WorkerPool
+    """
+    
+    if processes is False:
+        return worker_pool.get_pool()
+    return worker_pool.WorkerPool(processes)
+    
+    
+    
+def release_worker_pool(pool, processes = False, terminate = False):
+    """
+    shuts down a pool from get_worker_pool(), unless it is the framework's worker pool
+    """
+    
+    if processes is not False:
+        pool.shutdown(terminate)
+    
+    
+    
+def forecast_download_list(repos_parent, timestamp, repo_path):
+    """
+    Builds the list of files to download for all the forecast sources
+    
+    Args:
+        repos_parent: list of all the ':SourceData' sections of the config file
+        timestamp: datestamp + start hour
+        repo_path: path to store all the repo data; currently 'config_file.grib_forecast_repo'
+    Returns:
+        list of (url, local file path) for the files that don't exist locally, or are incomplete (see download_manager.DownloadManifest)
+    """
+    
+    download_list = []
+    for repos in repos_parent:
+        if "NOMAD" in repos[8][0]:
+            download_list.extend(nomads_download_list(repos, timestamp, repo_path))
+        else:
+            download_list.extend(datamart_download_list(repos, timestamp, repo_path))
+            
+    return download_list
+    
+    
+    
+def download_files(download_list, threads = 20, report_missing = True, manifest = None):
+    """
+    Downloads a list of files on a pool of threads, showing a progress bar and the download rate from each
+    host at the end. Failed requests are retried; files that don't exist on the server (or still fail to
+    download) are reported and skipped, nothing is written locally for them.
+    
+    Args:
+        download_list: list of (url, local file path)
+        threads: number of simultaneous downloads
+        report_missing: print a message for files that don't exist on the server
+        manifest: download manifest of the repository, see download_manager.get_manifest()
+    Returns:
+        list of download_manager.DownloadResult for the files that were not downloaded
+    """
+    
+    failed = []
+    manager = download_manager.DownloadManager(threads = threads, manifest = manifest)
+    try:
+        for k, result in enumerate(manager.download_all(download_list)):
+            #set progress bar
+            pbar = (k+1)/float(len(download_list)) * 40
+            sys.stdout.write('\r')
+            sys.stdout.write("[%-40s] %d%%" % ('='*int(pbar), pbar/40*100))
+            sys.stdout.flush()
+            
+            if download_failed(result):
+                failed.append(result)
+    finally:
+        manager.close()
+        
+    print ""
+    for line in manager.report():
+        print line
+    report_failed_downloads(failed, report_missing)
+            
+    return failed
+    
+    
+    
+def download_failed(result):
+    """
+    Returns:
+        whether a download_manager.DownloadResult is a file that wasn't downloaded (missing on the server,
+        failed transfer, or a grib file rejected as incomplete)
+    """
+    
+    return result.status not in (200, 206)
+    
+    
+    
+def report_failed_downloads(failed, report_missing = True):
+    """
+    prints a message for each download that failed, see download_files()
+    """
+    
+    for result in failed:
+        if result.status == 404:
+            if report_missing:
+                print "\n Error: File does not exist locally or remotely: " + result.url
+        else:
+            print "\n Error: Download failed (" + str(result.status or result.error) + "): " + result.url
+    
+    
+    
+def convert_streaming(input, download_list, processes = False, download_threads = 20, manifest = None, conversion_manifest = None, dif_files = None):
+    """
+    Downloads and converts the forecast at the same time. Each grib file is converted as soon as it (and
+    the previous timestep, for accumulated precipitation) has been downloaded, so the total time is close to the
+    longer of the download and the conversion rather than both added together. The number of conversions
+    waiting for a worker is bounded, and the frames are written to each r2c file in frame order.
+    Grib files whose download failed are reported and not converted, the rest of the forecast still is. The frames
+    of an r2c file after one that couldn't be converted aren't written (or recorded in the conversion manifest),
+    so they are converted on the next run.
+    
+    Args:
+        input: list of conversion inputs, see conversion_plan()
+        download_list: list of (url, local file path) to download, see forecast_download_list()
+        processes: number of conversion worker processes, defaults to the framework's worker pool (see get_worker_pool())
+        download_threads: number of simultaneous downloads
+        manifest: download manifest of the repository, see download_manager.get_manifest()
+        conversion_manifest: either None, or the conversion_manifest.ConversionManifest of the wxData folder, see convert_scheduled()
+        dif_files: either None, or a tempdiff.DifFiles that writes the dif files during the conversion, see conversion_plan()
+    Returns:
+        NULL - downloads and converts meteorological forecast files
+    """
+    
+    tasks, assembler, progress = conversion_plan(input, conversion_manifest, dif_files)
+    
+    convert_pool = get_worker_pool(processes)
+    max_in_flight = 2 * convert_pool.processes
+    
+    #work out which downloads each task is waiting for
+    downloading = set([os.path.normpath(filepath) for url, filepath in download_list])
+    waiting = {}
+    needs = []
+    for n, task in enumerate(tasks):
+        files = [task[0]]
+        if task[1] is not False:
+            files.append(task[1])
+        needed = set([os.path.normpath(f) for f in files]) & downloading
+        needs.append(needed)
+        for f in needed:
+            waiting.setdefault(f, []).append(n)
+            
+    print "Downloading " + str(len(download_list)) + " files and converting " + str(len(tasks)) + " grib files with " + str(min(convert_pool.processes, len(tasks))) + " processes"
+    manager = download_manager.DownloadManager(threads = download_threads, manifest = manifest)
+    in_flight = collections.deque()
+    failed = []
+    skipped = set()
+    cache_stats = {}
+    
+    def collect(async_result):
+        results, worker_stats = async_result.get()
+        cache_stats[worker_stats[0]] = worker_stats[1]
+        for r2c_path, frame_index, frame_time, values in results:
+            assembler.add_frame(r2c_path, frame_index, frame_time, values)
+    
+    def submit(task):
+        #back-pressure: wait for the oldest conversion before queueing more than max_in_flight
+        while len(in_flight) >= max_in_flight:
+            collect(in_flight.popleft())
+        in_flight.append(convert_pool.apply_async(convert_frame_task, (task,)))
+        
+    try:
+        #anything that doesn't need a download can start straight away
+        for n, task in enumerate(tasks):
+            if len(needs[n]) == 0:
+                submit(task)
+                
+        for k, result in enumerate(manager.download_all(download_list)):
+            filepath = result.path
+            pbar = (k+1)/float(len(download_list)) * 40
+            sys.stdout.write('\r')
+            sys.stdout.write("[%-40s] %d%% downloaded" % ('='*int(pbar), pbar/40*100))
+            sys.stdout.flush()
+            
+            #the tasks that needed a file that wasn't downloaded are skipped
+            if download_failed(result):
+                failed.append(result)
+                skipped.update(waiting.pop(os.path.normpath(filepath), []))
+                
+            for n in waiting.pop(os.path.normpath(filepath), []):
+                needs[n].discard(os.path.normpath(filepath))
+                if len(needs[n]) == 0 and n not in skipped:
+                    submit(tasks[n])
+                    
+            while len(in_flight) > 0 and in_flight[0].ready():
+                collect(in_flight.popleft())
+                
+        while len(in_flight) > 0:
+            collect(in_flight.popleft())
+            
+        assembler.close()
+        if dif_files is not None:
+            dif_files.close()
+    except:
+        release_worker_pool(convert_pool, processes, terminate = True)
+        raise
+    finally:
+        manager.close()
+        record_conversion(conversion_manifest, progress, assembler)
+    release_worker_pool(convert_pool, processes)
+        
+    print ""
+    for line in manager.report():
+        print line
+    report_failed_downloads(failed)
+    if len(skipped) > 0:
+        print "\n Error: " + str(len(skipped)) + " grib files were not converted because their downloads failed"
+        if assembler.pending_frames() > 0:
+            print " " + str(assembler.pending_frames()) + " converted frames were not written, they come after a missing frame of their r2c file"
+    print convert_pool.stats()
+    print raster_cache_report(cache_stats)
+    print "\n"
     
     
     
@@ -590,28 +1083,35 @@ def Download_Datamart_ReAnalysisHindcast(config_file, type, RepoPath):
         raise ValueError('Source type is not defined. Only "CaPA" hindcast data can currently be downloaded')
     
 
-    #get list of files on the server
+    #get the files on the server that are newer than the last file held locally (the high-water mark)
     #http://stackoverflow.com/questions/10875215/python-urllib-downloading-contents-of-an-online-directory
-    urlpath = urllib2.urlopen(url)
-    server_data = urlpath.read()
-    filename_pattern = re.compile('"(' + filename_nomenclature + '.+.grib2)"')
-    filelist = filename_pattern.findall(server_data)
-    
-    
-    print "Downloading grib files from DataMart..."
-    #for all the files on the datamart
-    for s,name in enumerate(filelist):
-        try:
-            if not os.path.exists(os.path.join(RepoPath, name)): #if file doesn't exist locally, then download
-                os.system("wget -O " + os.path.join(RepoPath, name) + " " + url + "/" + name)
-        except:
-            pass
-    print "All of the files have been downloaded from:\n" + url
+    listing = download_manager.ListingCache(RepoPath)
+    filename_pattern = re.compile('"(' + filename_nomenclature + '.+?.grib2)"')
+    manager = download_manager.DownloadManager(threads = 20)
+    try:
+        filelist = listing.new_files(manager, url, filename_pattern)
+    finally:
+        manager.close()
+    
+    
+    print "Downloading " + str(len(filelist)) + " new grib files from DataMart..."
+    #for the new files on the datamart that don't exist locally
+    manifest = download_manager.get_manifest(RepoPath)
+    download_list = []
+    for name in filelist:
+        if not manifest.is_complete(os.path.join(RepoPath, name)):
+            download_list.append((url + name, os.path.join(RepoPath, name)))
+    failed = set([result.url for result in download_files(download_list, manifest = manifest)])
+    print "\nAll of the files have been downloaded from:\n" + url
+    
+    #move the mark up to the last file that is held along with every file before it
+    listing.advance_mark(url, filelist, failed)
+    listing.save()
     
     #get the timestamp of the last file
     pattern = filename_nomenclature + "(\d+)(_\d+.grib2)"
 
-    m = re.search(pattern,filelist[-1]) #only look at the last file in the list
+    m = re.search(pattern,listing.mark(url) or "") #only look at the last file held
     if m:
         lasttimestring = m.groups()[0]
         lasttimestep = datetime.datetime.strptime(lasttimestring,"%Y%m%d%H")
@@ -668,24 +1168,28 @@ def Download_Datamart_GEMHindcast(config_file, type, RepoPath):
     
 
     #Download grib2 files from DataMart ****************************************************** 
-    #While an online version exists and a local version does not download then repeat (hours 000 & 003 for all four forecasts)
+    #Download any that exist online and not locally (hours 000 & 003 for all four forecasts)
+    manifest = download_manager.get_manifest(RepoPath)
+    filelist = []
+    download_list = []
     for k,day in enumerate(dates):
         for i,startperiod in enumerate(forecast_periods):
             for j,starthour in enumerate(time_periods):
             
                 filename = filename_nomenclature + day + str(startperiod).zfill(2) +'_P' + str(starthour).zfill(3) + '.grib2'  
                 website = url + str(startperiod).zfill(2) + '/' + str(starthour).zfill(3) + '/' + filename
+                filelist.append(filename)
           
-                if os.path.exists(os.path.join(RepoPath,filename)): #check if file already exists in local directory
-                    lastfile = filename
-
-                else:
-                    try: #download if remote file exists
-                        urllib2.urlopen(website) #command to see if remote file can be opened
-                        os.system("wget -O " + os.path.join(RepoPath,filename) + " " + website) #use wget to actually download the file
-                        lastfile = os.path.join(RepoPath,filename)
-                    except urllib2.URLError as e: #do nothing if remote file doesn't exist
-                        pass
+                if not manifest.is_complete(os.path.join(RepoPath,filename)): #check if file already exists in local directory
+                    download_list.append((website, os.path.join(RepoPath,filename)))
+                    
+    #files that don't exist remotely are skipped, the newest files are often not online yet
+    download_files(download_list, report_missing = False, manifest = manifest)
+    
+    #the last file is the latest one that exists locally
+    for filename in filelist:
+        if manifest.is_complete(os.path.join(RepoPath,filename)):
+            lastfile = os.path.join(RepoPath,filename)
             
             
     print "All of the files have been downloaded from:\n" + url
@@ -732,10 +1236,6 @@ def MetUpdate(config_file, r2c_target_path, type, RepoPath, r2c_template_path):
         lastgribfiletime, grib_path_string = Download_Datamart_GEMHindcast(config_file,type,RepoPath)
 
         
-    #load capa template and get coordinate system
-    template_r2c_object = pyEnSim_basics.load_r2c_template(r2c_template_path)
-
-    
     #load r2c and get last frame and time
     lastindexframe, lasttimeframe = pyEnSim_basics.r2c_EndFrameData(r2c_target_path)
     
@@ -744,35 +1244,50 @@ def MetUpdate(config_file, r2c_target_path, type, RepoPath, r2c_template_path):
     print "the last gribfile is: " + str(lastgribfiletime)
     print "\n"
     
-
-    if type == "CaPA":
-        #starting at the next timestep, convert specified capa grib file and append to r2c file
-        current_time = lasttimeframe
-        current_index = lastindexframe
+    #list the whole missing window, up to the first missing grib file
+    frames = hindcast_frames(type, lasttimeframe, lastgribfiletime, grib_path_string, RepoPath, timestep)
+    frames = check_hindcast_gaps(frames, lasttimeframe, timestep)
+    if len(frames) == 0:
+        print "The " + type + " hindcast is up to date"
+        return
         
+    if type == "GEMTemps":
+        convert_add = -273.15
+    else:
+        convert_add = False
+        
+    regrid_cache = get_regrid_cache(config_file)
+    tasks = [[grib_path, False, [0], [r2c_target_path], lastindexframe + k + 1, frame_time, convert_add, False, r2c_template_path, regrid_cache, False]
+             for k, (frame_time, grib_path) in enumerate(frames)]
+    backfill_hindcast(tasks, r2c_target_path)
+    
+    
+    
+def hindcast_frames(type, lasttimeframe, lastgribfiletime, grib_path_string, RepoPath, timestep):
+    """
+    Lists the frames that are missing from a hindcast r2c file, with the grib file each one comes from
+    
+    Args:
+        type: string; currently either 'CaPA' or 'GEMTemps'
+        lasttimeframe: datetime of the last frame in the r2c file
+        lastgribfiletime: datetime of the last grib file in the repository
+        grib_path_string: see Download_Datamart_ReAnalysisHindcast() and Download_Datamart_GEMHindcast()
+        RepoPath: path to the directory where the downloaded grib files are stored
+        timestep: hours between frames
+    Returns:
+        list of (frame time, grib file path), in frame order
+    """
+    
+    frames = []
+    current_time = lasttimeframe
+    
+    if type == "CaPA":
+        #starting at the next timestep, each capa grib file is named after its time
         while(current_time < lastgribfiletime):
             current_time = current_time + datetime.timedelta(hours = timestep)
-            current_index = current_index + 1
-            current_gribpath = current_time.strftime(grib_path_string)
+            frames.append((current_time, current_time.strftime(grib_path_string)))
             
-            #convert and append grib file
-            pyEnSim_basics.grib_fastappend_r2c(grib_path = current_gribpath, 
-                                template_r2c_object = template_r2c_object, 
-                                r2cTargetFilePath = r2c_target_path, 
-                                frameindex = current_index, 
-                                frametime = current_time, 
-                                convert_mult = False, convert_add = False, ensemble = False)
-
-            
-            
-            
-
     if type == "GEMTemps":
-    
-        #create an ordered list of grib files to append
-        current_time = lasttimeframe
-
-        griblist = []
         while(current_time < lastgribfiletime):
             timestamp_odd = current_time.strftime("%Y%m%d%H")
             current_time = current_time + datetime.timedelta(hours = timestep)
@@ -781,32 +1296,83 @@ def MetUpdate(config_file, r2c_target_path, type, RepoPath, r2c_template_path):
             
             #get relevant grib file name; this is dependent on the hour because the forecasted temps are being used
             if int(hourstamp) in (0,6,12,18):
-               gribname = os.path.join(RepoPath,grib_path_string + timestamp_even + "_P000.grib2")
-               griblist.append(gribname)
+               frames.append((current_time, os.path.join(RepoPath,grib_path_string + timestamp_even + "_P000.grib2")))
            
             if int(hourstamp) in (3,9,15,21):
-               gribname = os.path.join(RepoPath,grib_path_string + timestamp_odd + "_P003.grib2")
-               griblist.append(gribname)
-        
-        
-        
-        #now iterate through grib list and append each file to r2c
-        current_time = lasttimeframe
-        current_index = lastindexframe
+               frames.append((current_time, os.path.join(RepoPath,grib_path_string + timestamp_odd + "_P003.grib2")))
+               
+    return frames
+    
+    
+    
+def check_hindcast_gaps(frames, lasttimeframe, timestep):
+    """
+    Checks that the missing frames of a hindcast r2c file follow on from its last frame one timestep apart,
+    and that all their grib files have been downloaded. Only the frames before the first gap can be appended,
+    the rest are left for the next update
+    
+    Args:
+        frames: see hindcast_frames()
+        lasttimeframe: datetime of the last frame in the r2c file
+        timestep: hours between frames
+    Returns:
+        list of the frames before the first gap
+    """
+    
+    expected_time = lasttimeframe
+    for k, (frame_time, grib_path) in enumerate(frames):
+        expected_time = expected_time + datetime.timedelta(hours = timestep)
+        if frame_time != expected_time:
+            print "Gap in the hindcast frames: expected " + str(expected_time) + " but the next grib file is for " + str(frame_time)
+            print "Only appending the frames up to " + str(expected_time - datetime.timedelta(hours = timestep))
+            return frames[0:k]
+        if not os.path.isfile(grib_path):
+            print "Gap in the hindcast grib files, missing " + grib_path
+            print "Only appending the frames up to " + str(expected_time - datetime.timedelta(hours = timestep))
+            return frames[0:k]
+            
+    return frames
+    
+    
+    
+def backfill_hindcast(tasks, r2c_target_path, processes = False):
+    """
+    Converts the missing frames of a hindcast r2c file in parallel (see run_conversion_tasks()), then appends
+    them to the file in frame order in one batch. Nothing is appended unless every frame was converted, so the
+    file never ends up with a gap
+    
+    Args:
+        tasks: list of conversion tasks, see convert_frame_task(); one per frame, in frame order
+        r2c_target_path: path to the r2c file that is being updated
+        processes: number of worker processes, defaults to the number of cpus
+    Returns:
+        NULL - but appends the frames to the r2c file
+    """
+    
+    start = time.time()
+    converted = {}
+    
+    def add_frame(r2c_path, frame_index, frame_time, values):
+        converted[frame_index] = (frame_time, values)
         
-        for i, grib_path in enumerate(griblist):
-            current_index = current_index + 1
-            current_time = current_time + datetime.timedelta(hours = timestep)
-            #convert and append grib file
-            pyEnSim_basics.grib_fastappend_r2c(grib_path = grib_path, 
-                                template_r2c_object = template_r2c_object, 
-                                r2cTargetFilePath = r2c_target_path, 
-                                frameindex = current_index, 
-                                frametime = current_time, 
-                                convert_mult = False, convert_add = -273.15, ensemble = False)
+    run_conversion_tasks(tasks, add_frame, processes)
+    
+    missing = [task[4] for task in tasks if task[4] not in converted]
+    if len(missing) > 0:
+        raise ValueError("Frames " + str(missing) + " could not be converted, nothing was appended to " + r2c_target_path)
         
-
-
+    #the frames are all held in memory and written in one pass
+    writer = r2c_io.R2CWriter(r2c_target_path, memory_budget = float("inf"))
+    for task in tasks:
+        frame_time, values = converted[task[4]]
+        writer.add_frame(task[4], frame_time, values)
+    writer.close()
+    
+    elapsed = max(time.time() - start, 1e-6)
+    print "\nAppended " + str(len(tasks)) + " frames to " + r2c_target_path + " in " + "%.1f" % elapsed + "s (" + "%.2f" % (len(tasks) / elapsed) + " frames/s)"
+    
+    
+    
 def query_ec_datamart_hindcast(config_file):
     """
     Function to download temperature (GEM regional forecast) and precipitation (CaPA) grib
@@ -854,13 +1420,9 @@ def query_ec_datamart_hindcast(config_file):
     destination = os.path.join(config_file.model_directory_path, "tempr", GEMTempsfilename)
     shutil.copyfile(origin, destination)
     
-    #create YYYYMMDD_dif.r2c file from temperature file
-    print "Calculating YYYYMMDD_dif.r2c file /n"
-    cmd = [config_file.rscript_path,
-          os.path.join(config_file.repository_directory,config_file.scripts_directory,config_file.r_script_tempdiff),
-          os.path.join(config_file.repository_directory,config_file.scripts_directory),
-          os.path.join(config_file.model_directory_path, "tempr")]
-    subprocess.call(cmd,shell=True)
+    #create YYYYMMDD_dif.r2c file from temperature file, only the days since the last update are added
+    print "Calculating YYYYMMDD_dif.r2c file \n"
+    tempdiff.update_directory(os.path.join(config_file.model_directory_path, "tempr"))
     
     
     
\ No newline at end of file
@@ -276,7 +276,7 @@ def GenericTemplateWriter(config_file, template_name, start_date):
     
     
     
-def EventGenerator(config_file, start_date, first_event = True, events_to_follow = False, flags = False):
+def EventGenerator(config_file, start_date, first_event = True, events_to_follow = False, flags = False, event_directory = False):
     """
     Event Generator that generates event files from a template. The template values are defaults
     that can be overridden by supplying flag pairs to the command line through the flags.
@@ -289,6 +289,7 @@ def EventGenerator(config_file, start_date, first_event = True, events_to_follow
         flags: pairs in a list. The first value specifies the flag to match in the event file, the second value is what to substitute in behind the flag
                 format must be False, or a list within a list.
                 ex) [[":tbcflg","y"],[":pointsoilmoisture","pathtofile"]]
+        event_directory: either False, or the directory to write the event file to instead of the model's event directory
                 
     Output: writes an event file to the event directory, as specified in the config_file
     
@@ -352,10 +353,12 @@ def EventGenerator(config_file, start_date, first_event = True, events_to_follow
 
 
     #check what kind of event file we're writing (historical or forecast) and write appropriate file name
+    if event_directory is False:
+        event_directory = os.path.join(repo_path,config_file.model_directory,'event')
     if first_event:
-        file = open(os.path.join(repo_path,config_file.model_directory,'event','event.evt'), 'w') 
+        file = open(os.path.join(event_directory,'event.evt'), 'w') 
     else:
-        file = open(os.path.join(repo_path,config_file.model_directory,'event',start_date.strftime('%Y%m%d') + '.evt'), 'w')
+        file = open(os.path.join(event_directory,start_date.strftime('%Y%m%d') + '.evt'), 'w')
      
     #write file
     for i, line in enumerate(table):
@@ -5,8 +5,170 @@ no documentation for the pyEnSim library.
 """
 
 import pyEnSim.pyEnSim as pyEnSim
+import numpy
+import os
 import re
 import datetime
+import threading
+import collections
+
+import r2c_io
+import grib_index
+import grib_regrid
+
+
+class RasterCache(object):
+    """
+    least recently used cache of decoded grib children (numpy arrays), bounded by memory. Entries are keyed by
+    (grib path, modification time, child), so a grib file that is replaced on disk is decoded again.
+    
+    With accumulated precipitation every grib file is decoded as the current timestep and then again as the
+    previous timestep of the next one; with the cache the second decode is a lookup. The hits, misses and
+    evictions counters show whether max_bytes is big enough for that reuse (see raster_cache_stats()).
+    The number of children of the grib files is kept as well, for at most MAX_CHILDREN_COUNTS files.
+    
+    Args:
+        max_bytes: total size of the cached arrays before the least recently used are evicted
+    """
+    
+    def __init__(self, max_bytes = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._children_counts = collections.OrderedDict()
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        
+        
+    def get(self, key):
+        """
+        gets a cached array, or None if it isn't cached
+        """
+        
+        with self._lock:
+            values = self._entries.pop(key, None)
+            if values is None:
+                self.misses += 1
+                return None
+            self._entries[key] = values #move to the most recently used end
+            self.hits += 1
+            return values
+            
+            
+    def put(self, key, values):
+        """
+        adds an array to the cache, evicting the least recently used arrays to stay within max_bytes.
+        The array is made read only since it is shared by everything that gets it from the cache
+        """
+        
+        if values.nbytes > self.max_bytes:
+            return
+        values.setflags(write = False)
+        
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key).nbytes
+            self._entries[key] = values
+            self.nbytes += values.nbytes
+            self._evict()
+            
+            
+    def resize(self, max_bytes):
+        """
+        changes the memory limit, evicting arrays if the cache is now over it
+        """
+        
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+            
+            
+    def _evict(self):
+        while self.nbytes > self.max_bytes:
+            old_key, old_values = self._entries.popitem(last = False)
+            self.nbytes -= old_values.nbytes
+            self.evictions += 1
+            
+            
+    def children_count(self, grib_key):
+        """
+        gets the number of children of a grib file, or None if it isn't known
+        
+        Args:
+            grib_key: (grib path, modification time), see _grib_key()
+        """
+        
+        with self._lock:
+            cached = self._children_counts.get(grib_key[0])
+            if cached is None or cached[0] != grib_key[1]:
+                return None
+            return cached[1]
+            
+    
+    def put_children_count(self, grib_key, count):
+        """
+        keeps the number of children of a grib file, replacing the count of an older version of the file
+        """
+        
+        with self._lock:
+            self._children_counts.pop(grib_key[0], None)
+            self._children_counts[grib_key[0]] = (grib_key[1], count)
+            while len(self._children_counts) > MAX_CHILDREN_COUNTS:
+                self._children_counts.popitem(last = False)
+                
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._children_counts.clear()
+            self.nbytes = 0
+            
+            
+    def stats(self):
+        """
+        Returns:
+            dictionary of hits, misses, evictions, entries, nbytes and max_bytes
+        """
+        
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "entries": len(self._entries), "nbytes": self.nbytes, "max_bytes": self.max_bytes}
+                    
+                    
+#only the messages of the children that are needed are loaded if they are less than this fraction of
+#the grib file, see load_grib_children()
+SUBSET_FRACTION = 0.5
+
+#number of grib files whose children count is kept, see RasterCache.children_count()
+MAX_CHILDREN_COUNTS = 1000
+
+#decoded grib children of this process, see read_children()
+_raster_cache = RasterCache()
+
+
+
+def set_raster_cache_size(max_bytes):
+    """
+    sets the memory limit of the decoded raster cache of this process, 0 turns the cache off
+    """
+    
+    _raster_cache.resize(max_bytes)
+        
+        
+        
+def raster_cache_stats():
+    """
+    gets the counters of the decoded raster cache of this process, see RasterCache.stats()
+    """
+    
+    return _raster_cache.stats()
+    
+    
+    
+def _grib_key(grib_path):
+    return (os.path.abspath(grib_path), os.path.getmtime(grib_path))
 
 
 def load_r2c_template(r2cpath):
@@ -27,6 +189,76 @@ def load_r2c_template(r2cpath):
     return r2c_object
     
     
+#r2c templates loaded in this process, see get_template()
+_templates = {}
+_template_coordinate_systems = {}
+_template_paths = {}
+_templates_lock = threading.Lock()
+
+
+
+def get_template(r2cpath, stream = None):
+    """
+    gets a loaded r2c template from the template registry of this process. Each template is loaded (with its
+    coordinate system) the first time it is asked for, and the same object is handed out after that, unless
+    the template file has changed on disk since it was loaded.
+    
+    pyEnSim has no way of copying a loaded object, so the template is shared by everything that asks for it
+    in the process. That is fine as long as it is used one frame at a time (every frame sets all the nodes
+    before it is written). Anything that uses a template at the same time as something else (ie. from
+    another thread) should give its own stream name, each stream gets its own object which is also only
+    loaded once.
+    
+    Args:
+        r2cpath: path of single frame r2c file (ie. EmptyGridLL.r2c, TEMPLATE_met.r2c, TEMPLATE_tem.r2c)
+        stream: optional name of the output stream the template is for
+    Returns:
+        pyEnSim object, see load_r2c_template()
+    """
+    
+    path = os.path.abspath(r2cpath)
+    file_stat = os.stat(path)
+    version = (file_stat.st_mtime, file_stat.st_size)
+    
+    with _templates_lock:
+        cached = _templates.get((path, stream))
+        if cached is not None and cached[0] == version:
+            return cached[1]
+            
+        if cached is not None: #the template has changed, forget the old one
+            _template_coordinate_systems.pop(id(cached[1]), None)
+            _template_paths.pop(id(cached[1]), None)
+            
+        r2c_object = load_r2c_template(path)
+        _templates[(path, stream)] = (version, r2c_object)
+        _template_coordinate_systems[id(r2c_object)] = r2c_object.GetCoordinateSystem()
+        _template_paths[id(r2c_object)] = path
+        
+        return r2c_object
+        
+        
+        
+def template_coordinate_system(template_r2c_object):
+    """
+    gets the coordinate system of an r2c template, without asking pyEnSim again if the template came from get_template()
+    """
+    
+    coordinate_system = _template_coordinate_systems.get(id(template_r2c_object))
+    if coordinate_system is None:
+        coordinate_system = template_r2c_object.GetCoordinateSystem()
+    return coordinate_system
+    
+    
+    
+def template_path(template_r2c_object):
+    """
+    gets the path of an r2c template that came from get_template(), or None for any other object
+    """
+    
+    return _template_paths.get(id(template_r2c_object))
+    
+    
+    
 def load_grib_file(grib_path):
     """
     loads a grib file
@@ -47,7 +279,421 @@ def load_grib_file(grib_path):
     
     
     
-def grib_save_r2c(grib_path, r2c_template_path, r2cTargetFilePath, timestamp = datetime.datetime.now(), convert_mult = False, convert_add = False, ensemble = False):
+def raster_to_array(raster, nodes = None):
+    """
+    copies all the node values of a pyEnSim raster into a numpy array. pyEnSim only exposes
+    single node access, so this is done in one pass and all the arithmetic is then done on the array
+    
+    Args:
+        raster: pyEnSim raster object (ie. a child of a grib file), must be initialized with InitAttributes()
+        nodes: either None, or a numpy array of the nodes to copy (ie. a crop, see grib_crop())
+    Returns:
+        numpy array (float64) of length raster.GetNodeCount() (or len(nodes)), in node order
+    """
+    
+    get_value = raster.GetNodeValue
+    if nodes is not None:
+        return numpy.fromiter((get_value(k) for k in nodes.tolist()), dtype = numpy.float64, count = len(nodes))
+        
+    count = raster.GetNodeCount()
+    return numpy.fromiter((get_value(k) for k in xrange(count)), dtype = numpy.float64, count = count)
+    
+    
+    
+def array_to_raster(values, raster, nodes = None):
+    """
+    writes a numpy array back into the nodes of a pyEnSim raster in a single pass
+    
+    Args:
+        values: numpy array, same length and node order as returned by raster_to_array()
+        raster: pyEnSim raster object that the values are written to
+        nodes: either None, or the nodes the values are written to (see raster_to_array()). The other nodes are left as they are
+    Returns:
+        NULL - but modifies the raster nodes in place
+    """
+    
+    set_value = raster.SetNodeValue
+    if nodes is not None:
+        for k, value in zip(nodes.tolist(), values.tolist()):
+            set_value(k, value)
+        return
+        
+    for k, value in enumerate(values.tolist()):
+        set_value(k, value)
+        
+        
+        
+def convert_array(values, convert_mult = False, convert_add = False, previous = None):
+    """
+    applies the de-accumulation and unit conversions to a whole frame at once.
+    The order is the same as it has always been: subtract previous (clamped at 0), add, then multiply
+    
+    Args:
+        values: numpy array of node values
+        convert_mult: either 'False' (python defined, not a string), or a number that each value is multiplied by
+        convert_add: either 'False' (python defined, not a string), or a number that is added to each value
+        previous: either None, or a numpy array of the same shape. If given, it is subtracted from values and
+                  negative results are set to 0. This is used for accumulated precipitation.
+    Returns:
+        numpy array of converted values
+    """
+    
+    if previous is not None:
+        values = numpy.maximum(values - previous, 0)
+        
+    if convert_add != False:
+        values = values + convert_add
+        
+    if convert_mult != False:
+        values = values * convert_mult
+        
+    return values
+    
+    
+    
+def map_to_template(raster, values, template_r2c_object, regrid_weights = None, nodes = None):
+    """
+    copies a grib raster onto the grid of the r2c template object
+    
+    Args:
+        raster: pyEnSim grib raster (ie. a child of a grib file)
+        values: either None, or a numpy array of converted node values that replaces the raster values
+        template_r2c_object: r2c template object the data is copied into
+        regrid_weights: either None, or a sparse weight matrix from grib_regrid.get_weights(). If None, pyEnSim
+                        works out the projection and interpolation (ConvertToCoordinateSystem and MapObjectDispatch)
+        nodes: either None, or the nodes of the raster that values hold (see grib_crop()). The weights must then be cropped
+               the same way (see grib_regrid.crop_weights())
+    Returns:
+        numpy array of the values on the template grid if regrid_weights were used, otherwise None.
+        The node values of template_r2c_object are set in both cases
+    """
+    
+    if regrid_weights is not None:
+        if values is None:
+            values = raster_to_array(raster, nodes)
+        template_values = regrid_weights.dot(values)
+        array_to_raster(template_values, template_r2c_object)
+        return template_values
+        
+    else:
+        if values is not None:
+            array_to_raster(values, raster, nodes)
+        raster.ConvertToCoordinateSystem(template_coordinate_system(template_r2c_object))
+        template_r2c_object.MapObjectDispatch(raster)
+        return None
+    
+    
+    
+def grib_crop(grib_path, template_r2c_object):
+    """
+    gets the grib points needed to convert a grib file onto a template, so the fields can be cropped to the
+    template extent (plus a halo, see grib_regrid.get_crop()) before any arithmetic or interpolation.
+    This only works for templates that came from get_template()
+    
+    Args:
+        grib_path: path of a grib2 file
+        template_r2c_object: r2c template object
+    Returns:
+        (key, nodes), see grib_regrid.get_crop(). (None, None) if the whole field is used
+    """
+    
+    r2c_template_path = template_path(template_r2c_object)
+    if r2c_template_path is None:
+        return None, None
+    return grib_regrid.get_crop(grib_path, r2c_template_path)
+    
+    
+    
+def grib_children_count(grib_path, grib_object = None):
+    """
+    gets the number of children of a grib file. This comes from the message index of the file (see grib_index)
+    when every message is one child, so the file doesn't have to be loaded
+    
+    Args:
+        grib_path: path of a grib2 file
+        grib_object: the loaded grib file, or None to only load it if the count isn't otherwise known
+    Returns:
+        number of children, and the grib object (None if it didn't have to be loaded)
+    """
+    
+    key = _grib_key(grib_path)
+    count = _raster_cache.children_count(key)
+    if count is None:
+        if grib_object is None and grib_index.one_field_per_message(grib_path):
+            count = len(grib_index.read_index(grib_path))
+        else:
+            if grib_object is None:
+                grib_object = load_grib_file(grib_path)
+            count = grib_object.GetChildrenCount()
+        _raster_cache.put_children_count(key, count)
+        
+    return count, grib_object
+    
+    
+    
+def load_grib_children(grib_path, children):
+    """
+    loads a grib file, or only the messages of some of its children if they are less than SUBSET_FRACTION of the file. The
+    messages are found with the message index of the file (see grib_index) and copied into a temporary grib
+    file which pyEnSim loads instead, so converting 5 members of a 21 member file only loads 5 messages.
+    
+    Args:
+        grib_path: path of a grib2 file
+        children: list of the children that will be used
+    Returns:
+        grib_object: pyEnSim grib object
+        positions: dictionary of the position of each child in grib_object (use grib_object.GetChild(positions[i]))
+        subset_path: path of the temporary grib file that was loaded, or None if the whole file was loaded.
+                     It must be removed with remove_grib_subset() once the children are no longer needed
+    """
+    
+    if grib_index.one_field_per_message(grib_path):
+        messages = grib_index.read_index(grib_path)
+        wanted = [i for i in children if i < len(messages)]
+        
+        #copying most of the file would cost more than it saves
+        wanted_bytes = sum([messages[i][1] for i in set(wanted)])
+        if len(wanted) == len(children) and wanted_bytes <= SUBSET_FRACTION * os.path.getsize(grib_path):
+            subset_path = grib_index.extract_messages(grib_path, wanted)
+            try:
+                grib_object = load_grib_file(subset_path)
+            except:
+                remove_grib_subset(subset_path)
+                raise
+            return grib_object, dict([(i, k) for k, i in enumerate(wanted)]), subset_path
+            
+    return load_grib_file(grib_path), dict([(i, i) for i in children]), None
+    
+    
+    
+def remove_grib_subset(subset_path):
+    """
+    removes a temporary grib file made by load_grib_children()
+    """
+    
+    if subset_path is not None and os.path.exists(subset_path):
+        try:
+            os.remove(subset_path)
+        except OSError: #still open on windows, it is in the temp folder anyway
+            pass
+            
+            
+            
+def read_children(grib_path, children, grib_object = None, positions = None, rasters = None, crop = (None, None)):
+    """
+    decodes children of a grib file into a single array, one row per child. For the EC datamart ensemble
+    files each child is an ensemble member, so this holds the whole ensemble for one timestep.
+    Decoded children are kept in the decoded raster cache (see RasterCache), so a grib file that is used
+    again (ie. as the previous timestep of the next file) isn't loaded or decoded again. Otherwise only the
+    messages of the children that aren't cached are loaded (see load_grib_children())
+    
+    Args:
+        grib_path: path of a grib2 file
+        children: list of the children to decode
+        grib_object: the loaded grib file, or None to load it if a child isn't in the cache
+        positions: position of each child in grib_object, see load_grib_children(). Defaults to the child numbers
+        rasters: optional dictionary that the pyEnSim rasters of the decoded children are added to, by child
+        crop: (key, nodes) of the nodes to decode, see grib_crop(). (None, None) decodes every node
+    Returns:
+        numpy array of shape (len(children), node count), in node order
+    """
+    
+    crop_key, nodes = crop
+    key = _grib_key(grib_path)
+    rows = [_raster_cache.get(key + (i, crop_key)) for i in children]
+    missing = [i for i, values in zip(children, rows) if values is None]
+    
+    subset_path = None
+    if len(missing) > 0 and grib_object is None:
+        grib_object, positions, subset_path = load_grib_children(grib_path, missing)
+    if positions is None:
+        positions = dict([(i, i) for i in children])
+        
+    try:
+        for k, i in enumerate(children):
+            if rows[k] is None:
+                raster = grib_object.GetChild(positions[i])
+                raster.InitAttributes()
+                rows[k] = raster_to_array(raster, nodes)
+                _raster_cache.put(key + (i, crop_key), rows[k])
+                if rasters is not None:
+                    rasters[i] = raster
+    finally:
+        remove_grib_subset(subset_path)
+        
+    if len(rows) == 0:
+        return numpy.zeros((0, 0))
+        
+    return numpy.vstack(rows)
+    
+    
+    
+def grib_ensemble_frames(grib_path, template_r2c_object, children = [0], convert_mult = False, convert_add = False, grib_previous = False, regrid_weights = None, set_template = True, conversion_cache = None):
+    """
+    converts children of a grib file onto the template grid, decoding the grib file (and the previous
+    grib file, for de-accumulation) only once for all the children, or not at all if they are in the
+    decoded raster cache (see RasterCache). Only the messages of the requested children are loaded
+    (see load_grib_children()), and with regrid weights only the grib points around the template are decoded (see grib_crop()).
+    All the children are de-accumulated and converted together as one (member, node) array, and with regrid weights they are all regridded in a
+    single sparse product. With a conversion cache, children converted before are read from the cache
+    instead and only the others are converted (and added to the cache).
+    
+    This is a generator, each child's frame is yielded in turn so the caller can write it out while the
+    template object holds that child's values.
+    
+    Args:
+        grib_path: full path to where the grib file is stored
+        template_r2c_object: r2c template object
+        children: list of the children of the grib file to convert, [0] for a grib file without ensemble children.
+                  Children that the grib file doesn't have are skipped
+        convert_mult: see grib_fastappend_r2c
+        convert_add: see grib_fastappend_r2c
+        grib_previous: see grib_fastappend_r2c
+        regrid_weights: see grib_fastappend_r2c
+        set_template: whether the node values of template_r2c_object must be set for each child. Only regridding
+                      with regrid_weights can skip this
+        conversion_cache: see grib_fastappend_r2c
+        
+    Returns:
+        generator of (child, numpy array) pairs; the values on the template grid in node order, or None if
+        pyEnSim did the interpolation (the values are then only in template_r2c_object)
+    """
+    
+    childrenCount = grib_children_count(grib_path)[0]
+    children = [i for i in children if i < childrenCount or i == 0]
+    
+    #the cache needs the template file to key the frames, so it only works with templates from get_template()
+    r2c_template_path = template_path(template_r2c_object)
+    if conversion_cache is None or r2c_template_path is None:
+        for frame in _convert_children(grib_path, template_r2c_object, children, convert_mult, convert_add, grib_previous,
+                                       regrid_weights, set_template):
+            yield frame
+        return
+        
+    method = "pyEnSim" if regrid_weights is None else "weights"
+    keys = {}
+    cached = {}
+    for i in children:
+        keys[i] = conversion_cache.key(grib_path, i, r2c_template_path, convert_add, convert_mult, grib_previous, method)
+        values = conversion_cache.get(keys[i])
+        if values is not None:
+            cached[i] = values
+            
+    converted = _convert_children(grib_path, template_r2c_object, [i for i in children if i not in cached], convert_mult, convert_add,
+                                  grib_previous, regrid_weights, set_template)
+    try:
+        for i in children:
+            if i in cached:
+                if set_template:
+                    array_to_raster(cached[i], template_r2c_object)
+                yield i, cached[i]
+                continue
+                
+            i, template_values = converted.next()
+            if template_values is None:
+                template_values = raster_to_array(template_r2c_object)
+            conversion_cache.put(keys[i], template_values)
+            yield i, template_values
+    finally:
+        converted.close()
+        
+        
+        
+def _convert_children(grib_path, template_r2c_object, children, convert_mult, convert_add, grib_previous, regrid_weights, set_template):
+    """
+    converts children of a grib file onto the template grid, see grib_ensemble_frames(). The children
+    must all be in the grib file
+    """
+    
+    if len(children) == 0:
+        return
+        
+    #with regrid weights only the grib points around the template are decoded and converted, the rest of the field
+    #isn't used. The weights are cropped the same way, unless they use points outside the crop.
+    #pyEnSim interpolates from the whole raster, so every node is converted for it
+    crop = (None, None)
+    if regrid_weights is not None:
+        crop = grib_crop(grib_path, template_r2c_object)
+        if crop[0] is not None:
+            cropped_weights = grib_regrid.crop_weights(regrid_weights, crop[0], crop[1])
+            if cropped_weights is None:
+                crop = (None, None)
+            else:
+                regrid_weights = cropped_weights
+            
+    #pyEnSim needs the grib rasters to do the interpolation, the regrid weights only need their values
+    grib_object = None
+    positions = None
+    subset_path = None
+    if regrid_weights is None:
+        grib_object, positions, subset_path = load_grib_children(grib_path, children)
+        
+    try:
+        rasters = {}
+        values = read_children(grib_path, children, grib_object, positions, rasters, crop)
+        
+        #subtract the previous grib file if given, it is only loaded once for all the children (if it isn't cached)
+        previous_values = None
+        if grib_previous is not False:
+            previous_values = read_children(grib_previous, children, crop = crop)
+            
+        #de-accumulate and apply unit conversions to every child at once, only touch the nodes if something changes
+        changed = previous_values is not None or convert_add != False or convert_mult != False
+        if changed:
+            values = convert_array(values, convert_mult, convert_add, previous = previous_values)
+            
+        if regrid_weights is not None:
+            template_values = numpy.asarray(regrid_weights.dot(values.T)).T
+            for k, i in enumerate(children):
+                if set_template:
+                    array_to_raster(template_values[k], template_r2c_object)
+                yield i, template_values[k]
+                
+        else:
+            for k, i in enumerate(children):
+                raster = rasters.get(i)
+                if raster is None: #the values came from the cache
+                    raster = grib_object.GetChild(positions[i])
+                    raster.InitAttributes()
+                map_to_template(raster, values[k] if changed else None, template_r2c_object)
+                yield i, None
+    finally:
+        remove_grib_subset(subset_path)
+    
+    
+    
+def grib_to_arrays(grib_path, template_r2c_object, children = [0], convert_mult = False, convert_add = False, grib_previous = False, regrid_weights = None, conversion_cache = None):
+    """
+    converts children of a grib file onto the template grid and returns the values instead of writing them
+    to an r2c file. This is used when the frames are converted in parallel and written by another process
+    
+    Args:
+        grib_path: full path to where the grib file is stored
+        template_r2c_object: r2c template object
+        children: list of the children of the grib file to convert, [0] for a grib file without ensemble children.
+                  Children that the grib file doesn't have are skipped
+        convert_mult: see grib_fastappend_r2c
+        convert_add: see grib_fastappend_r2c
+        grib_previous: see grib_fastappend_r2c
+        regrid_weights: see grib_fastappend_r2c
+        conversion_cache: see grib_fastappend_r2c
+        
+    Returns:
+        list of (child, numpy array) pairs; the values on the template grid, in node order, for each child converted
+    """
+    
+    template_arrays = []
+    for i, template_values in grib_ensemble_frames(grib_path, template_r2c_object, children, convert_mult, convert_add, grib_previous,
+                                                   regrid_weights, set_template = False, conversion_cache = conversion_cache):
+        if template_values is None:
+            template_values = raster_to_array(template_r2c_object)
+        template_arrays.append((i, template_values))
+        
+    return template_arrays
+    
+    
+    
+def grib_save_r2c(grib_path, r2c_template_path, r2cTargetFilePath, timestamp = datetime.datetime.now(), convert_mult = False, convert_add = False, ensemble = False, regrid_weights = None, conversion_cache = None):
     """
     converts a single grib file to an r2c file. A template file must be given the grib data
     is interpolated onto the template grid (not sure what interpolation technique is used but
@@ -63,19 +709,17 @@ def grib_save_r2c(grib_path, r2c_template_path, r2cTargetFilePath, timestamp = d
         ensemble: either 'False' (python defined, not a string), or a integer. If not False, then the same number of r2c files will be created from the 'children' of the grib file. If the integer is greater than
                     the number of children, the number of children will be used instead. This is used for the EC datamart grib files in which each ensemble is a 'child' in the main file (unlike the NOMADS format,
                     where every ensemble has its own separate grib file)
+        regrid_weights: either None, or a sparse weight matrix from grib_regrid.get_weights() that is used instead of the pyEnSim interpolation
+        conversion_cache: see grib_fastappend_r2c
         
     Returns:
         NULL - outputs r2c file(s)
         
     """
-    #get  data from the grib object
-    grib_object = load_grib_file(grib_path)
-    
     #if using the ensemble option (ie. ensembles are in the children of the grib file)
     #then set the number of ensembles, else default to 1
     if ensemble is not False:
-        rasterCount = min(grib_object.GetChildrenCount(),ensemble)
-        raster_iteration = range(1,rasterCount+1) #this ensures the 1st child is ignored, as is done in NOMADS ensembles
+        raster_iteration = range(1,ensemble+1) #this ensures the 1st child is ignored, as is done in NOMADS ensembles
         
         #also get the base name of the r2c file so that we can append an ensemble number to it
         regexp = re.compile("\d\d.r2c")
@@ -87,40 +731,21 @@ def grib_save_r2c(grib_path, r2c_template_path, r2cTargetFilePath, timestamp = d
         raster_iteration = range(0,1)
 
     
-    #get the r2c object and its attributes
-    r2c_object = load_r2c_template(r2c_template_path)
-    cs = r2c_object.GetCoordinateSystem()  
-
+    #get the r2c object, it is only loaded the first time
+    r2c_object = get_template(r2c_template_path)
     
-    for i in raster_iteration:   
+    #set time
+    timeStep = pyEnSim.CEnSimDateTime()
+    timeStep.Set(timestamp.year, timestamp.month, timestamp.day, 0, 0, 0, 0)
+
+    #the grib file is decoded once for all the children (members beyond the number of children are skipped)
+    for i, template_values in grib_ensemble_frames(grib_path, r2c_object, raster_iteration, convert_mult, convert_add, regrid_weights = regrid_weights,
+                                                   conversion_cache = conversion_cache):
         if ensemble is not False:   
             r2cTargetFilePath = r2cTargetFilePathbase + "%02d" % (i) + ".r2c" #append ensemble num and suffix
         else:
             pass
             
-        firstRaster = grib_object.GetChild(i)
-        firstRaster.InitAttributes()
-        
-        #apply unit converstions
-        if convert_add != False:
-            #print firstRaster.GetNodeCount()
-            for k in range(0,firstRaster.GetNodeCount()):
-                #print firstRaster.GetNodeValue(k)
-                firstRaster.SetNodeValue(k, firstRaster.GetNodeValue(k) + convert_add)
-                
-        if convert_mult != False:
-            for k in range(0,firstRaster.GetNodeCount()):
-                firstRaster.SetNodeValue(k, firstRaster.GetNodeValue(k) * convert_mult)
-        
-        #convert grib object to r2c attributes
-        firstRaster.ConvertToCoordinateSystem(cs)
-        
-        #set time
-        timeStep = pyEnSim.CEnSimDateTime()
-        timeStep.Set(timestamp.year, timestamp.month, timestamp.day, 0, 0, 0, 0)
-        
-        #copy data over
-        r2c_object.MapObjectDispatch(firstRaster)
         r2c_object.SetCurrentFrameCounter(1)
         r2c_object.SetCurrentStep(1)
         r2c_object.SetCurrentStepTime(timeStep)
@@ -130,7 +755,40 @@ def grib_save_r2c(grib_path, r2c_template_path, r2cTargetFilePath, timestamp = d
         
     
    
-def grib_fastappend_r2c(grib_path, template_r2c_object, r2cTargetFilePath, frameindex, frametime, convert_mult = False, convert_add = False, ensemble = False, grib_previous = False):
+def save_r2c_frame(values, r2c_template_path, r2cTargetFilePath, frameindex, frametime):
+    """
+    creates an r2c file with pyEnSim, holding a single frame of values that were already converted onto the
+    template grid (ie. by grib_to_arrays()). The file is written exactly as grib_save_r2c() writes it, so the
+    header and the first frame of the forecast files still come from pyEnSim
+    
+    Args:
+        values: numpy array of the frame, in node order (see raster_to_array())
+        r2c_template_path: full path to where the r2c template is stored
+        r2cTargetFilePath: full path to where the new r2c should be created
+        frameindex: integer for what to label the frame index
+        frametime: datetime object - used to datestamp the frame
+        
+    Returns:
+        NULL - outputs the r2c file
+    """
+    
+    r2c_object = get_template(r2c_template_path)
+    array_to_raster(numpy.asarray(values).ravel(), r2c_object)
+    
+    #set time
+    timeStep = pyEnSim.CEnSimDateTime()
+    timeStep.Set(frametime.year, frametime.month, frametime.day, frametime.hour, 0, 0, 0)
+    
+    r2c_object.SetCurrentFrameCounter(frameindex)
+    r2c_object.SetCurrentStep(frameindex)
+    r2c_object.SetCurrentStepTime(timeStep)
+    
+    #Save to file
+    r2c_object.SaveToMultiFrameASCIIFile(r2cTargetFilePath,0)
+    
+    
+    
+def grib_fastappend_r2c(grib_path, template_r2c_object, r2cTargetFilePath, frameindex, frametime, convert_mult = False, convert_add = False, ensemble = False, grib_previous = False, regrid_weights = None, writers = None, conversion_cache = None):
     """
     converts a single grib file and appends to an r2c file. A template file must be given so the grib data
     is interpolated onto the template grid (not sure what interpolation technique is used but
@@ -152,65 +810,47 @@ def grib_fastappend_r2c(grib_path, template_r2c_object, r2cTargetFilePath, frame
                     where every ensemble has its own separate grib file)
         grib_previous: either 'False' (python defind, not a string), or a path to a preceding grib file. If that path is given, this grib file will be loaded and subtracted from the target grib file. This is used
                         for accumulated precipitation. (ie. grib2 - grib1 = the precipitation that fell between the time2 and time1)
+        regrid_weights: either None, or a sparse weight matrix from grib_regrid.get_weights() that is used instead of the pyEnSim interpolation
+        writers: either None, or a dictionary of r2c_io.R2CWriter sessions keyed by r2c path. If given, the frames are added to the
+                 session of the target file (and written when the session is flushed/closed) instead of being appended by pyEnSim
+        conversion_cache: either None, or a conversion_cache.ConversionCache. Frames converted before (from the same grib messages,
+                          template and unit conversion) are then read from the cache instead of being converted again.
+                          The template must come from get_template()
 
     Returns:
         NULL
     """
     
-    #get data from the grib object
-    grib_object = load_grib_file(grib_path)
-    
     if ensemble is not False:
-        rasterCount = min(grib_object.GetChildrenCount(),ensemble)
-        raster_iteration = range(1,rasterCount+1) #this ensures the 1st child is ignored, as is done in NOMADS ensembles
+        raster_iteration = range(1,ensemble+1) #this ensures the 1st child is ignored, as is done in NOMADS ensembles
         
     else:
         raster_iteration = range(0,1)
     r2cTargetFilePathbase = re.split("\d\d.r2c",r2cTargetFilePath)[0] #remove the last digits and suffix from the file name, to be added later
+    
+    #convert time into pyEnSim format
+    timeStep = pyEnSim.CEnSimDateTime()
+    timeStep.Set(frametime.year, frametime.month, frametime.day, frametime.hour, 0, 0, 0)
+    
+    #the grib file and the previous grib file are each decoded once for all the children, and all the
+    #children are de-accumulated/converted together (members beyond the number of children are skipped)
+    frames = grib_ensemble_frames(grib_path, template_r2c_object, raster_iteration, convert_mult, convert_add, grib_previous,
+                                  regrid_weights, set_template = writers is None, conversion_cache = conversion_cache)
         
-    for i in raster_iteration:
+    for i, template_values in frames:
         #rename r2c file if ensemble, otherwise keep original name
         if ensemble is not False:
             r2cTargetFilePath = r2cTargetFilePathbase + "%02d" % (i) + ".r2c"
         else:
             pass
-
-        #load the grib object
-        firstRaster = grib_object.GetChild(i)
-        firstRaster.InitAttributes()
-        finalRaster = firstRaster
-        
-        #subtract the previous grib file from the target grib file, if specified in function arguments
-        if grib_previous is not False:
-            grib_previous_object = load_grib_file(grib_previous)
-            previousRaster = grib_previous_object.GetChild(i)
-            previousRaster.InitAttributes()
-            
-            for k in range(0, firstRaster.GetNodeCount()+1):
-                rainvalue = firstRaster.GetNodeValue(k) - previousRaster.GetNodeValue(k)
-                if rainvalue < 0:
-                    rainvalue = 0
-                finalRaster.SetNodeValue(k, rainvalue)
-                
-        #apply unit converstions
-        if convert_add != False:
-            for k in range(0,finalRaster.GetNodeCount()):
-                finalRaster.SetNodeValue(k, (finalRaster.GetNodeValue(k) + convert_add))
-                
-        if convert_mult != False:
-            for k in range(0,finalRaster.GetNodeCount()):
-                finalRaster.SetNodeValue(k, finalRaster.GetNodeValue(k) * convert_mult)
-        
-        #convert grib object to r2c attributes
-        cs = template_r2c_object.GetCoordinateSystem() 
-        finalRaster.ConvertToCoordinateSystem(cs)
         
-        #convert time into pyEnSim format
-        timeStep = pyEnSim.CEnSimDateTime()
-        timeStep.Set(frametime.year, frametime.month, frametime.day, frametime.hour, 0, 0, 0)
-
-        #copy data over
-        template_r2c_object.MapObjectDispatch(finalRaster)
+        #add to the writer session of the target file, if batching the appends
+        if writers is not None:
+            if template_values is None:
+                template_values = raster_to_array(template_r2c_object)
+            r2c_io.get_writer(writers, r2cTargetFilePath).add_frame(frameindex, frametime, template_values)
+            continue
+            
         template_r2c_object.SetCurrentFrameCounter(frameindex)
         template_r2c_object.SetCurrentStep(frameindex)
         template_r2c_object.SetCurrentStepTime(timeStep)
@@ -222,7 +862,8 @@ def grib_fastappend_r2c(grib_path, template_r2c_object, r2cTargetFilePath, frame
 
 def r2c_EndFrameData(r2cTargetFilePath):
     """
-    Given a path to an ascii r2c file, it returns the last frame number and frame time
+    Given a path to an ascii r2c file, it returns the last frame number and frame time.
+    Only the end of the file is read (see r2c_io.last_frame), so this stays fast as the hindcast files grow
     
     Args:
         r2cTargetFilePath: full path to an ascii r2c
@@ -232,18 +873,6 @@ def r2c_EndFrameData(r2cTargetFilePath):
         endtimeframe: a datetime object denoting the timestamp of the last frame
     """
     
-    #get the frame and time data from the target r2c file
-    match = re.findall(r':Frame\s+(\d+)\s+\d+\s+(.+)', open(r2cTargetFilePath).read())
-    match = match[len(match)-1]
-    lastindexframe = int(match[0])
-    lasttimeframe = match[1]
-    
-    #get the timestamp from the last frame, try multiple formats
-    try:
-        endtimeframe = datetime.datetime.strptime(lasttimeframe, '"%Y/%m/%d %H:%M"')
-    except:
-        endtimeframe = datetime.datetime.strptime(lasttimeframe, '"%Y/%m/%d %H:%M:00.000"')
+    lastindexframe, laststep, endtimeframe = r2c_io.last_frame(r2cTargetFilePath)
         
     return lastindexframe, endtimeframe
-    
-
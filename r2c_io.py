@@ -0,0 +1,734 @@
+"""
+Pure python/numpy reader and writer for multi-frame ascii r2c files.
+
+pyEnSim has to parse a whole r2c file to get at any of its frames. This module reads the header
+once, builds an index of where every :Frame/:EndFrame block starts and ends in the file (the file
+is memory mapped, so the frame data isn't read while the index is built), and then only parses the
+frames that are asked for.
+
+Frame data is returned as numpy arrays of shape (yCount, xCount). Row 0 is the first line of the
+frame in the file, which is the row at yOrigin.
+"""
+
+#import standard modules
+import os
+import re
+import mmap
+import datetime
+
+#import scientific modules
+import numpy
+
+
+#format used to write the timestamp of each frame, unless the file has frames to take it from (see FrameLayout)
+FRAME_TIME_FORMAT = "%Y/%m/%d %H:%M"
+
+#format used to write each value in a frame, unless the file has frames to take it from (see FrameLayout)
+VALUE_FORMAT = "%.3f"
+
+frame_pattern = re.compile(r':Frame\s+(\d+)\s+(\d+)\s+"([^"]+)"')
+frame_line_pattern = re.compile(r'^:Frame(\s+)(\d+)(\s+)(\d+)(\s+)"([^"]*)"(.*)$')
+frame_time_pattern = re.compile(r'^\d{4}/\d{2}/\d{2} \d{2}:\d{2}(:\d{2})?(\.\d+)?$')
+value_pattern = re.compile(r'\S+')
+exponent_pattern = re.compile(r'([eE][+-]?)(\d+)')
+
+
+
+def parse_frame_time(timestring):
+    """
+    converts the timestamp of a :Frame line to a datetime object, both formats found in
+    our r2c files are accepted ("YYYY/MM/DD HH:MM" and "YYYY/MM/DD HH:MM:00.000")
+
+    Args:
+        timestring: timestamp without the quotes
+    Returns:
+        datetime object
+    """
+
+    timestring = timestring.strip().strip('"')
+    try:
+        return datetime.datetime.strptime(timestring, "%Y/%m/%d %H:%M")
+    except ValueError:
+        return datetime.datetime.strptime(timestring, "%Y/%m/%d %H:%M:%S.%f")
+
+
+
+def parse_frame_line(line):
+    """
+    parses a ':Frame  index  step  "time"' line
+
+    Returns:
+        frame index (integer), step (integer) and frame time (datetime)
+    """
+
+    m = frame_pattern.search(line)
+    if m is None:
+        raise ValueError("Not an r2c frame line: " + line)
+
+    return int(m.group(1)), int(m.group(2)), parse_frame_time(m.group(3))
+
+
+
+def read_header(r2c_path):
+    """
+    reads the header of an r2c file
+
+    Args:
+        r2c_path: path to an ascii r2c file
+    Returns:
+        header_lines: list of the header lines (including :EndHeader) without line endings
+        attributes: dictionary of the header keywords, in lower case without the ':' (ie. 'xcount'), and their value
+    """
+
+    header_lines = []
+    attributes = {}
+
+    r2c_file = open(r2c_path, 'rb')
+    try:
+        for line in r2c_file:
+            line = line.rstrip('\r\n')
+            header_lines.append(line)
+
+            tokens = line.split(None, 1)
+            if len(tokens) == 0 or not tokens[0].startswith(':'):
+                continue
+            if tokens[0].lower() == ':endheader':
+                break
+            if len(tokens) > 1:
+                attributes[tokens[0][1:].lower()] = tokens[1].strip()
+    finally:
+        r2c_file.close()
+
+    return header_lines, attributes
+
+
+
+def last_frame(r2c_path, chunk_size = 65536):
+    """
+    gets the index and time of the last frame of an r2c file by reading backwards from the end of
+    the file, so only the last frame is read no matter how large the file is
+
+    Args:
+        r2c_path: path to an ascii r2c file
+        chunk_size: number of bytes read at a time
+    Returns:
+        frame index (integer), step (integer) and frame time (datetime) of the last :Frame line
+    """
+
+    r2c_file = open(r2c_path, 'rb')
+    try:
+        r2c_file.seek(0, os.SEEK_END)
+        offset = r2c_file.tell()
+        tail = ''
+
+        while offset > 0:
+            read_size = min(chunk_size, offset)
+            offset = offset - read_size
+            r2c_file.seek(offset)
+            tail = r2c_file.read(read_size) + tail
+
+            position = tail.rfind(':Frame')
+            if position != -1:
+                line_end = tail.find('\n', position)
+                if line_end == -1:
+                    line_end = len(tail)
+                return parse_frame_line(tail[position:line_end])
+    finally:
+        r2c_file.close()
+
+    raise ValueError("No frames found in " + r2c_path)
+
+
+
+class R2CFile(object):
+    """
+    Read access to a multi-frame ascii r2c file through an index of its frames.
+
+    Usage:
+        r2c = r2c_io.R2CFile(path)
+        last = r2c.read_frame(-1)
+        times, data = r2c.read_frames(start_time, end_time)
+        r2c.close()
+
+    Attributes:
+        header_lines: list of the header lines, see read_header()
+        attributes: dictionary of header keywords, see read_header()
+        xcount, ycount: grid dimensions
+        frames: list of (frame index, step, frame time, data start offset, data end offset), in file order
+    """
+
+    def __init__(self, r2c_path):
+        self.path = r2c_path
+        self.header_lines, self.attributes = read_header(r2c_path)
+        self.xcount = int(self.attributes["xcount"])
+        self.ycount = int(self.attributes["ycount"])
+
+        self._file = open(r2c_path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access = mmap.ACCESS_READ)
+        self.frames = self._build_index()
+
+
+    def _build_index(self):
+        """
+        finds the byte offsets of every frame, only the :Frame lines are parsed
+        """
+
+        frames = []
+        mm = self._map
+        position = mm.find(':Frame')
+        while position != -1:
+            line_end = mm.find('\n', position)
+            end = mm.find(':EndFrame', line_end)
+            if line_end == -1 or end == -1: #incomplete last frame (ie. the file is being written)
+                break
+
+            index, step, frame_time = parse_frame_line(mm[position:line_end])
+            frames.append((index, step, frame_time, line_end + 1, end))
+            position = mm.find(':Frame', end + len(':EndFrame'))
+
+        return frames
+
+
+    def __len__(self):
+        return len(self.frames)
+
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+    def frame_times(self):
+        """
+        Returns:
+            list of the datetime of each frame
+        """
+        return [frame[2] for frame in self.frames]
+
+
+    def read_frame(self, n):
+        """
+        reads a single frame
+
+        Args:
+            n: position of the frame in the file (not the frame index written in the file), negative values count from the end
+        Returns:
+            numpy array of shape (ycount, xcount)
+        """
+
+        start, end = self.frames[n][3:5]
+        values = numpy.fromstring(self._map[start:end], dtype = numpy.float64, sep = ' ')
+        if values.size != self.xcount * self.ycount:
+            raise ValueError("Frame " + str(self.frames[n][0]) + " in " + self.path + " has " + str(values.size) +
+                             " values, expected " + str(self.xcount * self.ycount))
+
+        return values.reshape(self.ycount, self.xcount)
+
+
+    def read_frames(self, start_time = None, end_time = None):
+        """
+        reads all the frames with a timestamp between start_time and end_time (inclusive)
+
+        Args:
+            start_time: datetime or None (from the first frame)
+            end_time: datetime or None (to the last frame)
+        Returns:
+            times: list of the datetime of each frame read
+            data: numpy array of shape (number of frames, ycount, xcount)
+        """
+
+        selected = [n for n, frame in enumerate(self.frames)
+                    if (start_time is None or frame[2] >= start_time) and (end_time is None or frame[2] <= end_time)]
+
+        data = numpy.empty((len(selected), self.ycount, self.xcount))
+        for k, n in enumerate(selected):
+            data[k] = self.read_frame(n)
+
+        return [self.frames[n][2] for n in selected], data
+
+
+
+def _align(text, width):
+    #right aligns text in width characters, with at least one space before it
+    return " " * max(1, width - len(text)) + text
+
+
+
+class FrameLayout(object):
+    """
+    How the frames of an r2c file are written: the spacing of the :Frame line, the format of its timestamp and
+    the format and spacing of the values. Frames added to a file that already has frames (ie. written by
+    pyEnSim's SaveToMultiFrameASCIIFile) are written the way its first frame is, see frame_layout(), so the
+    appended frames are laid out exactly like the frames pyEnSim writes to that file.
+
+    The frame index, the step and the values are each written either after a fixed whitespace (a string, ie. " ")
+    or right aligned in a number of characters (an integer), with at least one space before them.
+
+    Args:
+        index_field: whitespace or width of the frame index, after ':Frame'
+        step_field: whitespace or width of the step
+        time_separator: whitespace between the step and the quoted timestamp
+        time_format: strftime format of the timestamp (ie. "%Y/%m/%d %H:%M:%S.000")
+        frame_suffix: text after the quoted timestamp
+        value_format: format of each value, without a width (ie. "%.3f")
+        value_field: whitespace between the values or width of each value
+        line_prefix: text before the first value of each line, when the values are separated by whitespace
+        line_suffix: text after the last value of each line
+        exponent_digits: either None, or the number of digits every exponent is written with (ie. 3 for "1.0e+000")
+        end_frame: :EndFrame line
+        newline: line ending
+    """
+
+    def __init__(self, index_field = 9, step_field = 9, time_separator = " ", time_format = FRAME_TIME_FORMAT, frame_suffix = "",
+                 value_format = VALUE_FORMAT, value_field = " ", line_prefix = "", line_suffix = "", exponent_digits = None,
+                 end_frame = ":EndFrame", newline = "\n"):
+        self.index_field = index_field
+        self.step_field = step_field
+        self.time_separator = time_separator
+        self.time_format = time_format
+        self.frame_suffix = frame_suffix
+        self.value_format = value_format
+        self.value_field = value_field
+        self.line_prefix = line_prefix
+        self.line_suffix = line_suffix
+        self.exponent_digits = exponent_digits
+        self.end_frame = end_frame
+        self.newline = newline
+
+
+    def _field(self, field, number):
+        if isinstance(field, int):
+            return _align(str(number), field)
+        return field + str(number)
+
+
+    def _exponent(self, text):
+        return exponent_pattern.sub(lambda m: m.group(1) + m.group(2).lstrip("0").rjust(self.exponent_digits, "0"), text)
+
+
+    def format_row(self, row):
+        """
+        formats the values of one line of a frame, without the line ending
+        """
+
+        #the whole row is formatted at once when the values can't be wider than their field
+        if self.exponent_digits is None:
+            if isinstance(self.value_field, int):
+                line = ("%" + str(self.value_field) + self.value_format[1:]) * len(row) % tuple(row)
+                if len(line) == self.value_field * len(row) and line[::self.value_field].strip() == "":
+                    return line + self.line_suffix
+            else:
+                return self.line_prefix + self.value_field.join([self.value_format] * len(row)) % tuple(row) + self.line_suffix
+
+        texts = [self.value_format % value for value in row]
+        if self.exponent_digits is not None:
+            texts = [self._exponent(text) for text in texts]
+        if isinstance(self.value_field, int):
+            return "".join([_align(text, self.value_field) for text in texts]) + self.line_suffix
+        return self.line_prefix + self.value_field.join(texts) + self.line_suffix
+
+
+    def format_frame(self, frame_index, frame_time, values):
+        """
+        formats a single frame as text, ready to be written to an r2c file
+
+        Args:
+            frame_index: integer, written as both the frame and the step number
+            frame_time: datetime of the frame
+            values: numpy array of shape (ycount, xcount), row 0 is written first
+        Returns:
+            string containing the :Frame line, the data and the :EndFrame line
+        """
+
+        lines = [":Frame" + self._field(self.index_field, frame_index) + self._field(self.step_field, frame_index) + self.time_separator +
+                 '"' + frame_time.strftime(self.time_format) + '"' + self.frame_suffix]
+        lines.extend([self.format_row(row) for row in numpy.asarray(values).tolist()])
+        lines.append(self.end_frame)
+
+        return self.newline.join(lines) + self.newline
+
+
+
+def _value_layout(line):
+    """
+    gets the value format and spacing of a line of frame data, see frame_layout()
+    """
+
+    tokens = list(value_pattern.finditer(line))
+    if len(tokens) == 0:
+        return {}
+
+    #the values are written with as many decimals as the most precise value of the line
+    precision = 0
+    exponent = None
+    for token in tokens:
+        text = token.group()
+        mantissa = re.split("[eE]", text)[0]
+        if "." in mantissa:
+            precision = max(precision, len(mantissa) - mantissa.index(".") - 1)
+        m = exponent_pattern.search(text)
+        if m is not None and exponent is None:
+            exponent = m
+    layout = {"value_format": "%." + str(precision) + ("f" if exponent is None else exponent.group(1)[0]),
+              "exponent_digits": None if exponent is None else len(exponent.group(2)),
+              "line_suffix": line[tokens[-1].end():]}
+
+    #values that all end the same number of characters apart are aligned, otherwise they are separated by whitespace
+    widths = set([tokens[0].end()] + [tokens[k].end() - tokens[k - 1].end() for k in range(1, len(tokens))])
+    if len(tokens) > 1 and len(widths) == 1:
+        layout["value_field"] = widths.pop()
+    else:
+        layout["line_prefix"] = line[:tokens[0].start()]
+        if len(tokens) > 1:
+            layout["value_field"] = line[tokens[0].end():tokens[1].start()]
+
+    return layout
+
+
+
+def frame_layout(r2c_path, default = None):
+    """
+    gets the layout of the frames of an r2c file from its first frame, so that frames can be added the way the
+    file was written (ie. by pyEnSim). The frame index and the step are taken as right aligned on the :Frame
+    line, and the values are written with the decimals, exponent and spacing of the first line of the frame.
+
+    Args:
+        r2c_path: path of an existing r2c file
+        default: returned if the file has no complete frame yet
+    Returns:
+        FrameLayout
+    """
+
+    frame_line = None
+    first_line = None
+    end_line = None
+
+    r2c_file = open(r2c_path, 'rb')
+    try:
+        for line in r2c_file:
+            if frame_line is None:
+                if line.startswith(':Frame'):
+                    frame_line = line
+            elif line.startswith(':EndFrame'):
+                end_line = line
+                break
+            elif first_line is None:
+                first_line = line
+    finally:
+        r2c_file.close()
+
+    m = None
+    if frame_line is not None and end_line is not None:
+        m = frame_line_pattern.match(frame_line.rstrip('\r\n'))
+    if m is None:
+        return default
+
+    layout = {"index_field": len(m.group(1)) + len(m.group(2)),
+              "step_field": len(m.group(3)) + len(m.group(4)),
+              "time_separator": m.group(5),
+              "frame_suffix": m.group(7),
+              "end_frame": end_line.rstrip('\r\n'),
+              "newline": "\r\n" if frame_line.endswith("\r\n") else "\n"}
+
+    time_match = frame_time_pattern.match(m.group(6))
+    if time_match is not None:
+        layout["time_format"] = "%Y/%m/%d %H:%M"
+        if time_match.group(1) is not None:
+            layout["time_format"] += ":%S"
+        if time_match.group(2) is not None: #frame times are whole seconds
+            layout["time_format"] += "." + "0" * (len(time_match.group(2)) - 1)
+
+    if first_line is not None:
+        layout.update(_value_layout(first_line.rstrip('\r\n')))
+
+    return FrameLayout(**layout)
+
+
+
+def format_frame(frame_index, frame_time, values, layout = None):
+    """
+    formats a single frame as text, ready to be written to an r2c file
+
+    Args:
+        frame_index: integer, written as both the frame and the step number
+        frame_time: datetime of the frame
+        values: numpy array of shape (ycount, xcount), row 0 is written first
+        layout: either None for the default layout, or a FrameLayout
+    Returns:
+        string containing the :Frame line, the data and the :EndFrame line
+    """
+
+    if layout is None:
+        layout = FrameLayout()
+    return layout.format_frame(frame_index, frame_time, values)
+
+
+
+def write_r2c(r2c_path, header_lines, frames, layout = None):
+    """
+    writes a new multi-frame r2c file
+
+    Args:
+        r2c_path: path of the r2c file to create (it is overwritten if it exists)
+        header_lines: list of header lines, typically from read_header() of a template
+        frames: iterable of (frame index, frame time, numpy array of shape (ycount, xcount))
+        layout: either None for the default layout, or a FrameLayout
+    Returns:
+        NULL - but writes the r2c file
+    """
+
+    if layout is None:
+        layout = FrameLayout()
+
+    r2c_file = open(r2c_path, 'wb')
+    try:
+        r2c_file.write(layout.newline.join(header_lines) + layout.newline)
+        for frame_index, frame_time, values in frames:
+            r2c_file.write(layout.format_frame(frame_index, frame_time, values))
+    finally:
+        r2c_file.close()
+
+
+
+def append_frames(r2c_path, frames, layout = None):
+    """
+    appends frames to the end of an existing r2c file
+
+    Args:
+        r2c_path: path of an existing r2c file
+        frames: iterable of (frame index, frame time, numpy array of shape (ycount, xcount))
+        layout: either None to write the frames like the first frame of the file (see frame_layout()), or a FrameLayout
+    Returns:
+        NULL - but appends to the r2c file
+    """
+
+    if layout is None:
+        layout = frame_layout(r2c_path, FrameLayout())
+
+    r2c_file = open(r2c_path, 'ab')
+    try:
+        for frame_index, frame_time, values in frames:
+            r2c_file.write(layout.format_frame(frame_index, frame_time, values))
+    finally:
+        r2c_file.close()
+
+
+
+def truncate_frames(r2c_path, frame_count):
+    """
+    cuts an r2c file back to its header and its first frames, ie. to redo the frames after them
+
+    Args:
+        r2c_path: path of an existing r2c file
+        frame_count: number of frames to keep
+    Returns:
+        NULL - but truncates the r2c file
+    """
+
+    r2c = R2CFile(r2c_path)
+    try:
+        if frame_count >= len(r2c.frames):
+            return
+        if frame_count == 0:
+            end = r2c._map.find(':Frame')
+        else:
+            end = r2c._map.find('\n', r2c.frames[frame_count - 1][4]) + 1
+    finally:
+        r2c.close()
+
+    r2c_file = open(r2c_path, 'r+b')
+    try:
+        r2c_file.truncate(end)
+    finally:
+        r2c_file.close()
+
+
+
+class R2CWriter(object):
+    """
+    Buffered writer session for appending many frames to an existing r2c file. Frames are kept in
+    memory until memory_budget bytes of frame data are held (or the session is closed), then they
+    are formatted and written in one pass with a single open of the file. Frames are written in the
+    order they are added, with the frame index and time they are given, and laid out like the first
+    frame of the file unless a FrameLayout is given (see frame_layout()).
+
+    Usage:
+        writer = r2c_io.R2CWriter(path)
+        writer.add_frame(frame_index, frame_time, values)
+        ...
+        writer.close()
+    """
+
+    def __init__(self, r2c_path, memory_budget = 64 * 1024 * 1024, layout = None):
+        self.path = r2c_path
+        self.memory_budget = memory_budget
+        self.layout = layout
+        self.frames_written = 0
+        self._frames = []
+        self._buffered_bytes = 0
+        self._shape = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def add_frame(self, frame_index, frame_time, values):
+        """
+        adds a frame to the session
+
+        Args:
+            frame_index: integer, written as the frame and step number
+            frame_time: datetime of the frame
+            values: numpy array, either (ycount, xcount) or flat in node order
+        """
+
+        values = numpy.array(values, dtype = numpy.float64)
+        self._frames.append((frame_index, frame_time, values))
+        self._buffered_bytes = self._buffered_bytes + values.nbytes
+
+        if self._buffered_bytes >= self.memory_budget:
+            self.flush()
+
+
+    def flush(self):
+        """
+        writes all the buffered frames to the end of the file
+        """
+
+        if len(self._frames) == 0:
+            return
+
+        #the grid size and the layout are only needed here, by now the file has been created (ie. by pyEnSim)
+        if self._shape is None:
+            attributes = read_header(self.path)[1]
+            self._shape = (int(attributes["ycount"]), int(attributes["xcount"]))
+        if self.layout is None:
+            self.layout = frame_layout(self.path, FrameLayout())
+
+        append_frames(self.path, [(frame_index, frame_time, values.reshape(self._shape))
+                                  for frame_index, frame_time, values in self._frames], self.layout)
+
+        self.frames_written = self.frames_written + len(self._frames)
+        self._frames = []
+        self._buffered_bytes = 0
+
+
+    def close(self):
+        self.flush()
+
+
+
+def get_writer(writers, r2c_path):
+    """
+    gets the writer session of an r2c file from a dictionary of sessions, starting one if required
+
+    Args:
+        writers: dictionary of R2CWriter, keyed by r2c path
+        r2c_path: path of the r2c file
+    Returns:
+        R2CWriter
+    """
+
+    if r2c_path not in writers:
+        writers[r2c_path] = R2CWriter(r2c_path)
+    return writers[r2c_path]
+
+
+
+def close_writers(writers):
+    """
+    closes (ie. writes out) every writer session in a dictionary of sessions
+    """
+
+    for r2c_path in sorted(writers):
+        writers[r2c_path].close()
+
+
+
+class FrameAssembler(object):
+    """
+    Writes frames that arrive in any order (ie. from parallel workers) to their r2c files in frame order.
+    Each frame is held until all the frames before it in its file have been written. A file is only
+    created once its first frame is ready, either with the given header or by a function that writes the
+    new file with its first frame (ie. with pyEnSim); the frames after it are appended in the layout of that
+    first frame. A file without a header is an existing file that the frames are appended to. Each frame can
+    also be passed on, in frame order, to a function that uses the frames as they are written
+    (ie. tempdiff.DifFiles.add_frame).
+
+    Usage:
+        assembler = r2c_io.FrameAssembler(frame_order, headers)
+        assembler.add_frame(r2c_path, frame_index, frame_time, values)
+        ...
+        assembler.close()
+    """
+
+    def __init__(self, frame_order, headers, on_write = None, create = None):
+        """
+        Args:
+            frame_order: dictionary of the frame indices of each r2c file in the order they are written, keyed by r2c path
+            headers: dictionary of the header lines of each r2c file, keyed by r2c path. None appends to the existing file
+            on_write: either None, or a function called with (r2c path, frame index, frame time, values) for each frame, in frame order
+            create: either None, or a function called with (r2c path, frame index, frame time, values) that writes a new
+                    r2c file with its first frame. The header lines of the new files are then not used
+        """
+
+        self.frame_order = frame_order
+        self.headers = headers
+        self.on_write = on_write
+        self.create = create
+        self.writers = {}
+        self._created = set()
+        self._pending = dict([(r2c_path, {}) for r2c_path in frame_order])
+        self._next = dict([(r2c_path, 0) for r2c_path in frame_order])
+
+
+    def add_frame(self, r2c_path, frame_index, frame_time, values):
+        self._pending[r2c_path][frame_index] = (frame_time, values)
+
+        order = self.frame_order[r2c_path]
+        pending = self._pending[r2c_path]
+        while self._next[r2c_path] < len(order) and order[self._next[r2c_path]] in pending:
+            index = order[self._next[r2c_path]]
+            frame_time, values = pending.pop(index)
+
+            new_file = r2c_path not in self.writers and self.headers[r2c_path] is not None
+            if new_file and self.create is not None:
+                self.create(r2c_path, index, frame_time, values)
+                self._created.add(r2c_path)
+                get_writer(self.writers, r2c_path)
+            else:
+                if new_file:
+                    write_r2c(r2c_path, self.headers[r2c_path], [])
+                get_writer(self.writers, r2c_path).add_frame(index, frame_time, values)
+
+            if self.on_write is not None:
+                self.on_write(r2c_path, index, frame_time, values)
+            self._next[r2c_path] = self._next[r2c_path] + 1
+
+
+    def pending_frames(self):
+        """
+        Returns:
+            number of frames waiting for an earlier frame of their file
+        """
+        return sum([len(pending) for pending in self._pending.values()])
+
+
+    def frames_written(self, r2c_path):
+        """
+        Returns:
+            number of frames of an r2c file that have been written out to disk (not just buffered)
+        """
+        if r2c_path not in self.writers:
+            return 0
+        created = 1 if r2c_path in self._created else 0
+        return self.writers[r2c_path].frames_written + created
+
+
+    def close(self):
+        close_writers(self.writers)
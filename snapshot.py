@@ -0,0 +1,223 @@
+"""
+Snapshots of a member's working 'Repo' directory (ie. 'Repo_spinup', 'Repo_hindcast' and 'Repo_forecast').
+
+A snapshot used to be made by removing the previous one and copying the whole 'Repo' again. Here the new snapshot
+is built next to the previous one: files that haven't changed since the previous snapshot (same size and
+modification time) are hard links to the previous snapshot's files, and only the files that have changed are
+copied from 'Repo' (as a reflink, a copy-on-write clone, where the file system supports it). The files of a
+snapshot are never linked to 'Repo' itself, so WATFLOOD writing to its files in 'Repo' doesn't change the snapshot.
+
+Once the new snapshot is complete it is swapped in by renaming, and the previous one is removed; an interrupted
+snapshot leaves the previous one in place.
+
+The workspaces of the forecast runs are made the same way from the member's model directory, with the files
+the runs only read linked to it rather than copied, see link_tree().
+"""
+
+#import standard modules
+import os
+import stat
+import shutil
+
+
+#suffixes of the snapshot being built, and of the previous snapshot while it is being swapped out
+PARTIAL_SUFFIX = ".partial"
+OLD_SUFFIX = ".old"
+
+#seconds two modification times can differ by and still be the same, see _unchanged()
+MTIME_TOLERANCE = 1e-5
+
+#linux ioctl that clones a file (reflink), see _clone()
+FICLONE = 0x40049409
+
+
+
+def _rmtree(path):
+    def onerror(func, path, exc_info):
+        #read only files (ie. on windows) are made writable and removed again
+        os.chmod(path, stat.S_IWRITE)
+        func(path)
+    shutil.rmtree(path, onerror = onerror)
+
+
+
+def _link(source, target):
+    """
+    hard links target to source, returns False if the file system (or python on windows) can't
+    """
+
+    try:
+        if hasattr(os, "link"):
+            os.link(source, target)
+            return True
+
+        import ctypes
+        return bool(ctypes.windll.kernel32.CreateHardLinkW(unicode(target), unicode(source), None))
+    except (OSError, AttributeError, ImportError):
+        return False
+
+
+
+def _clone(source, target):
+    """
+    copies source to target as a reflink (copy-on-write clone), returns False if the file system can't
+    """
+
+    try:
+        import fcntl
+    except ImportError:
+        return False
+
+    source_file = open(source, "rb")
+    try:
+        target_file = open(target, "wb")
+        try:
+            fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+        except IOError:
+            target_file.close()
+            os.remove(target)
+            return False
+        target_file.close()
+    finally:
+        source_file.close()
+
+    shutil.copystat(source, target)
+    return True
+
+
+
+def _unchanged(source, previous):
+    try:
+        source_stat = os.stat(source)
+        previous_stat = os.stat(previous)
+    except OSError:
+        return False
+    #copied modification times are only kept to the microsecond
+    return source_stat.st_size == previous_stat.st_size and abs(source_stat.st_mtime - previous_stat.st_mtime) < MTIME_TOLERANCE
+
+
+
+def _snapshot_directory(source, target, previous, ignore, counts):
+    names = os.listdir(source)
+    ignored = set()
+    if ignore is not None:
+        ignored = ignore(source, names)
+
+    os.mkdir(target)
+    for name in names:
+        if name in ignored:
+            continue
+        source_path = os.path.join(source, name)
+        target_path = os.path.join(target, name)
+        previous_path = os.path.join(previous, name) if previous is not None else None
+
+        if os.path.isdir(source_path):
+            if previous_path is not None and not os.path.isdir(previous_path):
+                previous_path = None
+            _snapshot_directory(source_path, target_path, previous_path, ignore, counts)
+
+        elif previous_path is not None and _unchanged(source_path, previous_path) and _link(previous_path, target_path):
+            counts["linked"] += 1
+
+        else:
+            _copy(source_path, target_path, counts)
+
+    shutil.copystat(source, target)
+
+
+
+def _copy(source, target, counts):
+    if not _clone(source, target):
+        shutil.copy2(source, target)
+    counts["copied"] += 1
+    counts["copied_bytes"] += os.path.getsize(target)
+
+
+
+def _link_directory(source, target, ignore, read_only, counts):
+    names = os.listdir(source)
+    ignored = set()
+    if ignore is not None:
+        ignored = ignore(source, names)
+
+    os.mkdir(target)
+    for name in names:
+        if name in ignored:
+            continue
+        source_path = os.path.join(source, name)
+        target_path = os.path.join(target, name)
+
+        if os.path.isdir(source_path):
+            _link_directory(source_path, target_path, ignore, read_only, counts)
+        elif read_only(source_path) and _link(source_path, target_path):
+            counts["linked"] += 1
+        else:
+            _copy(source_path, target_path, counts)
+
+    shutil.copystat(source, target)
+
+
+
+def take_snapshot(source, target, ignore = None):
+    """
+    makes a snapshot of a directory, replacing the previous snapshot (see module description)
+
+    Args:
+        source: directory to take the snapshot of (ie. the member's 'Repo' directory)
+        target: snapshot directory (ie. the member's 'Repo_hindcast' directory)
+        ignore: either None, or a function that returns the names to leave out, as in shutil.copytree()
+                (ie. shutil.ignore_patterns("wxData", "bin"))
+    Returns:
+        dictionary with the number of files "linked" to the previous snapshot, "copied" and the "copied_bytes"
+    """
+
+    partial = target + PARTIAL_SUFFIX
+    old = target + OLD_SUFFIX
+
+    #clean up after an interrupted snapshot; if it was interrupted while swapping, the previous snapshot is the old one
+    if os.path.exists(partial):
+        _rmtree(partial)
+    if os.path.exists(old):
+        if os.path.exists(target):
+            _rmtree(old)
+        else:
+            os.rename(old, target)
+
+    previous = target if os.path.isdir(target) else None
+    counts = {"linked": 0, "copied": 0, "copied_bytes": 0}
+    try:
+        _snapshot_directory(source, partial, previous, ignore, counts)
+    except:
+        if os.path.exists(partial):
+            _rmtree(partial)
+        raise
+
+    #swap the new snapshot in
+    if previous is not None:
+        os.rename(target, old)
+    os.rename(partial, target)
+    if previous is not None:
+        _rmtree(old)
+
+    return counts
+
+
+
+def link_tree(source, target, read_only, ignore = None):
+    """
+    makes a working copy of a directory (ie. a forecast run's workspace) without copying the files that are only
+    read: they are hard links to the source files. The other files are copied (as a reflink where the file system
+    supports it), so writing to them doesn't change the source
+
+    Args:
+        source: directory to copy
+        target: directory to create, it must not exist
+        read_only: function that returns whether a source file is only read from the copy, so it can be linked
+        ignore: either None, or a function that returns the names to leave out, as in shutil.copytree()
+    Returns:
+        dictionary with the number of files "linked" to the source, "copied" and the "copied_bytes"
+    """
+
+    counts = {"linked": 0, "copied": 0, "copied_bytes": 0}
+    _link_directory(source, target, ignore, read_only, counts)
+    return counts
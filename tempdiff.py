@@ -0,0 +1,292 @@
+"""
+Creates the YYYYMMDD_dif.r2c files (gridded daily temperature range, needed for the modified Hargreaves
+evaporation, :flgevp2 = 4 in the par file) from the *_tem.r2c files. This replaces tempdiff.r.
+
+Each day's frame is the maximum minus the minimum of that day's temperature frames, cell by cell, labelled
+with the date at 00:00. The temperature frames are read one at a time (see r2c_io.R2CFile), so only the
+running maximum and minimum are held in memory whatever the size of the file. An existing dif file is
+updated rather than made again: its last day is dropped (it may have been made before the day was complete)
+and the days from then on are appended. The forecast dif files can also be written while the temperature
+frames are converted, see DifFiles.
+"""
+
+#import standard modules
+import os
+import bisect
+import datetime
+import numpy
+
+#import custom modules
+import r2c_io
+
+
+#layout of the frames of a dif file, written exactly as tempdiff.r wrote them:
+#:Frame  1   1   "2016/01/01 00:00", then the values with one decimal separated by a space. R writes text
+#files with the platform's line ending (CRLF on windows), and so do these
+DIF_LAYOUT = r2c_io.FrameLayout(index_field = "  ", step_field = "   ", time_separator = "   ", value_format = "%.1f",
+                                newline = os.linesep)
+
+
+
+class DailyRange(object):
+    """
+    Running daily maximum and minimum of gridded temperature frames. The frames must be added in time order;
+    each day's range is returned as soon as the first frame of the next day is added.
+
+    Usage:
+        daily_range = tempdiff.DailyRange()
+        for frame_time, values in frames:
+            day = daily_range.add(frame_time, values)
+            if day is not None:
+                day_time, difference = day
+        day = daily_range.finish()
+    """
+
+    def __init__(self):
+        self.day = None
+        self.maximum = None
+        self.minimum = None
+
+
+    def add(self, frame_time, values):
+        """
+        adds a temperature frame
+
+        Args:
+            frame_time: datetime of the frame
+            values: numpy array of the frame values
+        Returns:
+            (day, numpy array of max - min) of the previous day if this frame starts a new day, otherwise None
+        """
+
+        day = datetime.datetime(frame_time.year, frame_time.month, frame_time.day)
+        finished = None
+        if self.day is not None and day != self.day:
+            finished = self.finish()
+
+        if self.day is None:
+            self.day = day
+            self.maximum = numpy.array(values, dtype = numpy.float64)
+            self.minimum = numpy.array(values, dtype = numpy.float64)
+        else:
+            numpy.maximum(self.maximum, values, out = self.maximum)
+            numpy.minimum(self.minimum, values, out = self.minimum)
+
+        return finished
+
+
+    def finish(self):
+        """
+        ends the current day
+
+        Returns:
+            (day, numpy array of max - min) of the current day, or None if no frames have been added since the last day
+        """
+
+        if self.day is None:
+            return None
+
+        finished = (self.day, self.maximum - self.minimum)
+        self.day = None
+        self.maximum = None
+        self.minimum = None
+        return finished
+
+
+
+def dif_path(tem_path):
+    """
+    gets the path of the dif file of a temperature file (ie. 20160101_tem.r2c -> 20160101_dif.r2c)
+    """
+
+    return os.path.join(os.path.dirname(tem_path), os.path.basename(tem_path).replace("tem", "dif"))
+
+
+
+class DifFiles(object):
+    """
+    Writes the dif files of temperature files while their frames are being converted, so the temperature
+    files don't have to be read again (see met_process.conversion_plan()). The frames of each temperature
+    file must be added in time order, as r2c_io.FrameAssembler writes them.
+
+    Usage:
+        dif_files = tempdiff.DifFiles()
+        dif_files.add_file(tem_path)
+        dif_files.add_frame(tem_path, frame_index, frame_time, values)
+        ...
+        dif_files.close()
+    """
+
+    def __init__(self):
+        self.files = set()
+        self.updates = []
+        self._ranges = {}
+        self._writers = {}
+        self._days = {}
+
+
+    def add_file(self, tem_path):
+        """
+        adds a temperature file whose frames are all converted in this pass. Its dif file is made again
+        once the first frame is added, with the header the temperature file was written with
+
+        Args:
+            tem_path: path of the *_tem.r2c file
+        """
+
+        self.files.add(tem_path)
+
+
+    def update_file(self, tem_path):
+        """
+        adds a temperature file that is only partly converted in this pass (the frames before are kept).
+        Its dif file is updated from the temperature file once the conversion is done, see update_dif()
+        """
+
+        self.updates.append(tem_path)
+
+
+    def add_frame(self, tem_path, frame_index, frame_time, values):
+        """
+        adds a temperature frame, frames of files that weren't added with add_file() are ignored
+        """
+
+        if tem_path not in self.files:
+            return
+
+        #by the time its first frame is added, the temperature file has been created (ie. by pyEnSim)
+        if tem_path not in self._writers:
+            target = dif_path(tem_path)
+            r2c_io.write_r2c(target, r2c_io.read_header(tem_path)[0], [], DIF_LAYOUT)
+            self._writers[tem_path] = r2c_io.R2CWriter(target, layout = DIF_LAYOUT)
+            self._ranges[tem_path] = DailyRange()
+            self._days[tem_path] = 0
+
+        self._write_day(tem_path, self._ranges[tem_path].add(frame_time, values))
+
+
+    def _write_day(self, tem_path, day):
+        if day is not None:
+            self._days[tem_path] = self._days[tem_path] + 1
+            self._writers[tem_path].add_frame(self._days[tem_path], day[0], day[1])
+
+
+    def close(self):
+        """
+        writes the last day of each dif file and updates the dif files of the partly converted temperature files
+
+        Returns:
+            number of dif files written
+        """
+
+        for tem_path in self._writers:
+            self._write_day(tem_path, self._ranges[tem_path].finish())
+            self._writers[tem_path].close()
+
+        for tem_path in self.updates:
+            if os.path.exists(tem_path):
+                update_dif(tem_path)
+
+        return len(self._writers) + len(self.updates)
+
+
+
+def daily_differences(tem_path, start_day = None):
+    """
+    reads a temperature file one frame at a time and reduces it to daily ranges
+
+    Args:
+        tem_path: path of a *_tem.r2c file
+        start_day: datetime of the first day to return, or None to start at the first frame
+    Returns:
+        generator of (day, numpy array of shape (ycount, xcount))
+    """
+
+    r2c = r2c_io.R2CFile(tem_path)
+    try:
+        first = 0
+        if start_day is not None:
+            first = bisect.bisect_left(r2c.frame_times(), start_day)
+
+        daily_range = DailyRange()
+        for n in xrange(first, len(r2c)):
+            day = daily_range.add(r2c.frames[n][2], r2c.read_frame(n))
+            if day is not None:
+                yield day
+
+        day = daily_range.finish()
+        if day is not None:
+            yield day
+    finally:
+        r2c.close()
+
+
+
+def update_dif(tem_path, incremental = True):
+    """
+    creates or updates the dif file of a temperature file
+
+    Args:
+        tem_path: path of a *_tem.r2c file
+        incremental: update an existing dif file from its last day on, rather than making it again
+    Returns:
+        number of days written
+    """
+
+    target = dif_path(tem_path)
+    tem_start = None
+    tem_end = None
+    if os.path.exists(tem_path) and os.path.getsize(tem_path) > 0:
+        r2c = r2c_io.R2CFile(tem_path)
+        try:
+            if len(r2c) > 0:
+                tem_start = r2c.frames[0][2]
+                tem_end = r2c.frames[-1][2]
+        finally:
+            r2c.close()
+
+    #keep the days of the existing dif file, if it was made from the start of the same temperature file
+    kept = 0
+    start_day = None
+    if incremental and os.path.exists(target) and tem_start is not None:
+        dif = r2c_io.R2CFile(target)
+        try:
+            dif_days = dif.frame_times()
+        finally:
+            dif.close()
+
+        first_day = datetime.datetime(tem_start.year, tem_start.month, tem_start.day)
+        if len(dif_days) > 0 and dif_days[0] == first_day and dif_days[-1] <= tem_end:
+            kept = len(dif_days) - 1
+            start_day = dif_days[-1]
+
+    if start_day is None:
+        r2c_io.write_r2c(target, r2c_io.read_header(tem_path)[0], [], DIF_LAYOUT)
+    else:
+        r2c_io.truncate_frames(target, kept)
+
+    writer = r2c_io.R2CWriter(target, layout = DIF_LAYOUT)
+    for day, difference in daily_differences(tem_path, start_day):
+        kept = kept + 1
+        writer.add_frame(kept, day, difference)
+    writer.close()
+
+    return writer.frames_written
+
+
+
+def update_directory(tempr_directory, incremental = True):
+    """
+    creates or updates the dif file of every temperature file in a directory, the same files tempdiff.r did
+
+    Args:
+        tempr_directory: directory where the *_tem.r2c files are stored (ie. the model's tempr folder)
+        incremental: see update_dif()
+    Returns:
+        NULL - but writes the *_dif.r2c files
+    """
+
+    for name in sorted(os.listdir(tempr_directory)):
+        if "tem" in name and name.lower().endswith(".r2c"):
+            days = update_dif(os.path.join(tempr_directory, name), incremental)
+            print "  " + os.path.basename(dif_path(name)) + ": " + str(days) + " days written"
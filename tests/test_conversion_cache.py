@@ -0,0 +1,132 @@
+"""
+Tests of conversion_cache, run with: python -m unittest discover -s tests
+"""
+
+#import standard modules
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+#import scientific modules
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import conversion_cache
+from test_grib_index import grib2_message
+
+
+
+class ConversionCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = conversion_cache.ConversionCache(os.path.join(self.directory, "cache"))
+        self.template = self.write("template.r2c", ":FileType r2c\n:EndHeader\n")
+
+        #ensemble grib files with one member per message
+        self.grib = self.write("ens_003.grib2", grib2_message(1, "a") + grib2_message(1, "b"))
+        self.previous = self.write("ens_000.grib2", grib2_message(1, "c") + grib2_message(1, "d"))
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def write(self, name, content, mtime = None):
+        path = os.path.join(self.directory, name)
+        source_file = open(path, "wb")
+        try:
+            source_file.write(content)
+        finally:
+            source_file.close()
+        #files rewritten by a test get a new modification time, so their checksums aren't the ones kept in memory
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+
+    def test_key_follows_the_sources(self):
+        key = self.cache.key(self.grib, 0, self.template)
+        self.assertEqual(self.cache.key(self.grib, 0, self.template), key)
+        self.assertNotEqual(self.cache.key(self.grib, 1, self.template), key)
+        self.assertNotEqual(self.cache.key(self.grib, 0, self.template, convert_add = -273.15), key)
+        self.assertNotEqual(self.cache.key(self.grib, 0, self.template, convert_mult = 1000.0), key)
+        self.assertNotEqual(self.cache.key(self.grib, 0, self.template, method = "weights"), key)
+        self.assertNotEqual(self.cache.key(self.grib, 0, self.template, grib_previous = self.previous), key)
+
+        #the key is made from the member's message, not from the file name or the other members
+        self.write("copy.grib2", grib2_message(1, "a") + grib2_message(1, "x"))
+        self.assertEqual(self.cache.key(os.path.join(self.directory, "copy.grib2"), 0, self.template), key)
+        self.write("ens_003.grib2", grib2_message(1, "z") + grib2_message(1, "b"), mtime = 1000)
+        self.assertNotEqual(self.cache.key(self.grib, 0, self.template), key)
+
+        key = self.cache.key(self.grib, 0, self.template)
+        self.write("template.r2c", ":FileType r2c\n:xCount 2\n:EndHeader\n", mtime = 1000)
+        self.assertNotEqual(self.cache.key(self.grib, 0, self.template), key)
+
+
+    def test_key_of_previous_member(self):
+        key = self.cache.key(self.grib, 1, self.template, grib_previous = self.previous)
+        self.write("ens_000.grib2", grib2_message(1, "y") + grib2_message(1, "d"), mtime = 1000)
+        self.assertEqual(self.cache.key(self.grib, 1, self.template, grib_previous = self.previous), key)
+        self.write("ens_000.grib2", grib2_message(1, "y") + grib2_message(1, "w"), mtime = 2000)
+        self.assertNotEqual(self.cache.key(self.grib, 1, self.template, grib_previous = self.previous), key)
+
+
+    def test_key_of_file_with_several_members_per_message(self):
+        grib = self.write("multi.grib2", grib2_message(2, "a"))
+        key = self.cache.key(grib, 0, self.template)
+        self.assertNotEqual(self.cache.key(grib, 1, self.template), key)
+        self.write("multi.grib2", grib2_message(2, "b"), mtime = 1000)
+        self.assertNotEqual(self.cache.key(grib, 0, self.template), key)
+
+
+    def test_put_and_get(self):
+        key = self.cache.key(self.grib, 0, self.template)
+        self.assertEqual(self.cache.get(key), None)
+
+        values = numpy.linspace(-40.0, 40.0, 600)
+        self.cache.put(key, values)
+        cached = self.cache.get(key)
+        self.assertEqual(cached.dtype, numpy.float32)
+        self.assertTrue(numpy.array_equal(cached, values.astype(numpy.float32)))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+        #another process (or run) finds the frame in the same directory
+        cache = conversion_cache.ConversionCache(self.cache.directory)
+        self.assertTrue(numpy.array_equal(cache.get(key), cached))
+        self.assertEqual(os.listdir(os.path.dirname(self.cache._path(key))), [key + conversion_cache.ENTRY_SUFFIX])
+
+
+    def test_evict(self):
+        now = time.time()
+        keys = ["%040x" % k for k in range(5)]
+        for k, key in enumerate(keys):
+            self.cache.put(key, numpy.zeros(100))
+            os.utime(self.cache._path(key), (now - (5 - k) * 86400, now - (5 - k) * 86400))
+        size = os.path.getsize(self.cache._path(keys[0]))
+        cached = lambda keys: [os.path.exists(self.cache._path(key)) for key in keys]
+
+        #frames not used for 3.5 days, then the least recently used over the size limit
+        self.assertEqual(self.cache.evict(max_age_days = 3.5), 2)
+        self.assertEqual(cached(keys), [False, False, True, True, True])
+        self.assertEqual(self.cache.evict(max_bytes = 2 * size), 1)
+        self.assertEqual(cached(keys), [False, False, False, True, True])
+
+        #a frame read back is used again, so it is evicted last
+        self.cache.get(keys[3])
+        self.assertEqual(self.cache.evict(max_bytes = size), 1)
+        self.assertEqual(cached(keys), [False, False, False, True, False])
+
+
+    def test_get_cache_shared(self):
+        directory = os.path.join(self.directory, "cache")
+        self.assertTrue(conversion_cache.get_cache(directory) is conversion_cache.get_cache(directory + os.sep))
+
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+"""
+Tests of conversion_manifest, run with: python -m unittest discover -s tests
+"""
+
+#import standard modules
+import os
+import sys
+import shutil
+import datetime
+import tempfile
+import unittest
+
+#import scientific modules
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import r2c_io
+import conversion_manifest
+
+
+HEADER = [":FileType r2c  ASCII  EnSim 1.0", ":xCount 3", ":yCount 2", ":EndHeader"]
+
+
+
+class ConversionManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.r2c_path = os.path.join(self.directory, "met", "20160101_met_01-01.r2c")
+        os.mkdir(os.path.dirname(self.r2c_path))
+        self.template = self.write("template.r2c", "\n".join(HEADER))
+
+        #accumulated precipitation: each frame after the first is de-accumulated with the previous grib file
+        start = datetime.datetime(2016, 1, 1)
+        self.gribs = [self.write("CMC_%03d.grib2" % (3 * k), "grib %d" % k) for k in range(5)]
+        self.expected = []
+        for k in range(5):
+            source = (self.gribs[k], self.gribs[k - 1] if k > 0 else False, False, False, self.template, "pyEnSim")
+            self.expected.append((k + 1, start + datetime.timedelta(hours = 3 * k), source))
+        r2c_io.write_r2c(self.r2c_path, HEADER, [(frame_index, frame_time, numpy.zeros((2, 3)) + frame_index)
+                                                 for frame_index, frame_time, source in self.expected])
+
+        manifest = conversion_manifest.ConversionManifest(self.directory)
+        manifest.record(self.r2c_path, self.expected)
+        manifest.save()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        source_file = open(path, "wb")
+        try:
+            source_file.write(content)
+        finally:
+            source_file.close()
+        return path
+
+
+    def valid_frames(self, expected = None):
+        manifest = conversion_manifest.ConversionManifest(self.directory)
+        return manifest.valid_frames(self.r2c_path, expected or self.expected)
+
+
+    def test_all_frames_kept(self):
+        self.assertEqual(self.valid_frames(), 5)
+
+
+    def test_frames_after_truncation(self):
+        #frames recorded in the manifest but no longer in the file (ie. the run was stopped) aren't kept
+        r2c_io.truncate_frames(self.r2c_path, 3)
+        self.assertEqual(self.valid_frames(), 3)
+
+        r2c_io.truncate_frames(self.r2c_path, 0)
+        self.assertEqual(self.valid_frames(), 0)
+
+
+    def test_changed_grib_file(self):
+        #grib file 3 is frame 4's source and frame 5's previous timestep
+        os.utime(self.write("CMC_009.grib2", "new grib 3"), (0, 0))
+        self.assertEqual(self.valid_frames(), 3)
+
+        #the same contents (ie. downloaded again) keep the frames
+        os.utime(self.write("CMC_009.grib2", "grib 3"), (0, 0))
+        self.assertEqual(self.valid_frames(), 5)
+
+        os.remove(self.gribs[0])
+        self.assertEqual(self.valid_frames(), 0)
+
+
+    def test_changed_conversion(self):
+        expected = list(self.expected)
+        frame_index, frame_time, source = expected[2]
+        expected[2] = (frame_index, frame_time, source[0:2] + (-273.15,) + source[3:])
+        self.assertEqual(self.valid_frames(expected), 2)
+
+        #a frame at another time isn't the same frame
+        expected = list(self.expected)
+        expected[1] = (2, expected[1][1] + datetime.timedelta(hours = 1), expected[1][2])
+        self.assertEqual(self.valid_frames(expected), 1)
+
+        self.write("template.r2c", "\n".join(HEADER + ["#changed"]))
+        self.assertEqual(self.valid_frames(), 0)
+
+
+    def test_changed_method(self):
+        #turning the regrid weights on (or off) converts the whole file again, so it isn't made with both methods
+        expected = [(frame_index, frame_time, source[0:5] + ("weights",)) for frame_index, frame_time, source in self.expected]
+        self.assertEqual(self.valid_frames(expected), 0)
+
+
+    def test_more_frames_expected(self):
+        frame_index, frame_time, source = self.expected[-1]
+        expected = self.expected + [(frame_index + 1, frame_time + datetime.timedelta(hours = 3), source)]
+        self.assertEqual(self.valid_frames(expected), 5)
+
+
+    def test_other_manifest_version(self):
+        manifest = conversion_manifest.ConversionManifest(self.directory)
+        self.assertTrue(len(manifest.sources) > 0)
+        self.write(conversion_manifest.MANIFEST_NAME, '{"version": 0, "files": {}}')
+        self.assertEqual(self.valid_frames(), 0)
+
+        self.write(conversion_manifest.MANIFEST_NAME, "not json")
+        self.assertEqual(self.valid_frames(), 0)
+
+
+
+if __name__ == "__main__":
+    unittest.main()
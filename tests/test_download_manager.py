@@ -0,0 +1,559 @@
+"""
+Tests of download_manager against a local http server standing in for the grib repositories,
+run with: python -m unittest discover -s tests
+"""
+
+#import standard modules
+import os
+import re
+import sys
+import shutil
+import struct
+import tempfile
+import unittest
+import threading
+import SocketServer
+import BaseHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import download_manager
+
+
+
+class RepositoryServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    http server with the files of a repository in memory
+
+    Attributes:
+        files: dictionary of url path -> (content, etag)
+        script: dictionary of url path -> list of responses sent before the file is served, each either
+                (status, headers) or ("cut", number of bytes): the file is sent with its full Content-Length
+                but the connection is closed after that many bytes
+        requests: list of (url path, dictionary of request headers) of every request received
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), RepositoryHandler)
+        self.files = {}
+        self.script = {}
+        self.requests = []
+        self.lock = threading.Lock()
+
+
+    def url(self, path):
+        return "http://127.0.0.1:" + str(self.server_address[1]) + path
+
+
+
+class RepositoryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def send(self, status, body = "", headers = None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, dict(self.headers.items())))
+            script = server.script.get(self.path, [])
+            action = script.pop(0) if len(script) > 0 else None
+            content, etag = server.files.get(self.path, (None, None))
+
+        if action is not None and action[0] != "cut":
+            self.send(action[0], "", action[1])
+            return
+
+        if content is None:
+            self.send(404, "Not found")
+            return
+
+        if action is not None:
+            self.send_response(200)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content[:action[1]])
+            self.wfile.flush()
+            self.close_connection = 1
+            return
+
+        match = re.match(r"bytes=(\d+)-$", self.headers.get("range") or "")
+        if match is not None and self.headers.get("if-range") in (None, etag):
+            start = int(match.group(1))
+            if start >= len(content):
+                self.send(416, "", {"Content-Range": "bytes */" + str(len(content))})
+                return
+            self.send(206, content[start:], {"ETag": etag, "Content-Range": "bytes %d-%d/%d" % (start, len(content) - 1, len(content))})
+            return
+
+        self.send(200, content, {"ETag": etag})
+
+
+
+def grib1_message(body):
+    """
+    makes a grib edition 1 message around body, see grib_index.scan_messages()
+    """
+
+    length = 8 + len(body) + 4
+    return "GRIB" + struct.pack(">I", length)[1:] + "\x01" + body + "7777"
+
+
+
+class DownloadManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = RepositoryServer()
+        self.thread = threading.Thread(target = self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.directory = tempfile.mkdtemp()
+        self.delays = []
+
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+
+    def manager(self, retries = 2, manifest = True):
+        if manifest:
+            manifest = download_manager.DownloadManifest(self.directory)
+        else:
+            manifest = None
+        manager = download_manager.DownloadManager(threads = 4, retries = retries, backoff = 0.0, timeout = 5, manifest = manifest)
+
+        #record the waits between retries instead of sleeping
+        backoff = manager._backoff
+        def no_wait(attempt, retry_after = None):
+            self.delays.append(backoff(attempt, retry_after))
+            return 0
+        manager._backoff = no_wait
+        return manager
+
+
+    def serve(self, name, content, etag = '"1"'):
+        self.server.files["/" + name] = (content, etag)
+        return self.server.url("/" + name), os.path.join(self.directory, name)
+
+
+    def read(self, path):
+        local_file = open(path, "rb")
+        try:
+            return local_file.read()
+        finally:
+            local_file.close()
+
+
+    def download(self, manager, url, path):
+        try:
+            return manager.download(url, path)
+        finally:
+            manager.close()
+
+
+    def test_part_file_renamed_on_completion(self):
+        content = "x" * 100000
+        url, path = self.serve("file.bin", content)
+        manager = self.manager()
+        result = self.download(manager, url, path)
+
+        self.assertEqual(result.status, 200)
+        self.assertEqual(self.read(path), content)
+        self.assertFalse(os.path.exists(path + ".part"))
+        entry = manager.manifest.get(path)
+        self.assertTrue(entry["complete"])
+        self.assertEqual(entry["size"], len(content))
+        self.assertEqual(entry["sha1"], download_manager.file_checksum(path))
+        self.assertTrue(manager.manifest.is_complete(path, verify_checksum = True))
+
+
+    def test_temporary_file_removed_without_manifest(self):
+        url, path = self.serve("file.bin", "data")
+        self.server.script["/file.bin"] = [("cut", 2)]
+        result = self.download(self.manager(retries = 0, manifest = False), url, path)
+
+        self.assertEqual(result.status, None)
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+    def test_missing_file(self):
+        url, path = self.serve("file.bin", "data")
+        result = self.download(self.manager(), self.server.url("/other.bin"), os.path.join(self.directory, "other.bin"))
+
+        self.assertEqual(result.status, 404)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "other.bin")))
+        self.assertEqual(len(self.server.requests), 1)
+
+
+    def test_resume_with_range(self):
+        content = "".join([chr(k % 256) for k in range(5000)])
+        url, path = self.serve("file.bin", content)
+        self.server.script["/file.bin"] = [("cut", 1234)]
+        result = self.download(self.manager(), url, path)
+
+        self.assertEqual(result.status, 206)
+        self.assertEqual(self.read(path), content)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertFalse("range" in self.server.requests[0][1])
+        self.assertEqual(self.server.requests[1][1]["range"], "bytes=1234-")
+        self.assertEqual(self.server.requests[1][1]["if-range"], '"1"')
+
+
+    def test_resume_after_interrupted_run(self):
+        content = "abcdefghij" * 100
+        url, path = self.serve("file.bin", content)
+        self.server.script["/file.bin"] = [("cut", 300)]
+        result = self.download(self.manager(retries = 0), url, path)
+        self.assertEqual(result.status, None)
+        self.assertEqual(os.path.getsize(path + ".part"), 300)
+        self.assertFalse(os.path.exists(path))
+
+        #a new run (with the manifest read from disk) asks for the rest only
+        result = self.download(self.manager(), url, path)
+        self.assertEqual(result.status, 206)
+        self.assertEqual(self.read(path), content)
+        self.assertEqual(self.server.requests[-1][1]["range"], "bytes=300-")
+
+
+    def test_changed_file_downloaded_again(self):
+        url, path = self.serve("file.bin", "old" * 100)
+        self.server.script["/file.bin"] = [("cut", 50)]
+        self.download(self.manager(retries = 0), url, path)
+
+        #If-Range no longer matches, so the server sends the whole new file
+        self.serve("file.bin", "new" * 200, etag = '"2"')
+        result = self.download(self.manager(), url, path)
+
+        self.assertEqual(result.status, 200)
+        self.assertEqual(self.read(path), "new" * 200)
+        self.assertEqual(self.server.requests[-1][1]["if-range"], '"1"')
+
+
+    def test_416_restarts_download(self):
+        url, path = self.serve("file.bin", "a" * 500)
+        self.server.script["/file.bin"] = [("cut", 400)]
+        self.download(self.manager(retries = 0), url, path)
+
+        #the file is now shorter than the partial download, the server answers the range with 416
+        self.serve("file.bin", "b" * 100)
+        result = self.download(self.manager(), url, path)
+
+        self.assertEqual(result.status, 200)
+        self.assertEqual(self.read(path), "b" * 100)
+        self.assertFalse(os.path.exists(path + ".part"))
+        self.assertEqual(self.server.requests[-2][1]["range"], "bytes=400-")
+        self.assertFalse("range" in self.server.requests[-1][1])
+
+
+    def test_retry_after_busy_server(self):
+        url, path = self.serve("file.bin", "data")
+        self.server.script["/file.bin"] = [(429, {"Retry-After": "3"}), (503, {"Retry-After": "7"})]
+        manager = self.manager()
+        result = self.download(manager, url, path)
+
+        self.assertEqual(result.status, 200)
+        self.assertEqual(self.read(path), "data")
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.delays, [3, 7])
+        self.assertEqual(manager._stats["127.0.0.1:" + str(self.server.server_address[1])].retries, 2)
+
+
+    def test_retries_give_up(self):
+        url, path = self.serve("file.bin", "data")
+        self.server.script["/file.bin"] = [(503, {})] * 3
+        result = self.download(self.manager(retries = 2), url, path)
+
+        self.assertEqual(result.status, 503)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(len(self.server.requests), 3)
+
+
+    def test_complete_file_downloaded_again(self):
+        #the callers skip complete files (see DownloadManifest.is_complete()), a complete file asked for again is
+        #downloaded whole
+        url, path = self.serve("file.bin", "data")
+        self.assertEqual(self.download(self.manager(), url, path).status, 200)
+        self.assertTrue(download_manager.DownloadManifest(self.directory).is_complete(path))
+
+        self.serve("file.bin", "new data", etag = '"2"')
+        manager = self.manager()
+        result = self.download(manager, url, path)
+        self.assertEqual(result.status, 200)
+        self.assertEqual(self.read(path), "new data")
+        self.assertEqual(self.server.requests[-1][1].get("range"), None)
+        self.assertEqual(manager.manifest.get(path)["size"], 8)
+
+
+    def test_incomplete_grib_rejected(self):
+        complete = grib1_message("a" * 20) + grib1_message("b" * 30)
+        url, path = self.serve("file.grib2", complete)
+        self.assertEqual(self.download(self.manager(), url, path).status, 200)
+        self.assertEqual(self.read(path), complete)
+
+        #a file that ends part way through a message is never put in place
+        url, path = self.serve("cut.grib2", complete[:-10])
+        manager = self.manager(retries = 0)
+        result = self.download(manager, url, path)
+        self.assertEqual(result.status, None)
+        self.assertTrue(result.error.startswith("Incomplete grib file"))
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(path + ".part"))
+        self.assertEqual(manager.manifest.get(path), None)
+
+
+    def test_download_all(self):
+        downloads = [self.serve("file%d.bin" % k, str(k) * 1000) for k in range(10)]
+        manager = self.manager()
+        try:
+            results = list(manager.download_all(downloads + [(self.server.url("/missing.bin"), os.path.join(self.directory, "missing.bin"))]))
+        finally:
+            manager.close()
+
+        self.assertEqual(sorted([result.status for result in results]), [200] * 10 + [404])
+        for k, (url, path) in enumerate(downloads):
+            self.assertEqual(self.read(path), str(k) * 1000)
+        self.assertEqual(len(manager.report()), 1)
+
+
+
+class ConcurrencyControllerTest(unittest.TestCase):
+
+    def finish(self, controller, latencies, failed = 0, throttled = 0):
+        """
+        runs one download per latency through the controller, the first ones failed or throttled
+        """
+
+        for k, latency in enumerate(latencies):
+            controller.acquire()
+            controller.release(latency, failed = k < failed or k < throttled, throttled = k < throttled)
+        self.assertEqual(controller.active, 0)
+        return controller.limit
+
+
+    def test_initial_limit_clamped(self):
+        self.assertEqual(download_manager.ConcurrencyController(initial = 30, maximum = 20).limit, 20)
+        self.assertEqual(download_manager.ConcurrencyController(initial = 0, minimum = 2).limit, 2)
+        self.assertEqual(download_manager.ConcurrencyController(initial = 4, minimum = 8, maximum = 6).limit, 8)
+
+
+    def test_throttled_window_halves_limit(self):
+        controller = download_manager.ConcurrencyController(initial = 9, window = 4)
+        self.assertEqual(self.finish(controller, [1.0] * 3), 9)
+        self.assertEqual(self.finish(controller, [1.0], throttled = 1), 4)
+        self.assertEqual(self.finish(controller, [1.0] * 4, throttled = 1), 2)
+
+
+    def test_errors_above_threshold_halve_limit(self):
+        controller = download_manager.ConcurrencyController(initial = 8, window = 10, error_threshold = 0.1)
+
+        #one failed download in ten isn't above the threshold
+        self.assertEqual(self.finish(controller, [1.0] * 10, failed = 1), 9)
+        self.assertEqual(self.finish(controller, [1.0] * 10, failed = 2), 4)
+
+        #the windows with errors don't set the best latency
+        self.assertEqual(controller.best_latency, None)
+
+
+    def test_limit_increased_while_latency_within_tolerance(self):
+        controller = download_manager.ConcurrencyController(initial = 4, window = 5, latency_tolerance = 1.5)
+        self.assertEqual(self.finish(controller, [1.0] * 5), 5)
+        self.assertEqual(controller.best_latency, 1.0)
+        self.assertEqual(self.finish(controller, [1.5] * 5), 6)
+
+        #the requests are queueing up on the server
+        self.assertEqual(self.finish(controller, [1.6] * 5), 6)
+        self.assertEqual(self.finish(controller, [0.5, 1.0, 1.0, 1.0, 1.0]), 7)
+        self.assertEqual(controller.best_latency, 0.9)
+        self.assertEqual(self.finish(controller, [1.4] * 5), 7)
+
+
+    def test_limit_clamped(self):
+        controller = download_manager.ConcurrencyController(initial = 2, minimum = 2, maximum = 3, window = 2)
+        self.assertEqual(self.finish(controller, [1.0] * 2, throttled = 2), 2)
+        self.assertEqual(self.finish(controller, [1.0] * 2), 3)
+        self.assertEqual(self.finish(controller, [1.0] * 2), 3)
+        self.assertEqual(self.finish(controller, [1.0] * 2, failed = 2), 2)
+
+
+    def test_acquire_waits_for_release(self):
+        controller = download_manager.ConcurrencyController(initial = 2)
+        controller.acquire()
+        controller.acquire()
+
+        started = threading.Event()
+        def download():
+            controller.acquire()
+            started.set()
+        thread = threading.Thread(target = download)
+        thread.start()
+        self.assertFalse(started.wait(0.2))
+
+        controller.release(1.0)
+        self.assertTrue(started.wait(5))
+        thread.join()
+        self.assertEqual(controller.active, 2)
+
+
+
+class BackoffTest(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = download_manager.DownloadManager(backoff = 2.0, max_backoff = 10.0)
+        self.uniform = download_manager.random.uniform
+
+
+    def tearDown(self):
+        download_manager.random.uniform = self.uniform
+
+
+    def test_full_jitter(self):
+        for attempt, bound in enumerate([2.0, 4.0, 8.0, 10.0, 10.0]):
+            delays = [self.manager._backoff(attempt) for k in range(200)]
+            self.assertTrue(0.0 <= min(delays) and max(delays) <= bound)
+            self.assertTrue(max(delays) > bound / 2)
+
+
+    def test_retry_after(self):
+        #the server's Retry-After is used when it is longer than the random wait, up to max_backoff
+        download_manager.random.uniform = lambda low, high: high
+        self.assertEqual(self.manager._backoff(0, "5"), 5)
+        self.assertEqual(self.manager._backoff(2, "5"), 8.0)
+        self.assertEqual(self.manager._backoff(0, "120"), 10.0)
+
+        #an http date isn't used
+        self.assertEqual(self.manager._backoff(1, "Wed, 21 Oct 2015 07:28:00 GMT"), 4.0)
+        self.assertEqual(self.manager._backoff(1, None), 4.0)
+
+
+
+class ListingCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = RepositoryServer()
+        self.thread = threading.Thread(target = self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.directory = tempfile.mkdtemp()
+        self.url = self.server.url("/rdpa/")
+        self.pattern = re.compile('"(CMC_RDPA_.+?.grib2)"')
+        self.names = ["CMC_RDPA_%02d.grib2" % k for k in range(6)]
+
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+
+    def serve_listing(self, names, etag):
+        body = "<html>" + "".join(['<a href="%s">%s</a>\n' % (name, name) for name in names]) + "</html>"
+        self.server.files["/rdpa/"] = (body, etag)
+
+
+    def new_files(self, listing):
+        manager = download_manager.DownloadManager(retries = 0)
+        try:
+            return listing.new_files(manager, self.url, self.pattern)
+        finally:
+            manager.close()
+
+
+    def last_request(self):
+        return self.server.requests[-1][1]
+
+
+    def test_first_listing(self):
+        self.serve_listing(self.names[3:] + self.names[:3], '"1"')
+        listing = download_manager.ListingCache(self.directory)
+        self.assertEqual(self.new_files(listing), self.names)
+        self.assertEqual(listing.mark(self.url), None)
+        self.assertFalse("if-none-match" in self.last_request())
+
+
+    def test_unchanged_listing_skipped(self):
+        self.serve_listing(self.names, '"1"')
+        listing = download_manager.ListingCache(self.directory)
+        listing.advance_mark(self.url, self.new_files(listing), set())
+        self.assertEqual(listing.mark(self.url), self.names[-1])
+        listing.save()
+
+        #the mark is the last file of the listing, so it is only asked for if it changed
+        listing = download_manager.ListingCache(self.directory)
+        self.assertEqual(self.new_files(listing), [])
+        self.assertEqual(self.last_request()["if-none-match"], '"1"')
+
+        self.serve_listing(self.names + ["CMC_RDPA_06.grib2"], '"2"')
+        self.assertEqual(self.new_files(listing), ["CMC_RDPA_06.grib2"])
+
+
+    def test_listing_parsed_after_mark(self):
+        self.serve_listing(self.names, '"1"')
+        listing = download_manager.ListingCache(self.directory)
+        listing.set_mark(self.url, self.names[2])
+        self.assertEqual(self.new_files(listing), self.names[3:])
+
+        #only the listing after the mark is parsed, a file listed before it isn't seen
+        self.serve_listing(["CMC_RDPA_10.grib2"] + self.names, '"2"')
+        self.assertEqual(self.new_files(listing), self.names[3:])
+
+
+    def test_mark_no_longer_on_server(self):
+        #the server has removed the old files, the mark among them: the whole listing is parsed
+        self.serve_listing(self.names[3:], '"1"')
+        listing = download_manager.ListingCache(self.directory)
+        listing.set_mark(self.url, self.names[1])
+        self.assertEqual(self.new_files(listing), self.names[3:])
+
+        listing.set_mark(self.url, "CMC_RDPA_04a.grib2")
+        self.assertEqual(self.new_files(listing), self.names[5:])
+
+
+    def test_mark_stops_at_failed_download(self):
+        self.serve_listing(self.names, '"1"')
+        listing = download_manager.ListingCache(self.directory)
+        names = self.new_files(listing)
+        listing.advance_mark(self.url, names, set([self.url + self.names[2], self.url + self.names[4]]))
+        self.assertEqual(listing.mark(self.url), self.names[1])
+        listing.save()
+
+        #the listing is read again (not asked for only if it changed, even though it didn't) and the
+        #failed files are downloaded again
+        listing = download_manager.ListingCache(self.directory)
+        self.assertEqual(self.new_files(listing), self.names[2:])
+        self.assertFalse("if-none-match" in self.last_request())
+
+        listing.advance_mark(self.url, self.names[2:], set())
+        self.assertEqual(listing.mark(self.url), self.names[-1])
+        self.assertEqual(self.new_files(listing), [])
+
+
+    def test_corrupt_cache(self):
+        listing_file = open(os.path.join(self.directory, download_manager.LISTING_NAME), "w")
+        try:
+            listing_file.write("{")
+        finally:
+            listing_file.close()
+
+        self.serve_listing(self.names, '"1"')
+        self.assertEqual(self.new_files(download_manager.ListingCache(self.directory)), self.names)
+
+
+
+if __name__ == "__main__":
+    unittest.main()
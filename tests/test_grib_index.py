@@ -0,0 +1,133 @@
+"""
+Tests of grib_index, run with: python -m unittest discover -s tests
+"""
+
+#import standard modules
+import os
+import sys
+import json
+import shutil
+import struct
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import grib_index
+
+
+
+def section(number, body):
+    return struct.pack(">IB", 5 + len(body), number) + body
+
+
+
+def grib2_message(fields, data = "data"):
+    """
+    makes a grib2 message with one or more fields (sections 4 to 7 repeated), see grib_index.scan_messages()
+    """
+
+    sections = section(1, "identification") + section(3, "grid")
+    for k in range(fields):
+        sections += section(4, "product") + section(5, "representation") + section(6, "\xff") + section(7, data * (k + 1))
+    length = 16 + len(sections) + 4
+    return "GRIB\x00\x00\x00\x02" + struct.pack(">Q", length) + sections + "7777"
+
+
+
+class GribIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "ens.grib2")
+        self.messages = [grib2_message(1, "a"), grib2_message(1, "bb"), grib2_message(2, "c")]
+        self.write(self.path, "".join(self.messages))
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def write(self, path, content):
+        grib_file = open(path, "wb")
+        try:
+            grib_file.write(content)
+        finally:
+            grib_file.close()
+
+
+    def read(self, path):
+        grib_file = open(path, "rb")
+        try:
+            return grib_file.read()
+        finally:
+            grib_file.close()
+
+
+    def expected_index(self):
+        index = []
+        offset = 0
+        for message, fields in zip(self.messages, [1, 1, 2]):
+            index.append((offset, len(message), fields))
+            offset += len(message)
+        return index
+
+
+    def test_scan_messages(self):
+        self.assertEqual(grib_index.scan_messages(self.path), self.expected_index())
+
+
+    def test_scan_stops_at_incomplete_message(self):
+        content = "".join(self.messages)
+        self.write(self.path, content[:-10])
+        self.assertEqual(grib_index.scan_messages(self.path), self.expected_index()[0:2])
+
+        #a message whose sections don't add up to its length isn't counted either
+        self.write(self.path, self.messages[0] + self.messages[1][:16] + struct.pack(">IB", 6, 1) + self.messages[1][21:])
+        self.assertEqual(len(grib_index.scan_messages(self.path)), 1)
+
+        self.write(self.path, "<html>Not found</html>")
+        self.assertEqual(grib_index.scan_messages(self.path), [])
+
+
+    def test_index_file_reused_until_grib_file_changes(self):
+        self.assertEqual(grib_index.read_index(self.path), self.expected_index())
+        index_path = grib_index.index_path(self.path)
+        self.assertTrue(os.path.exists(index_path))
+
+        #an up to date index file is read instead of scanning the grib file again
+        index = json.load(open(index_path))
+        index["messages"] = [[0, 1, 1]]
+        json.dump(index, open(index_path, "w"))
+        self.assertEqual(grib_index.read_index(self.path), [(0, 1, 1)])
+
+        #a changed grib file is scanned again
+        self.messages = self.messages[0:2]
+        self.write(self.path, "".join(self.messages))
+        os.utime(self.path, (index["mtime"] + 10, index["mtime"] + 10))
+        self.assertEqual(grib_index.read_index(self.path), self.expected_index())
+        self.assertEqual(json.load(open(index_path))["size"], os.path.getsize(self.path))
+
+
+    def test_one_field_per_message(self):
+        self.assertFalse(grib_index.one_field_per_message(self.path))
+        self.messages = self.messages[0:2]
+        self.write(self.path, "".join(self.messages))
+        self.assertTrue(grib_index.one_field_per_message(self.path))
+
+
+    def test_extract_messages(self):
+        target = os.path.join(self.directory, "subset.grib2")
+        self.assertEqual(grib_index.extract_messages(self.path, [2, 0], target), target)
+        self.assertEqual(self.read(target), self.messages[2] + self.messages[0])
+
+        temporary = grib_index.extract_messages(self.path, [1])
+        try:
+            self.assertEqual(self.read(temporary), self.messages[1])
+            self.assertTrue(temporary.endswith(".grib2"))
+        finally:
+            os.remove(temporary)
+
+
+
+if __name__ == "__main__":
+    unittest.main()
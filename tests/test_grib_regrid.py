@@ -0,0 +1,293 @@
+"""
+Tests of grib_regrid, run with: python -m unittest discover -s tests
+"""
+
+#import standard modules
+import os
+import sys
+import math
+import shutil
+import struct
+import tempfile
+import unittest
+
+#import scientific modules
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import grib_regrid
+
+
+EARTH_RADIUS = 6371229.0
+
+
+
+def section(number, body):
+    return struct.pack(">IB", 5 + len(body), number) + body
+
+
+
+def signed(value):
+    #grib2 signed integers are sign and magnitude
+    return (1 << 31) | -value if value < 0 else value
+
+
+
+def grid_section(template, body):
+    """
+    makes a grid definition section (section 3) with a spherical earth of radius 6371229 m (shape 6)
+    """
+
+    header = struct.pack(">BIBBHB", 0, 0, 0, 0, template, 6) + "\x00" * 15
+    return section(3, header + body)
+
+
+
+def lat_lon_section(ni, nj, la1, lo1, di, dj, scanning_mode):
+    #template 3.0, angles in micro-degrees
+    body = struct.pack(">IIIIIIBIIIIB", ni, nj, 0, 0, signed(int(round(la1 * 1e6))), signed(int(round(lo1 * 1e6))), 0,
+                       0, 0, int(round(di * 1e6)), int(round(dj * 1e6)), scanning_mode)
+    return grid_section(0, body)
+
+
+
+def polar_stereographic_section(ni, nj, la1, lo1, lad, lov, di, dj, scanning_mode):
+    #template 3.20, angles in micro-degrees and distances in millimetres
+    body = struct.pack(">IIIIBIIIIBB", ni, nj, signed(int(round(la1 * 1e6))), signed(int(round(lo1 * 1e6))), 0,
+                       signed(int(round(lad * 1e6))), signed(int(round(lov * 1e6))), int(round(di * 1e3)),
+                       int(round(dj * 1e3)), 0, scanning_mode)
+    return grid_section(20, body)
+
+
+
+def r2c_grid(xorigin, yorigin, xcount, ycount, xdelta, ydelta):
+    return {"projection": "LATLONG", "xorigin": xorigin, "yorigin": yorigin, "xcount": xcount, "ycount": ycount,
+            "xdelta": xdelta, "ydelta": ydelta}
+
+
+
+def node_values(grid, function):
+    """
+    gets function(i, j) at every grib point, in the node order of the grid's scanning mode
+    """
+
+    i, j = numpy.meshgrid(numpy.arange(grid["ni"], dtype = float), numpy.arange(grid["nj"], dtype = float))
+    if grid["scanning_mode"] & 0x20:
+        i, j = i.T, j.T
+    return function(i.ravel(), j.ravel())
+
+
+
+class GridSectionTest(unittest.TestCase):
+
+    def test_lat_lon(self):
+        grid = grib_regrid.parse_grid_section(lat_lon_section(4, 3, 50.0, -100.0, 1.0, 0.5, 0x40))
+        self.assertEqual(grid, {"template": 0, "earth_radius": EARTH_RADIUS, "ni": 4, "nj": 3, "la1": 50.0,
+                                "lo1": -100.0, "di": 1.0, "dj": 0.5, "scanning_mode": 0x40})
+
+
+    def test_polar_stereographic(self):
+        grid = grib_regrid.parse_grid_section(polar_stereographic_section(10, 8, 40.0, -120.5, 60.0, -100.0, 10000.0, 12500.0, 0x40))
+        self.assertEqual(grid, {"template": 20, "earth_radius": EARTH_RADIUS, "ni": 10, "nj": 8, "la1": 40.0,
+                                "lo1": -120.5, "lad": 60.0, "lov": -100.0, "di": 10000.0, "dj": 12500.0,
+                                "south_pole": False, "scanning_mode": 0x40})
+
+
+    def test_unsupported_grids(self):
+        self.assertRaises(ValueError, grib_regrid.parse_grid_section, grid_section(1, "\x00" * 60))
+        self.assertRaises(ValueError, grib_regrid.parse_grid_section, lat_lon_section(4, 3, 50.0, -100.0, 1.0, 1.0, 0x10))
+
+
+    def test_read_grid_section(self):
+        directory = tempfile.mkdtemp()
+        try:
+            grid = lat_lon_section(4, 3, 50.0, -100.0, 1.0, 1.0, 0)
+            sections = section(1, "identification") + grid + section(4, "product")
+            path = os.path.join(directory, "grid.grib2")
+            grib_file = open(path, "wb")
+            try:
+                grib_file.write("GRIB\x00\x00\x00\x02" + struct.pack(">Q", 16 + len(sections) + 4) + sections + "7777")
+            finally:
+                grib_file.close()
+            self.assertEqual(grib_regrid.read_grid_section(path), grid)
+
+            grib_file = open(path, "wb")
+            try:
+                grib_file.write("not a grib file")
+            finally:
+                grib_file.close()
+            self.assertRaises(ValueError, grib_regrid.read_grid_section, path)
+        finally:
+            shutil.rmtree(directory)
+
+
+
+class LatLonWeightsTest(unittest.TestCase):
+
+    def grid(self, scanning_mode):
+        #5 x 4 points, 1 degree apart, from 100W and from 50N (or 47N when scanning northwards)
+        la1 = 47.0 if scanning_mode & 0x40 else 50.0
+        return grib_regrid.parse_grid_section(lat_lon_section(5, 4, la1, -100.0, 1.0, 1.0, scanning_mode))
+
+
+    def field(self, grid):
+        #a field linear in lat and lon is interpolated exactly
+        j_sign = 1.0 if grid["scanning_mode"] & 0x40 else -1.0
+        return node_values(grid, lambda i, j: 2.0 * (grid["la1"] + j_sign * j) + 3.0 * (grid["lo1"] + i) + 500.0)
+
+
+    def test_grid_indices(self):
+        lat = numpy.array([50.0, 49.5, 47.0])
+        lon = numpy.array([-100.0, -98.25, -96.0])
+        fi, fj = grib_regrid.grid_indices(self.grid(0), lat, lon)
+        self.assertTrue(numpy.allclose(fi, [0.0, 1.75, 4.0]))
+        self.assertTrue(numpy.allclose(fj, [0.0, 0.5, 3.0]))
+
+        fi, fj = grib_regrid.grid_indices(self.grid(0x40), lat, lon)
+        self.assertTrue(numpy.allclose(fi, [0.0, 1.75, 4.0]))
+        self.assertTrue(numpy.allclose(fj, [3.0, 2.5, 0.0]))
+
+
+    def test_interpolation(self):
+        #cell centres from 99.75W to 96.25W and 47.25N to 49.75N
+        r2c = r2c_grid(-100.0, 47.0, 8, 6, 0.5, 0.5)
+        lat, lon = grib_regrid.r2c_cell_centres(r2c)
+        for scanning_mode in [0, 0x20, 0x40, 0x60]:
+            grid = self.grid(scanning_mode)
+            weights = grib_regrid.build_weights(grid, r2c)
+            self.assertEqual(weights.shape, (48, 20))
+            self.assertTrue(numpy.allclose(weights.sum(axis = 1), 1.0))
+            self.assertTrue(numpy.allclose(weights.dot(self.field(grid)), 2.0 * lat + 3.0 * lon + 500.0))
+
+
+    def test_interpolation_at_grid_points(self):
+        #cells centred on the grib points take the value of that point
+        r2c = r2c_grid(-100.5, 46.5, 5, 4, 1.0, 1.0)
+        for scanning_mode in [0, 0x20, 0x40, 0x60]:
+            grid = self.grid(scanning_mode)
+            weights = grib_regrid.build_weights(grid, r2c)
+            self.assertTrue(numpy.allclose(weights.max(axis = 1).toarray(), 1.0))
+            self.assertEqual(list(numpy.unique(weights.indices)), range(20))
+
+
+    def test_edge_clamp(self):
+        #cells outside the grib grid take the value of the nearest edge (longitudes wrap around, so the cells
+        #are north, south and east of the grid)
+        lat = numpy.array([52.5, 52.5, 45.5, 44.5, 48.5, 48.5])
+        lon = numpy.array([-95.5, -97.5, -94.5, -98.75, -93.0, -97.5])
+        edge_lat = numpy.array([50.0, 50.0, 47.0, 47.0, 48.5, 48.5])
+        edge_lon = numpy.array([-96.0, -97.5, -96.0, -98.75, -96.0, -97.5])
+        for scanning_mode in [0, 0x20, 0x40, 0x60]:
+            grid = self.grid(scanning_mode)
+            values = self.field(grid)
+            for k in range(len(lat)):
+                weights = grib_regrid.build_weights(grid, r2c_grid(lon[k] - 0.25, lat[k] - 0.25, 1, 1, 0.5, 0.5))
+                self.assertAlmostEqual(weights.dot(values)[0], 2.0 * edge_lat[k] + 3.0 * edge_lon[k] + 500.0)
+
+
+
+class PolarStereographicWeightsTest(unittest.TestCase):
+
+    def setUp(self):
+        #10 km grid true at 60N, scanning northwards like the datamart regional grid
+        self.grid = grib_regrid.parse_grid_section(polar_stereographic_section(10, 8, 40.0, -120.0, 60.0, -100.0, 10000.0, 10000.0, 0x40))
+
+
+    def project(self, lat, lon):
+        rho = EARTH_RADIUS * (1.0 + math.sin(math.radians(60.0))) * math.tan(math.radians(45.0 - lat / 2.0))
+        return rho * math.sin(math.radians(lon + 100.0)), -rho * math.cos(math.radians(lon + 100.0))
+
+
+    def point(self, fi, fj):
+        #lat/lon at a fractional position on the grid (the inverse of project())
+        x1, y1 = self.project(40.0, -120.0)
+        x, y = x1 + fi * 10000.0, y1 + fj * 10000.0
+        rho = math.hypot(x, y)
+        lat = 90.0 - 2.0 * math.degrees(math.atan(rho / (EARTH_RADIUS * (1.0 + math.sin(math.radians(60.0))))))
+        return lat, -100.0 + math.degrees(math.atan2(x, -y))
+
+
+    def test_grid_indices(self):
+        positions = [(0.0, 0.0), (1.25, 0.5), (9.0, 7.0), (4.5, 3.75)]
+        lat, lon = numpy.array([self.point(fi, fj) for fi, fj in positions]).T
+        fi, fj = grib_regrid.grid_indices(self.grid, lat, lon)
+        self.assertTrue(numpy.allclose(numpy.array([fi, fj]).T, positions, atol = 1e-6))
+
+        #the pole is where the plane is centred
+        x1, y1 = self.project(40.0, -120.0)
+        fi, fj = grib_regrid.grid_indices(self.grid, numpy.array([90.0]), numpy.array([0.0]))
+        self.assertAlmostEqual(fi[0], -x1 / 10000.0, 6)
+        self.assertAlmostEqual(fj[0], -y1 / 10000.0, 6)
+
+
+    def test_interpolation(self):
+        #a field linear in i and j is interpolated exactly at the (tiny) cell centred on each position
+        values = node_values(self.grid, lambda i, j: 10.0 * i + 100.0 * j)
+        for fi, fj in [(1.25, 0.5), (4.5, 3.75), (8.9, 6.1), (-3.0, 2.0)]:
+            lat, lon = self.point(fi, fj)
+            weights = grib_regrid.build_weights(self.grid, r2c_grid(lon - 0.0005, lat - 0.0005, 1, 1, 0.001, 0.001))
+            self.assertAlmostEqual(weights.dot(values)[0], 10.0 * max(fi, 0.0) + 100.0 * fj, 3)
+
+
+
+class CropTest(unittest.TestCase):
+
+    def setUp(self):
+        #a template from 100W to 96W and 50N to 53N
+        self.r2c = r2c_grid(-100.0, 50.0, 8, 6, 0.5, 0.5)
+
+
+    def grid(self, scanning_mode):
+        #20 x 15 points, 1 degree apart from 110W and from 60N (or 46N when scanning northwards)
+        la1 = 46.0 if scanning_mode & 0x40 else 60.0
+        return grib_regrid.parse_grid_section(lat_lon_section(20, 15, la1, -110.0, 1.0, 1.0, scanning_mode))
+
+
+    def test_crop_window(self):
+        #the template corners are at i 10 to 14 and j 7 to 10, plus the halo
+        self.assertEqual(grib_regrid.crop_window(self.grid(0), self.r2c), (8, 17, 5, 13))
+        self.assertEqual(grib_regrid.crop_window(self.grid(0), self.r2c, halo = 0), (10, 15, 7, 11))
+
+        #the window stops at the edges of the grid
+        self.assertEqual(grib_regrid.crop_window(self.grid(0), r2c_grid(-110.0, 57.5, 4, 10, 0.5, 0.5)), (0, 5, 0, 6))
+        self.assertEqual(grib_regrid.crop_window(self.grid(0), r2c_grid(-93.0, 44.0, 20, 4, 0.5, 0.5)), (15, 20, 12, 15))
+
+
+    def test_window_nodes(self):
+        nodes = grib_regrid.window_nodes(self.grid(0), (1, 3, 2, 4))
+        self.assertEqual(list(nodes), [41, 42, 61, 62])
+
+        #adjacent points in j are consecutive
+        nodes = grib_regrid.window_nodes(self.grid(0x20), (1, 3, 2, 4))
+        self.assertEqual(list(nodes), [17, 18, 32, 33])
+
+
+    def test_cropped_weights(self):
+        #the cropped weights applied to the cropped values give the same frame as the full weights and field
+        for scanning_mode in [0, 0x20, 0x40, 0x60]:
+            grid = self.grid(scanning_mode)
+            weights = grib_regrid.build_weights(grid, self.r2c)
+            values = numpy.random.RandomState(scanning_mode).uniform(-20.0, 20.0, 300)
+            nodes = grib_regrid.window_nodes(grid, grib_regrid.crop_window(grid, self.r2c))
+            self.assertTrue(len(nodes) < 300)
+
+            cropped = grib_regrid.crop_weights(weights, "crop %d" % scanning_mode, nodes)
+            self.assertEqual(cropped.shape, (48, len(nodes)))
+            self.assertTrue(numpy.allclose(cropped.dot(values[nodes]), weights.dot(values)))
+            self.assertTrue(grib_regrid.crop_weights(weights, "crop %d" % scanning_mode, nodes) is cropped)
+
+
+    def test_weights_outside_crop(self):
+        #weights that use points outside the crop can't be cropped, the whole field is needed
+        grid = self.grid(0)
+        weights = grib_regrid.build_weights(grid, self.r2c)
+        nodes = grib_regrid.window_nodes(grid, (10, 13, 7, 11))
+        self.assertTrue(grib_regrid.crop_weights(weights, "part of the template", nodes) is None)
+
+        nodes = grib_regrid.window_nodes(grid, grib_regrid.crop_window(grid, self.r2c, halo = 0))
+        self.assertTrue(grib_regrid.crop_weights(weights, "template", nodes) is not None)
+
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,192 @@
+"""
+Tests of the ensemble grib decoding of pyEnsim_basics, with a stand-in for pyEnSim that counts what is loaded
+and decoded, run with: python -m unittest discover -s tests
+"""
+
+#import standard modules
+import os
+import re
+import sys
+import json
+import types
+import shutil
+import tempfile
+import unittest
+
+#import scientific modules
+import numpy
+import scipy.sparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import grib_index
+from test_grib_index import grib2_message
+
+#pyEnsim_basics imports pyEnSim, which is only there where EnSim is installed; the tests use FakePyEnSim either way
+try:
+    import pyEnSim.pyEnSim
+    import pyEnsim_basics
+except ImportError:
+    sys.modules["pyEnSim"] = types.ModuleType("pyEnSim")
+    sys.modules["pyEnSim.pyEnSim"] = types.ModuleType("pyEnSim.pyEnSim")
+    sys.modules["pyEnSim"].pyEnSim = sys.modules["pyEnSim.pyEnSim"]
+    try:
+        import pyEnsim_basics
+    finally:
+        #the other tests still see that pyEnSim isn't installed
+        del sys.modules["pyEnSim"]
+        del sys.modules["pyEnSim.pyEnSim"]
+
+
+
+class FakeRaster(object):
+
+    def __init__(self, values):
+        self.values = list(values)
+
+
+    def InitAttributes(self):
+        pass
+
+
+    def GetNodeCount(self):
+        return len(self.values)
+
+
+    def GetNodeValue(self, k):
+        return self.values[k]
+
+
+    def SetNodeValue(self, k, value):
+        self.values[k] = value
+
+
+
+class FakeGribFile(object):
+    """
+    stands in for pyEnSim.CGrib2File, each message of the grib file holds a child's node values as json
+    (see grib_file()). Every file loaded and every child decoded is counted
+    """
+
+    loaded = []
+    decoded = []
+
+
+    def SetFullFileName(self, path):
+        self.path = path
+
+
+    def LoadFromFile(self):
+        FakeGribFile.loaded.append(self.path)
+        grib_file = open(self.path, "rb")
+        try:
+            content = grib_file.read()
+        finally:
+            grib_file.close()
+        self.children = [json.loads(values) for values in re.findall(r"\[[^\]]*\]", content)]
+
+
+    def InitAttributes(self):
+        pass
+
+
+    def GetChildrenCount(self):
+        return len(self.children)
+
+
+    def GetChild(self, i):
+        FakeGribFile.decoded.append((self.path, i))
+        return FakeRaster(self.children[i])
+
+
+
+class FakePyEnSim(object):
+    CGrib2File = FakeGribFile
+
+
+
+class EnsembleDecodingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.pyEnSim = pyEnsim_basics.pyEnSim
+        pyEnsim_basics.pyEnSim = FakePyEnSim
+        pyEnsim_basics._raster_cache.clear()
+        FakeGribFile.loaded = []
+        FakeGribFile.decoded = []
+
+        #accumulated precipitation of 4 members over 3 grib nodes, at 2 timesteps
+        self.previous_values = numpy.array([[1.0, 2.0, 3.0], [0.0, 0.0, 0.0], [5.0, 5.0, 5.0], [2.0, 4.0, 6.0]])
+        self.values = numpy.array([[2.0, 2.5, 3.0], [1.0, 0.0, 4.0], [6.0, 7.0, 8.0], [1.0, 9.0, 6.5]])
+        self.previous = self.grib_file("CMC_000.grib2", self.previous_values)
+        self.grib = self.grib_file("CMC_003.grib2", self.values)
+
+        #a 2 node template: node 0 is the mean of the first two grib nodes, node 1 is the third grib node
+        self.weights = scipy.sparse.csr_matrix(numpy.array([[0.5, 0.5, 0.0], [0.0, 0.0, 1.0]]))
+        self.template = FakeRaster([0.0, 0.0])
+
+
+    def tearDown(self):
+        pyEnsim_basics.pyEnSim = self.pyEnSim
+        pyEnsim_basics._raster_cache.clear()
+        shutil.rmtree(self.directory)
+
+
+    def grib_file(self, name, members):
+        path = os.path.join(self.directory, name)
+        grib_file = open(path, "wb")
+        try:
+            grib_file.write("".join([grib2_message(1, json.dumps(list(values))) for values in members]))
+        finally:
+            grib_file.close()
+        return path
+
+
+    def test_read_children(self):
+        values = pyEnsim_basics.read_children(self.grib, [0, 1, 2, 3])
+        self.assertTrue(numpy.array_equal(values, self.values))
+        self.assertEqual(FakeGribFile.loaded, [self.grib])
+        self.assertEqual(sorted(FakeGribFile.decoded), [(self.grib, i) for i in range(4)])
+
+        #the decoded children are reused, in any order
+        values = pyEnsim_basics.read_children(self.grib, [3, 1])
+        self.assertTrue(numpy.array_equal(values, self.values[[3, 1]]))
+        self.assertEqual(len(FakeGribFile.loaded), 1)
+        self.assertEqual(len(FakeGribFile.decoded), 4)
+
+
+    def test_members_decoded_once(self):
+        frames = pyEnsim_basics.grib_to_arrays(self.grib, self.template, [0, 1, 2, 3], grib_previous = self.previous,
+                                               regrid_weights = self.weights)
+
+        deaccumulated = numpy.maximum(self.values - self.previous_values, 0)
+        self.assertEqual([i for i, values in frames], [0, 1, 2, 3])
+        for i, values in frames:
+            self.assertTrue(numpy.allclose(values, self.weights.dot(deaccumulated[i])))
+
+        #each grib file is loaded once and each member decoded once, whatever the number of members
+        self.assertEqual(sorted(FakeGribFile.loaded), sorted([self.grib, self.previous]))
+        self.assertEqual(sorted(FakeGribFile.decoded), sorted([(path, i) for path in [self.grib, self.previous] for i in range(4)]))
+
+        #the next timestep is de-accumulated with the grib file just decoded, it isn't loaded again
+        following = self.grib_file("CMC_006.grib2", self.values + 1.0)
+        pyEnsim_basics.grib_to_arrays(following, self.template, [0, 1, 2, 3], grib_previous = self.grib, regrid_weights = self.weights)
+        self.assertEqual(FakeGribFile.loaded.count(self.grib), 1)
+        self.assertEqual(len(FakeGribFile.decoded), 12)
+
+
+    def test_only_requested_members_loaded(self):
+        frames = pyEnsim_basics.grib_to_arrays(self.grib, self.template, [2, 7], regrid_weights = self.weights)
+
+        #the file has no member 7, and only member 2's message is loaded (from a temporary grib file)
+        self.assertEqual([i for i, values in frames], [2])
+        self.assertTrue(numpy.allclose(frames[0][1], self.weights.dot(self.values[2])))
+        self.assertEqual(len(FakeGribFile.loaded), 1)
+        self.assertNotEqual(FakeGribFile.loaded[0], self.grib)
+        self.assertFalse(os.path.exists(FakeGribFile.loaded[0]))
+        self.assertEqual(len(FakeGribFile.decoded), 1)
+        self.assertEqual(len(grib_index.read_index(self.grib)), 4)
+
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,246 @@
+"""
+Tests of r2c_io, run with: python -m unittest discover -s tests
+"""
+
+#import standard modules
+import os
+import sys
+import shutil
+import datetime
+import tempfile
+import unittest
+
+#import scientific modules
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import r2c_io
+
+try:
+    import pyEnSim.pyEnSim as pyEnSim
+except ImportError:
+    pyEnSim = None
+
+
+HEADER = ["########################################",
+          ":FileType r2c  ASCII  EnSim 1.0",
+          "#",
+          ":Projection         LATLONG",
+          ":Ellipsoid          WGS84",
+          "#",
+          ":xOrigin            -95.000000",
+          ":yOrigin            48.000000",
+          "#",
+          ":AttributeName 1 Temperature",
+          "#",
+          ":xCount             3",
+          ":yCount             2",
+          ":xDelta             0.100000",
+          ":yDelta             0.100000",
+          "#",
+          ":EndHeader"]
+
+
+
+class R2CIOTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "test.r2c")
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def frames(self, count):
+        start = datetime.datetime(2016, 1, 1)
+        return [(i + 1, start + datetime.timedelta(hours = 3 * i), numpy.arange(6.0).reshape(2, 3) * (i + 1) - 2.5)
+                for i in range(count)]
+
+
+    def read(self, path):
+        r2c_file = open(path, "rb")
+        try:
+            return r2c_file.read()
+        finally:
+            r2c_file.close()
+
+
+    def write(self, path, text):
+        r2c_file = open(path, "wb")
+        try:
+            r2c_file.write(text)
+        finally:
+            r2c_file.close()
+
+
+    def test_round_trip(self):
+        frames = self.frames(3)
+        r2c_io.write_r2c(self.path, HEADER, frames)
+
+        r2c = r2c_io.R2CFile(self.path)
+        try:
+            self.assertEqual(r2c.header_lines, HEADER)
+            self.assertEqual((r2c.xcount, r2c.ycount), (3, 2))
+            self.assertEqual(len(r2c), 3)
+            self.assertEqual([frame[0] for frame in r2c.frames], [1, 2, 3])
+            self.assertEqual(r2c.frame_times(), [frame[1] for frame in frames])
+            for n, frame in enumerate(frames):
+                numpy.testing.assert_array_equal(r2c.read_frame(n), frame[2])
+            numpy.testing.assert_array_equal(r2c.read_frame(-1), frames[-1][2])
+
+            times, data = r2c.read_frames(frames[1][1], None)
+            self.assertEqual(times, [frames[1][1], frames[2][1]])
+            self.assertEqual(data.shape, (2, 2, 3))
+        finally:
+            r2c.close()
+
+        self.assertEqual(r2c_io.last_frame(self.path), (3, 3, frames[2][1]))
+
+
+    def test_truncate_and_append(self):
+        frames = self.frames(3)
+        r2c_io.write_r2c(self.path, HEADER, frames)
+        expected = self.read(self.path)
+
+        r2c_io.truncate_frames(self.path, 1)
+        self.assertEqual(r2c_io.last_frame(self.path)[0], 1)
+        r2c_io.append_frames(self.path, frames[1:])
+        self.assertEqual(self.read(self.path), expected)
+
+        r2c_io.truncate_frames(self.path, 0)
+        self.assertEqual(self.read(self.path), "\n".join(HEADER) + "\n")
+
+
+    def test_writer_appends_like_first_frame(self):
+        #a first frame with aligned fields, seconds in the timestamp, 3 digit exponents and windows line endings
+        first_frame = ('\r\n'.join(HEADER) + '\r\n'
+                       ':Frame         1         1 "2016/01/01 00:00:00.000"\r\n'
+                       ' 2.7315000e+002 2.7415000e+002 2.7515000e+002\r\n'
+                       ' 2.7615000e+002 2.7715000e+002 1.0000000e-001\r\n'
+                       ':EndFrame\r\n')
+        self.write(self.path, first_frame)
+
+        writer = r2c_io.R2CWriter(self.path)
+        writer.add_frame(2, datetime.datetime(2016, 1, 1, 3), [273.25, 0.0, 1.5, 10.0, 0.125, 1e-6])
+        writer.close()
+
+        self.assertEqual(self.read(self.path), first_frame +
+                         ':Frame         2         2 "2016/01/01 03:00:00.000"\r\n'
+                         ' 2.7325000e+002 0.0000000e+000 1.5000000e+000\r\n'
+                         ' 1.0000000e+001 1.2500000e-001 1.0000000e-006\r\n'
+                         ':EndFrame\r\n')
+        self.assertEqual(r2c_io.last_frame(self.path), (2, 2, datetime.datetime(2016, 1, 1, 3)))
+
+
+    def test_writer_appends_like_separated_first_frame(self):
+        #a first frame with values separated by whitespace, and a space at the end of each line
+        first_frame = ('\n'.join(HEADER) + '\n'
+                       ':Frame 1 1 "2016/01/01 00:00"\n'
+                       '0.250 -1.500 2.000 \n'
+                       '3.000 4.000 5.000 \n'
+                       ':EndFrame\n')
+        self.write(self.path, first_frame)
+
+        r2c_io.append_frames(self.path, [(10, datetime.datetime(2016, 1, 2), numpy.array([[1, 2, 3], [-4, 5, 6.0625]]))])
+
+        self.assertEqual(self.read(self.path), first_frame +
+                         ':Frame 10 10 "2016/01/02 00:00"\n'
+                         '1.000 2.000 3.000 \n'
+                         '-4.000 5.000 6.062 \n'
+                         ':EndFrame\n')
+
+
+    def test_default_layout_without_frames(self):
+        r2c_io.write_r2c(self.path, HEADER, [])
+        self.assertTrue(r2c_io.frame_layout(self.path) is None)
+
+        writer = r2c_io.R2CWriter(self.path)
+        for frame_index, frame_time, values in self.frames(2):
+            writer.add_frame(frame_index, frame_time, values.ravel())
+        writer.close()
+
+        expected = os.path.join(self.directory, "expected.r2c")
+        r2c_io.write_r2c(expected, HEADER, self.frames(2))
+        self.assertEqual(self.read(self.path), self.read(expected))
+
+
+    def test_assembler_creates_files_with_first_frame(self):
+        frames = self.frames(4)
+        created = []
+        def create(r2c_path, frame_index, frame_time, values):
+            #stands in for pyEnSim, the first frame is written in another layout than the default one
+            created.append(frame_index)
+            r2c_io.write_r2c(r2c_path, HEADER, [(frame_index, frame_time, values)], r2c_io.FrameLayout(time_format = "%Y/%m/%d %H:%M:%S.000"))
+
+        written = []
+        assembler = r2c_io.FrameAssembler({self.path: [1, 2, 3, 4]}, {self.path: HEADER},
+                                          on_write = lambda *frame: written.append(frame[1]), create = create)
+        for n, pending in [(2, 1), (1, 2), (3, 3), (0, 0)]:
+            assembler.add_frame(self.path, *frames[n])
+            self.assertEqual(assembler.pending_frames(), pending)
+        assembler.close()
+
+        self.assertEqual(created, [1])
+        self.assertEqual(written, [1, 2, 3, 4])
+        self.assertEqual(assembler.frames_written(self.path), 4)
+
+        expected = os.path.join(self.directory, "expected.r2c")
+        r2c_io.write_r2c(expected, HEADER, frames, r2c_io.FrameLayout(time_format = "%Y/%m/%d %H:%M:%S.000"))
+        self.assertEqual(self.read(self.path), self.read(expected))
+
+
+    @unittest.skipIf(pyEnSim is None, "pyEnSim is not installed")
+    def test_writer_matches_pyensim(self):
+        #pyEnSim writes the first frame of both files, the second frame is appended by pyEnSim to one and by R2CWriter to the other
+        template_path = os.path.join(self.directory, "template.r2c")
+        r2c_io.write_r2c(template_path, HEADER, self.frames(1))
+        frames = self.frames(2)
+
+        paths = []
+        for name in ["pyensim.r2c", "writer.r2c"]:
+            template = pyEnSim.CRect2DCell()
+            template.SetFullFileName(template_path)
+            template.LoadFromFile()
+            template.InitAttributes()
+            path = os.path.join(self.directory, name)
+            paths.append(path)
+
+            for frame_index, frame_time, values in frames:
+                if name == "writer.r2c" and frame_index > 1:
+                    writer = r2c_io.R2CWriter(path)
+                    writer.add_frame(frame_index, frame_time, values)
+                    writer.close()
+                    continue
+
+                for k, value in enumerate(values.ravel().tolist()):
+                    template.SetNodeValue(k, value)
+                time_step = pyEnSim.CEnSimDateTime()
+                time_step.Set(frame_time.year, frame_time.month, frame_time.day, frame_time.hour, 0, 0, 0)
+                template.SetCurrentFrameCounter(frame_index)
+                template.SetCurrentStep(frame_index)
+                template.SetCurrentStepTime(time_step)
+                if frame_index == 1:
+                    template.SaveToMultiFrameASCIIFile(path, 0)
+                else:
+                    template.AppendToMultiFrameASCIIFile(path, 0)
+
+        pyensim_r2c = r2c_io.R2CFile(paths[0])
+        writer_r2c = r2c_io.R2CFile(paths[1])
+        try:
+            self.assertEqual(len(pyensim_r2c), len(writer_r2c))
+            for n in range(len(pyensim_r2c)):
+                start, end = pyensim_r2c.frames[n][3:5]
+                writer_start, writer_end = writer_r2c.frames[n][3:5]
+                self.assertEqual(pyensim_r2c.frames[n][:3], writer_r2c.frames[n][:3])
+                self.assertEqual(pyensim_r2c._map[start:end], writer_r2c._map[writer_start:writer_end])
+        finally:
+            pyensim_r2c.close()
+            writer_r2c.close()
+        self.assertEqual(self.read(paths[0]), self.read(paths[1]))
+
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,149 @@
+"""
+Tests of snapshot, run with: python -m unittest discover -s tests
+"""
+
+#import standard modules
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import snapshot
+
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, "Repo")
+        self.target = os.path.join(self.directory, "Repo_hindcast")
+        self.write("wpegr/basin/wpegr_shd.r2c", "shed")
+        self.write("wpegr/results/spl.csv", "flows")
+        self.write("wpegr/resume.txt", "resume")
+        self.write("wxData/met.grib2", "grib")
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def write(self, name, content, mtime = None):
+        path = os.path.join(self.source, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        source_file = open(path, "wb")
+        try:
+            source_file.write(content)
+        finally:
+            source_file.close()
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+
+    def read(self, path):
+        target_file = open(path, "rb")
+        try:
+            return target_file.read()
+        finally:
+            target_file.close()
+
+
+    def inode(self, root, name):
+        return os.stat(os.path.join(root, name)).st_ino
+
+
+    def test_first_snapshot_copied(self):
+        counts = snapshot.take_snapshot(self.source, self.target)
+        self.assertEqual(counts, {"linked": 0, "copied": 4, "copied_bytes": 19})
+        self.assertEqual(self.read(os.path.join(self.target, "wpegr", "resume.txt")), "resume")
+        self.assertNotEqual(self.inode(self.target, "wpegr/resume.txt"), self.inode(self.source, "wpegr/resume.txt"))
+
+
+    def test_unchanged_files_linked(self):
+        snapshot.take_snapshot(self.source, self.target)
+        previous = self.inode(self.target, "wpegr/basin/wpegr_shd.r2c")
+
+        #a file of the same size and modification time is unchanged
+        self.write("wpegr/results/spl.csv", "FLOWS", mtime = 1000)
+        self.write("wpegr/resume.txt", "resume 2")
+        counts = snapshot.take_snapshot(self.source, self.target)
+
+        self.assertEqual(counts, {"linked": 2, "copied": 2, "copied_bytes": 13})
+        self.assertEqual(self.inode(self.target, "wpegr/basin/wpegr_shd.r2c"), previous)
+        self.assertEqual(self.read(os.path.join(self.target, "wpegr", "results", "spl.csv")), "FLOWS")
+        self.assertEqual(self.read(os.path.join(self.target, "wpegr", "resume.txt")), "resume 2")
+        self.assertFalse(os.path.exists(self.target + snapshot.PARTIAL_SUFFIX))
+        self.assertFalse(os.path.exists(self.target + snapshot.OLD_SUFFIX))
+
+        #writing to 'Repo' doesn't change the snapshot
+        self.write("wpegr/resume.txt", "resume 3")
+        self.assertEqual(self.read(os.path.join(self.target, "wpegr", "resume.txt")), "resume 2")
+
+
+    def test_ignore(self):
+        snapshot.take_snapshot(self.source, self.target, ignore = shutil.ignore_patterns("wxData", "results"))
+        self.assertEqual(sorted(os.listdir(self.target)), ["wpegr"])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.target, "wpegr"))), ["basin", "resume.txt"])
+
+
+    def test_recovery_from_interrupted_snapshot(self):
+        snapshot.take_snapshot(self.source, self.target)
+        previous = self.inode(self.target, "wpegr/resume.txt")
+
+        #stopped while building the new snapshot
+        shutil.copytree(self.source, self.target + snapshot.PARTIAL_SUFFIX)
+        counts = snapshot.take_snapshot(self.source, self.target)
+        self.assertEqual(counts["linked"], 4)
+        self.assertFalse(os.path.exists(self.target + snapshot.PARTIAL_SUFFIX))
+
+        #stopped while swapping, after the previous snapshot was renamed: it is still the previous snapshot
+        os.rename(self.target, self.target + snapshot.OLD_SUFFIX)
+        counts = snapshot.take_snapshot(self.source, self.target)
+        self.assertEqual(counts["linked"], 4)
+        self.assertEqual(self.inode(self.target, "wpegr/resume.txt"), previous)
+        self.assertFalse(os.path.exists(self.target + snapshot.OLD_SUFFIX))
+
+        #stopped before the old snapshot was removed
+        shutil.copytree(self.target, self.target + snapshot.OLD_SUFFIX)
+        snapshot.take_snapshot(self.source, self.target)
+        self.assertEqual(self.inode(self.target, "wpegr/resume.txt"), previous)
+        self.assertFalse(os.path.exists(self.target + snapshot.OLD_SUFFIX))
+
+
+    def test_failed_snapshot_keeps_previous(self):
+        snapshot.take_snapshot(self.source, self.target)
+        self.write("wpegr/resume.txt", "resume 2")
+
+        def fail(source, target):
+            raise IOError("disk full")
+        clone = snapshot._clone
+        snapshot._clone = fail
+        try:
+            self.assertRaises(IOError, snapshot.take_snapshot, self.source, self.target)
+        finally:
+            snapshot._clone = clone
+
+        self.assertEqual(self.read(os.path.join(self.target, "wpegr", "resume.txt")), "resume")
+        self.assertFalse(os.path.exists(self.target + snapshot.PARTIAL_SUFFIX))
+
+
+    def test_link_tree(self):
+        workspace = os.path.join(self.directory, "Repo_runs", "01-01")
+        model_directory = os.path.join(self.source, "wpegr")
+        os.makedirs(os.path.dirname(workspace))
+        counts = snapshot.link_tree(model_directory, workspace, read_only = lambda path: os.path.dirname(path) != model_directory,
+                                    ignore = shutil.ignore_patterns("results"))
+
+        self.assertEqual(counts, {"linked": 1, "copied": 1, "copied_bytes": 6})
+        self.assertEqual(sorted(os.listdir(workspace)), ["basin", "resume.txt"])
+        self.assertEqual(self.inode(workspace, "basin/wpegr_shd.r2c"), self.inode(model_directory, "basin/wpegr_shd.r2c"))
+        self.assertNotEqual(self.inode(workspace, "resume.txt"), self.inode(model_directory, "resume.txt"))
+
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,151 @@
+"""
+Tests of tempdiff, run with: python -m unittest discover -s tests
+"""
+
+#import standard modules
+import os
+import sys
+import shutil
+import datetime
+import tempfile
+import unittest
+
+#import scientific modules
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import r2c_io
+import tempdiff
+
+
+HEADER = [":FileType r2c  ASCII  EnSim 1.0", "#", ":AttributeName 1 Temperature", ":xCount 3", ":yCount 2", ":EndHeader"]
+
+#temperature frames over two and a bit days
+FRAMES = [(datetime.datetime(2016, 1, 1, 0), [[-5.0, 0.0, 2.5], [10.0, -1.25, 3.0]]),
+          (datetime.datetime(2016, 1, 1, 12), [[-1.0, 4.0, 2.5], [12.5, -3.0, 3.04]]),
+          (datetime.datetime(2016, 1, 1, 18), [[-7.5, 1.0, 2.5], [11.0, 0.0, 2.96]]),
+          (datetime.datetime(2016, 1, 2, 0), [[0.0, 0.0, 0.0], [0.0, 0.0, 0.0]]),
+          (datetime.datetime(2016, 1, 2, 6), [[20.3, -0.5, 1.0], [-4.0, 0.0, 100.0]]),
+          (datetime.datetime(2016, 1, 3, 3), [[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]])]
+
+#the dif file tempdiff.r writes from FRAMES (see writer2c() in tempdiff.r): the header of the temperature file,
+#then each day's max - min at 00:00 with sprintf("%.1f") values separated by a space, with unix line endings
+TEMPDIFF_R_OUTPUT = "\n".join(HEADER + [
+    ':Frame  1   1   "2016/01/01 00:00"',
+    "6.5 4.0 0.0",
+    "2.5 3.0 0.1",
+    ":EndFrame",
+    ':Frame  2   2   "2016/01/02 00:00"',
+    "20.3 0.5 1.0",
+    "4.0 0.0 100.0",
+    ":EndFrame",
+    ':Frame  3   3   "2016/01/03 00:00"',
+    "0.0 0.0 0.0",
+    "0.0 0.0 0.0",
+    ":EndFrame"]) + "\n"
+
+
+
+class TempdiffTest(unittest.TestCase):
+
+    newline = "\n"
+
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.tem_path = os.path.join(self.directory, "20160101_tem.r2c")
+        self.dif_path = os.path.join(self.directory, "20160101_dif.r2c")
+
+        #the dif files are written with the line ending tempdiff.r has on the platform
+        self.layout = tempdiff.DIF_LAYOUT
+        tempdiff.DIF_LAYOUT = r2c_io.FrameLayout(**dict(self.layout.__dict__, newline = self.newline))
+        self.expected = TEMPDIFF_R_OUTPUT.replace("\n", self.newline)
+
+
+    def tearDown(self):
+        tempdiff.DIF_LAYOUT = self.layout
+        shutil.rmtree(self.directory)
+
+
+    def write_tem(self, frames):
+        r2c_io.write_r2c(self.tem_path, HEADER, [(n + 1, frame_time, numpy.array(values))
+                                                 for n, (frame_time, values) in enumerate(frames)])
+
+
+    def read(self, path):
+        r2c_file = open(path, "rb")
+        try:
+            return r2c_file.read()
+        finally:
+            r2c_file.close()
+
+
+    def test_dif_path(self):
+        self.assertEqual(tempdiff.dif_path(self.tem_path), self.dif_path)
+
+
+    def test_platform_line_ending(self):
+        self.assertEqual(self.layout.newline, os.linesep)
+
+
+    def test_update_dif_matches_tempdiff_r(self):
+        self.write_tem(FRAMES)
+        self.assertEqual(tempdiff.update_dif(self.tem_path), 3)
+        self.assertEqual(self.read(self.dif_path), self.expected)
+
+
+    def test_update_dif_incremental(self):
+        #the last day of the first pass isn't complete, it is made again with the frames added since
+        self.write_tem(FRAMES[0:4])
+        self.assertEqual(tempdiff.update_dif(self.tem_path), 2)
+        self.write_tem(FRAMES)
+        self.assertEqual(tempdiff.update_dif(self.tem_path), 2)
+        self.assertEqual(self.read(self.dif_path), self.expected)
+
+        #a temperature file that starts on another day is made again from the start
+        self.write_tem([(frame_time + datetime.timedelta(days = 1), values) for frame_time, values in FRAMES])
+        self.assertEqual(tempdiff.update_dif(self.tem_path), 3)
+        self.assertEqual(self.read(self.dif_path), self.expected.replace("2016/01/03", "2016/01/04")
+                         .replace("2016/01/02", "2016/01/03").replace("2016/01/01", "2016/01/02"))
+
+
+    def test_dif_files_written_during_conversion(self):
+        #the temperature frames are added as they are converted, the dif file is the one update_dif() makes
+        other_path = os.path.join(self.directory, "20160102_tem.r2c")
+        self.write_tem(FRAMES)
+        dif_files = tempdiff.DifFiles()
+        dif_files.add_file(self.tem_path)
+        for n, (frame_time, values) in enumerate(FRAMES):
+            dif_files.add_frame(self.tem_path, n + 1, frame_time, numpy.array(values))
+            dif_files.add_frame(other_path, n + 1, frame_time, numpy.array(values))
+        self.assertEqual(dif_files.close(), 1)
+
+        self.assertEqual(self.read(self.dif_path), self.expected)
+        self.assertFalse(os.path.exists(tempdiff.dif_path(other_path)))
+
+
+    def test_dif_files_of_partly_converted_file(self):
+        #only the frames from the last day on are converted in this pass, the dif file is updated when it is closed
+        self.write_tem(FRAMES[0:4])
+        tempdiff.update_dif(self.tem_path)
+        self.write_tem(FRAMES)
+        dif_files = tempdiff.DifFiles()
+        dif_files.update_file(self.tem_path)
+        for n in range(3, len(FRAMES)):
+            dif_files.add_frame(self.tem_path, n + 1, FRAMES[n][0], numpy.array(FRAMES[n][1]))
+        self.assertEqual(dif_files.close(), 1)
+
+        self.assertEqual(self.read(self.dif_path), self.expected)
+
+
+
+
+class WindowsTempdiffTest(TempdiffTest):
+
+    #tempdiff.r on windows
+    newline = "\r\n"
+
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+"""
+Tests of worker_pool, run with: python -m unittest discover -s tests
+"""
+
+#import standard modules
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import threading
+import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import worker_pool
+
+
+
+def pool_state():
+    #whether the worker can take the pool lock, and the pools it knows of
+    acquired = worker_pool._pool_lock.acquire(False)
+    if acquired:
+        worker_pool._pool_lock.release()
+    return acquired, len(worker_pool._pools)
+
+
+
+def change_directory(directory):
+    os.chdir(directory)
+    return os.getcwd()
+
+
+
+def current_directory(k):
+    return os.getcwd()
+
+
+
+def fail():
+    raise ValueError("task failed")
+
+
+
+class WorkerPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = os.path.realpath(tempfile.mkdtemp())
+        self.cwd = os.getcwd()
+        self.pools = []
+
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        for pool in self.pools:
+            pool.shutdown(terminate = True)
+        self.shutdown()
+        shutil.rmtree(self.directory)
+
+
+    def pool(self, processes = 1, threads = False):
+        pool = worker_pool.WorkerPool(processes, threads)
+        self.pools.append(pool)
+        return pool
+
+
+    def shutdown(self):
+        #shutdown() prints the stats of the shared pools
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            worker_pool.shutdown()
+        finally:
+            sys.stdout = stdout
+
+
+    def test_init_worker(self):
+        #a worker forked while the framework holds the lock and has a shared pool starts with neither
+        worker_pool.get_thread_pool()
+        with worker_pool._pool_lock:
+            pool = self.pool()
+        self.assertEqual(pool.apply_async(pool_state).get(10), (True, 0))
+        self.assertEqual(len(worker_pool._pools), 1)
+
+
+    def test_tasks_run_in_submitting_directory(self):
+        pool = self.pool()
+        os.chdir(self.directory)
+        other = os.path.join(self.directory, "other")
+        os.mkdir(other)
+
+        self.assertEqual(pool.apply_async(change_directory, (other,)).get(10), other)
+        self.assertEqual(pool.apply_async(current_directory, (0,)).get(10), self.directory)
+
+        os.chdir(other)
+        self.assertEqual(pool.map(current_directory, range(3)), [other] * 3)
+        self.assertEqual(list(pool.imap_unordered(current_directory, range(3))), [other] * 3)
+
+
+    def test_failed_task_counted_once(self):
+        pool = self.pool()
+        result = pool.apply_async(fail)
+        self.assertRaises(ValueError, result.get, 10)
+        self.assertRaises(ValueError, result.get, 10)
+        self.assertEqual((pool.submitted, pool.completed, pool.busy_seconds), (1, 1, 0.0))
+
+        self.assertEqual(pool.apply_async(current_directory, (0,)).get(10), self.cwd)
+        self.assertEqual((pool.submitted, pool.completed, pool.queue_depth()), (2, 2, 0))
+
+
+    def test_shared_pool(self):
+        #every stage gets the same pool until it is shut down
+        pool = worker_pool.get_pool()
+        self.assertTrue(worker_pool.get_pool() is pool)
+        self.assertFalse(pool.threads)
+        thread_pool = worker_pool.get_thread_pool()
+        self.assertTrue(thread_pool.threads)
+        self.assertTrue(worker_pool.get_thread_pool() is thread_pool)
+        self.assertEqual(pool.map(current_directory, range(4)), [self.cwd] * 4)
+
+        self.shutdown()
+        self.assertEqual(worker_pool._pools, {})
+        self.assertFalse(worker_pool.get_pool() is pool)
+
+
+    def test_shared_pool_started_once(self):
+        pools = []
+        def get_pool():
+            pools.append(worker_pool.get_pool())
+        threads = [threading.Thread(target = get_pool) for k in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(pools), 4)
+        self.assertEqual(len(set([id(pool) for pool in pools])), 1)
+        self.assertTrue(worker_pool.get_pool() is pools[0])
+
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,323 @@
+"""
+Pool of worker processes shared by the framework stages (forecast conversion, WATFLOOD runs and post-processing).
+
+Each stage used to start its own multiprocessing.Pool, which was never closed, so every stage (and every met
+scenario of the forecast) paid for starting the processes again and the old pools piled up. The pool here is
+started the first time it is needed and reused until shutdown() is called at the end of the run
+(see LWCB_Framework_Run_Model.py), or the process exits.
+
+Tasks are run from the working directory the framework had when they were submitted, as if they were run on a
+new pool, so a task that changes directory doesn't affect the next one.
+The pool keeps count of the tasks waiting for a worker (queue depth) and of the time the workers spent on tasks
+(utilisation), see WorkerPool.stats(). Each worker process is replaced after MAX_TASKS_PER_CHILD tasks, which
+frees what the tasks cached in it.
+
+Tasks that mostly wait on a subprocess (ie. WATFLOOD runs, see FrameworkLibrary.run_executable) can run on a
+pool of threads instead (see get_thread_pool()), which is cheaper than forked Python workers. Tasks on the
+thread pool must not change the current directory.
+"""
+
+#import standard modules
+import os
+import time
+import atexit
+import threading
+import multiprocessing
+import multiprocessing.pool
+
+
+#the pools shared by the framework (keyed by whether they are thread pools), see get_pool() and get_thread_pool()
+_pools = {}
+_pool_lock = threading.Lock()
+
+#tasks a worker process runs before it is replaced by a new one, so the caches the conversion builds up in the
+#workers (ie. pyEnSim_basics' templates and RasterCache, grib_regrid's weights) don't stay in memory
+#for the rest of the run
+MAX_TASKS_PER_CHILD = 100
+
+
+
+def _init_worker():
+    """
+    runs in each new worker process. The worker is forked from the framework, possibly while another thread
+    held the lock, and never uses the framework's pools
+    """
+
+    global _pool_lock
+    _pool_lock = threading.Lock()
+    _pools.clear()
+
+
+
+def _run_task(task):
+    """
+    runs a task in a worker process
+
+    Args:
+        task: (function, tuple of arguments, working directory or None to stay in the current directory)
+    Returns:
+        (seconds spent on the task, result of the function)
+    """
+
+    function, args, directory = task
+    start = time.time()
+    if directory is not None:
+        os.chdir(directory)
+    result = function(*args)
+    return time.time() - start, result
+
+
+
+class TaskResult(object):
+    """
+    Result of a task submitted with WorkerPool.apply_async(), same use as multiprocessing's AsyncResult
+    """
+
+    def __init__(self, pool, async_result):
+        self._pool = pool
+        self._async_result = async_result
+        self._collected = False
+
+
+    def ready(self):
+        return self._async_result.ready()
+
+
+    def get(self, timeout = None):
+        try:
+            busy, result = self._async_result.get(timeout)
+        except multiprocessing.TimeoutError:
+            raise
+        except:
+            self._collect(0.0)
+            raise
+        self._collect(busy)
+        return result
+
+
+    def _collect(self, busy):
+        if not self._collected:
+            self._collected = True
+            self._pool._task_done(busy)
+
+
+
+class WorkerPool(object):
+    """
+    Pool of worker processes that keeps track of its queue depth and utilisation.
+
+    Usage:
+        pool = worker_pool.get_pool()
+        results = pool.map(function, inputs)
+        for result in pool.imap_unordered(function, inputs):
+            ...
+        print pool.stats()
+
+    Args:
+        processes: number of worker processes, defaults to the number of cpus
+        threads: run the tasks on threads of this process instead of worker processes
+    """
+
+    def __init__(self, processes = False, threads = False):
+        if processes is False:
+            processes = multiprocessing.cpu_count()
+        self.processes = max(1, processes)
+        self.threads = threads
+        self.started = time.time()
+        self.submitted = 0
+        self.completed = 0
+        self.busy_seconds = 0.0
+        self.peak_queue_depth = 0
+        self._lock = threading.Lock()
+        if threads:
+            self._pool = multiprocessing.pool.ThreadPool(processes = self.processes)
+        else:
+            self._pool = multiprocessing.Pool(processes = self.processes, initializer = _init_worker,
+                                              maxtasksperchild = MAX_TASKS_PER_CHILD)
+
+
+    def _task(self, function, args):
+        with self._lock:
+            self.submitted += 1
+            self.peak_queue_depth = max(self.peak_queue_depth, self.submitted - self.completed - self.processes)
+        if self.threads:
+            return (function, args, None)
+        return (function, args, os.getcwd())
+
+
+    def _task_done(self, busy):
+        with self._lock:
+            self.completed += 1
+            self.busy_seconds += busy
+
+
+    def _collect(self, results):
+        #results come back as (seconds spent, result), the time is added to the utilisation
+        while True:
+            try:
+                busy, result = results.next()
+            except StopIteration:
+                return
+            except:
+                self._task_done(0.0)
+                raise
+            self._task_done(busy)
+            yield result
+
+
+    def map(self, function, inputs):
+        """
+        runs function(input) for every input, like multiprocessing.Pool.map() (each input is a separate task)
+
+        Returns:
+            list of the results, in the order of the inputs
+        """
+
+        return list(self.imap(function, inputs))
+
+
+    def imap(self, function, inputs, chunksize = 1):
+        """
+        Returns:
+            iterator of the results of function(input) for every input, in the order of the inputs
+        """
+
+        return self._collect(self._pool.imap(_run_task, [self._task(function, (i,)) for i in inputs], chunksize))
+
+
+    def imap_unordered(self, function, inputs, chunksize = 1):
+        """
+        Args:
+            chunksize: number of consecutive inputs sent to a worker at once, they are run one after the other
+                       by the same worker (ie. so the worker can reuse what it cached for the previous input)
+        Returns:
+            iterator of the results of function(input) for every input, in the order they finish
+        """
+
+        return self._collect(self._pool.imap_unordered(_run_task, [self._task(function, (i,)) for i in inputs], chunksize))
+
+
+    def apply_async(self, function, args = ()):
+        """
+        runs function(*args) as a task
+
+        Returns:
+            TaskResult, get() waits for the result
+        """
+
+        return TaskResult(self, self._pool.apply_async(_run_task, (self._task(function, args),)))
+
+
+    def queue_depth(self):
+        """
+        Returns:
+            number of tasks waiting for a worker (submitted tasks that haven't finished, less the ones being run)
+        """
+
+        with self._lock:
+            return max(0, self.submitted - self.completed - self.processes)
+
+
+    def utilisation(self):
+        """
+        Returns:
+            fraction of the time since the pool started that the workers spent on the finished tasks
+        """
+
+        elapsed = time.time() - self.started
+        if elapsed <= 0:
+            return 0.0
+        with self._lock:
+            return min(1.0, self.busy_seconds / (elapsed * self.processes))
+
+
+    def stats(self):
+        """
+        Returns:
+            string with the number of tasks, the queue depth and the utilisation of the workers
+        """
+
+        return ("Worker pool: %d %s, %d of %d tasks finished, %d waiting (at most %d), %.0f%% utilisation"
+                % (self.processes, "threads" if self.threads else "processes", self.completed, self.submitted,
+                   self.queue_depth(), self.peak_queue_depth, 100 * self.utilisation()))
+
+
+    def shutdown(self, terminate = False):
+        """
+        stops the worker processes
+
+        Args:
+            terminate: stop the tasks that are still running (ie. after an error), rather than waiting for them
+        """
+
+        if terminate:
+            self._pool.terminate()
+        else:
+            self._pool.close()
+        self._pool.join()
+
+
+
+def _shared_pool(threads):
+    with _pool_lock:
+        if threads in _pools:
+            return _pools[threads]
+
+    #the pool is started without holding the lock, so no worker is forked while it is held
+    pool = WorkerPool(threads = threads)
+    with _pool_lock:
+        if threads not in _pools:
+            _pools[threads] = pool
+            return pool
+        shared = _pools[threads]
+
+    #another thread started the pool first
+    pool.shutdown()
+    return shared
+
+
+
+def get_pool():
+    """
+    gets the pool shared by the framework, it is started the first time
+
+    Returns:
+        WorkerPool
+    """
+
+    return _shared_pool(False)
+
+
+
+def get_thread_pool():
+    """
+    gets the pool of threads shared by the framework, it is started the first time. It has one thread
+    per cpu, for tasks that run a subprocess each
+
+    Returns:
+        WorkerPool
+    """
+
+    return _shared_pool(True)
+
+
+
+def shutdown(terminate = False):
+    """
+    stops the shared pools, if they were started, and prints their stats. The next get_pool() or
+    get_thread_pool() starts a new one
+
+    Args:
+        terminate: see WorkerPool.shutdown()
+    """
+
+    with _pool_lock:
+        pools = [_pools[threads] for threads in sorted(_pools)]
+        _pools.clear()
+    for pool in pools:
+        print pool.stats()
+        pool.shutdown(terminate)
+
+
+#workers are daemon processes, make sure they are stopped if shutdown() wasn't called
+atexit.register(shutdown, True)